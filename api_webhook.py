@@ -1,33 +1,52 @@
 ## Import Library
-import os, asyncio, logging
-from typing import Any, DefaultDict
-from collections import defaultdict
+import os, json, time, hmac, asyncio, logging, contextvars
+_T0 = time.perf_counter()  # process start, for the startup timings in /ready
+from typing import Any
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 # API
-import httpx
-from functools import lru_cache,partial
+from functools import partial
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi.responses import PlainTextResponse, JSONResponse
 from concurrent.futures import ThreadPoolExecutor
 
 # Line Library
-from linebot.v3 import WebhookHandler
+from linebot.v3 import WebhookParser
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    QuickReply, QuickReplyItem, MessageAction, TextMessage, ReplyMessageRequest
+    QuickReply, QuickReplyItem, MessageAction, TextMessage
 )
 
 # Loading Utils Script
-from utils.clients import get_line_api                    
+from utils.clients import get_async_client, close_async_clients, LINE_API_HOST
+from utils.line_outbound import LineOutbound
+from utils.warmup import Warmup
+from utils.fast_path import FastPathMatcher
+from utils.debounce import DebouncePolicy
+from utils.speculation import Speculator
 from utils.chat_history_func import (
-    get_conversation_state, del_chat_history, save_chat_history
+    get_conversation_state, del_chat_history, save_chat_history, ensure_indexes,
+    aget_conversation_state, adel_chat_history, asave_chat_history,
+    needs_compaction, compact_history, acompact_history, flush_chat_history, chat_writer, state_cache,
+    prewarm_mongo, aprewarm_mongo
 )
 from utils.rag_func import (
-    decide_search_path, generate_answer, summarize_context, get_search_results
+    decide_search_path_with_source, generate_answer, summarize_context, get_search_results,
+    RetrievalPlan, likely_service, get_cached_answer, cache_answer, search_documents,
+    adecide_search_path_with_source, agenerate_answer, asummarize_context, aget_search_results,
+    aget_cached_answer, acache_answer, asearch_documents,
+    generate_answer_with_usage, agenerate_answer_with_usage, estimate_tokens,
+    embedding_cache, embedding_batcher, search_cache, semantic_cache, intent_classifier, context_packer,
+    llm_guard, catalog, prewarm_openai, aprewarm_openai, prewarm_search, aprewarm_search, prewarm_intent_model
 )
+from utils.ingest import TurnQueue
+from utils.buffer_backend import create_buffer_backend
+from utils.dedup import create_event_dedup
+from utils.scheduler import UpstreamScheduler, UpstreamLimit, TurnShed, HIGH, LOW
+from utils import scheduler, metrics
 
 
 load_dotenv()
@@ -37,13 +56,68 @@ logger = logging.getLogger("api_webhook")
 
 # FastAPI App Initialization
 app = FastAPI() # Changed from Flask
-handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
+parser = WebhookParser(os.getenv("LINE_CHANNEL_SECRET"))
 
 # Thread Worker
 _EXEC = ThreadPoolExecutor(max_workers=int(os.getenv("MAX_WORKERS")))          
 
-# Message Window Duration
-MESSAGE_WINDOW = int(os.getenv("MESSAGE_WINDOW_EXP") or "2")
+# I/O Mode: "thread" runs the sync SDK clients on _EXEC, "async" awaits the
+# async clients (AsyncOpenAI, azure aio, AsyncMongoClient, AsyncMessagingApi)
+ASYNC_IO = (os.getenv("IO_MODE") or "thread").lower() == "async"
+
+# Message Window Duration (upper bound of the adaptive window; DEBOUNCE_ADAPTIVE=0 always waits it)
+MESSAGE_WINDOW = float(os.getenv("MESSAGE_WINDOW_EXP") or "2")
+DEBOUNCE_ADAPTIVE = (os.getenv("DEBOUNCE_ADAPTIVE") or "1") != "0"
+
+# Speculative generation alongside classification (SPECULATIVE=1); wasted
+# tokens are capped per minute by SPECULATION_TOKEN_BUDGET
+SPECULATIVE = (os.getenv("SPECULATIVE") or "0") == "1"
+SPECULATOR = Speculator(int(os.getenv("SPECULATION_TOKEN_BUDGET") or "20000"))
+
+# Per-upstream concurrency and rate limits (calls/s); UPSTREAM_LIMITS (JSON)
+# overrides them per upstream, e.g. {"openai": {"concurrency": 20, "rate": 8}}
+DEFAULT_UPSTREAM_LIMITS = {
+    "openai": {"concurrency": 32, "rate": 20},
+    "azure_search": {"concurrency": 16, "rate": 15},
+    "mongo": {"concurrency": 64},
+    "line": {"concurrency": 32, "rate": 500},
+}
+UPSTREAMS = UpstreamScheduler(
+    {
+        name: UpstreamLimit.from_config(config)
+        for name, config in {**DEFAULT_UPSTREAM_LIMITS, **json.loads(os.getenv("UPSTREAM_LIMITS") or "{}")}.items()
+    },
+    turn_estimate=float(os.getenv("TURN_ESTIMATE_SEC") or "5"),
+    # While RAG turns are being shed, one still runs every TURN_SHED_PROBE_SEC
+    # and the estimate halves every TURN_ESTIMATE_HALF_LIFE_SEC without a reply
+    probe_interval=float(os.getenv("TURN_SHED_PROBE_SEC") or "10"),
+    half_life=float(os.getenv("TURN_ESTIMATE_HALF_LIFE_SEC") or "60"),
+)
+
+# Seconds a LINE reply token stays usable after its message arrives; turns
+# that cannot reply within it are answered early with SHED_REPLY
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL") or "60")
+SHED_REPLY = "ขออภัยครับ ขณะนี้ระบบใช้เวลาตอบนานกว่าปกติ กรุณาส่งคำถามอีกครั้งในอีกสักครู่ครับ"
+
+# LINE replies, pushes and loading indicators share one pooled HTTP/2 client.
+# LINE_PUSH_FALLBACK=1 pushes answers whose reply token expired instead of
+# dropping them; pushes count against the channel's paid monthly message
+# quota, so it is off unless enabled.
+LINE_OUT = LineOutbound(
+    get_async_client,
+    LINE_API_HOST,
+    os.getenv("LINE_CHANNEL_ACCESS_TOKEN"),
+    push_fallback=(os.getenv("LINE_PUSH_FALLBACK") or "0") == "1",
+)
+
+# Clients are built on first use; PREWARM=1 (default) connects to every
+# upstream and loads the intent model in the background after startup, and
+# /ready answers 200 once that has finished (or PREWARM_TIMEOUT_SEC passed)
+PREWARM = (os.getenv("PREWARM") or "1") != "0"
+WARMUP = Warmup(_T0, timeout=float(os.getenv("PREWARM_TIMEOUT_SEC") or "10"))
+
+# Path decisions whose history-free answers may be served from the semantic cache
+SEMANTIC_CACHE_PATHS = ("INSURANCE_SERVICE", "INSURANCE_PRODUCT", "OFF-TOPIC")
 
 # FAQ Answer
 FAQ_CACHED_ANSWERS = {
@@ -53,6 +127,32 @@ FAQ_CACHED_ANSWERS = {
     "Line Thai Group" : "ที่เดียวจบ ครบทุกบริการของอาคเนย์ประกันชีวิต เช่น ดูข้อมูลประกัน แก้ไขข้อมูลกรมธรรม์ หรือ แจ้งเคลมประกัน \n เป็นเพื่อนกับ Thai Group ได้เลยที่นี่ https://lin.ee/OGWXtpN "
 }
 
+# Other phrasings that should get the same FAQ answer
+FAQ_ALIASES = {
+    "ศูนย์ดูแลลูกค้า": ["คอลเซ็นเตอร์", "call center", "เบอร์ติดต่อ", "เบอร์โทรติดต่อ", "ติดต่อเจ้าหน้าที่"],
+    "โปรโมชั่น SE Life": ["โปรโมชั่นอาคเนย์", "โปรโมชั่น selife", "promotion se life"],
+    "โปรโมชั่น IN-SURE": ["โปรโมชั่นอินทร", "โปรโมชั่น insure", "promotion insure"],
+    "Line Thai Group": ["line thaigroup", "ไลน์ไทยกรุ๊ป"],
+}
+
+# Canned intents answered before any network call (extendable via FAST_PATH_INTENTS_FILE)
+FAST_PATH = FastPathMatcher.from_config(
+    FAQ_CACHED_ANSWERS,
+    FAQ_ALIASES,
+    path=os.getenv("FAST_PATH_INTENTS_FILE") or None,
+    min_coverage=float(os.getenv("FAST_PATH_MIN_COVERAGE") or "0.8"),
+)
+
+# Quick-reply taps and canned intents flush at once; complete-looking
+# questions get a short window; otherwise the user's typing cadence decides
+DEBOUNCE = DebouncePolicy(
+    MESSAGE_WINDOW,
+    short_window=float(os.getenv("DEBOUNCE_SHORT_WINDOW") or "0.4"),
+    min_window=float(os.getenv("DEBOUNCE_MIN_WINDOW") or "0.3"),
+    is_instant=lambda message: bool(FAST_PATH.match([message])),
+    complete_chars=int(os.getenv("DEBOUNCE_COMPLETE_CHARS") or "40"),
+)
+
 # Icon Image
 FAQ_BUTTON_META = {
     "ศูนย์ดูแลลูกค้า": "https://raw.githubusercontent.com/sorawitr0607/LINE_RAG_API/main/icon_pic/customer_service.png",
@@ -71,109 +171,224 @@ FAQ_QUICK_REPLY = QuickReply(
     ])
 
 
-# Store the main event loop instance
-main_event_loop = None
-USER_BUFFERS: DefaultDict[str, dict[str, Any]] = defaultdict(lambda: {"messages": [], "reply_token": None, "task": None})
+# Debounce buffers (BUFFER_BACKEND=memcached shares them across workers); the
+# timers stay local, and the worker holding a user's latest message flushes.
+# A user's buffer is dropped after BUFFER_TTL seconds without messages.
+BUFFER = create_buffer_backend(
+    (os.getenv("BUFFER_BACKEND") or "memory").lower(),
+    _EXEC,
+    ttl=int(os.getenv("BUFFER_TTL") or "300"),
+)
+_DEBOUNCE_TASKS: dict[str, asyncio.Task] = {}
+
+# Redelivered webhook events (same webhookEventId) are dropped before
+# buffering; DEDUP_BACKEND defaults to the buffer backend, "off" disables it
+DEDUP = create_event_dedup(
+    (os.getenv("DEDUP_BACKEND") or os.getenv("BUFFER_BACKEND") or "memory").lower(),
+    _EXEC,
+    window=float(os.getenv("DEDUP_WINDOW_SEC") or "3600"),
+    maxsize=int(os.getenv("DEDUP_MAX_EVENTS") or "100000"),
+)
+
+# Debounced turns wait here for one of INGEST_WORKERS pipeline consumers
+BUSY_REPLY = "ขณะนี้มีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้งในอีกสักครู่ครับ"
+
+async def _reply_busy(user_id: str, buffer_data: dict[str, Any]) -> None:
+    with scheduler.lane(HIGH):
+        await _reply(buffer_data["reply_token"], [TextMessage(text=BUSY_REPLY, quickReply=FAQ_QUICK_REPLY)],
+                     user_id, buffer_data.get("reply_deadline"))
+
+async def _pipeline_consumer(user_id: str, buffer_data: dict[str, Any]) -> None:
+    await _run_rag_pipeline(user_id, buffer_data)
+
+TURN_QUEUE = TurnQueue(
+    _pipeline_consumer,
+    _reply_busy,
+    maxsize=int(os.getenv("INGEST_QUEUE_SIZE") or "200"),
+    workers=int(os.getenv("INGEST_WORKERS") or "16"),
+)
+
+metrics.gauge("linebot_executor_queue_depth", "Calls waiting for a thread-pool worker", lambda: _EXEC._work_queue.qsize())
+metrics.gauge("linebot_pipelines_in_flight", "Turns being processed", lambda: TURN_QUEUE.in_flight)
+metrics.gauge("linebot_turn_queue_depth", "Debounced turns waiting for a consumer", lambda: TURN_QUEUE.stats()["depth"])
+# Only backends that can count their buffers cheaply (the in-process one) report size
+if {"users", "bytes"} <= BUFFER.stats().keys():
+    metrics.gauge("linebot_buffer_users", "Users with an in-process message buffer", lambda: BUFFER.stats()["users"])
+    metrics.gauge("linebot_buffer_bytes", "Approximate size of the in-process message buffers",
+                  lambda: BUFFER.stats()["bytes"])
+metrics.gauge("linebot_debounce_pending", "Users with a debounce timer running", lambda: len(_DEBOUNCE_TASKS))
+metrics.gauge("linebot_background_tasks", "Fire-and-forget tasks still running", lambda: len(_BACKGROUND_TASKS))
+metrics.gauge("linebot_chat_write_queued", "Chat records waiting for the write-behind flush",
+              lambda: chat_writer.stats()["queued"] if chat_writer else 0)
+metrics.gauge("linebot_ready", "1 once the startup prewarm has finished", lambda: int(WARMUP.ready))
+metrics.gauge("linebot_startup_seconds", "Process start to ready (imports plus prewarm)",
+              lambda: WARMUP.ready_s if WARMUP.ready_s is not None else float("nan"))
+metrics.gauge("linebot_first_turn_seconds", "Duration of this worker's first answered turn",
+              lambda: WARMUP.first_turn_s if WARMUP.first_turn_s is not None else float("nan"))
 
 # Event Setup
 @app.on_event("startup")
 async def startup_event():
-    global main_event_loop
-    main_event_loop = asyncio.get_running_loop()
-    logger.info("Main event loop captured on startup.")
+    WARMUP.mark_started()
+    TURN_QUEUE.start()
+    logger.info("Turn queue started with %s consumers.", TURN_QUEUE.stats()["workers"])
+    _spawn(_ensure_indexes())
+    if PREWARM:
+        _spawn(WARMUP.run(_prewarm_steps()))
+    else:
+        WARMUP.mark_ready()
+
+def _prewarm_steps() -> dict:
+    """One step per upstream (plus the intent model), run concurrently by WARMUP."""
+    async def openai():
+        await _to_thread(prewarm_openai)  # the sync client also serves embeddings in async mode
+        if ASYNC_IO:
+            await aprewarm_openai()
+    return {
+        "openai": openai,
+        "azure_search": partial(_io, prewarm_search, aprewarm_search),
+        "mongo": partial(_io, prewarm_mongo, aprewarm_mongo),
+        "line": LINE_OUT.prewarm,
+        "intent_model": partial(_to_thread, prewarm_intent_model),
+    }
+
+async def _ensure_indexes() -> None:
+    try:
+        await _to_thread(ensure_indexes)
+    except Exception as e:
+        logger.warning(f"Could not ensure conversation indexes: {e}")
     
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+def _spawn(coro) -> asyncio.Task:
+    """create_task that keeps a reference until the task finishes."""
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
 async def _to_thread(fn, *args, **kwargs):
-    """Run blocking function in the shared thread-pool."""
+    """Run blocking function in the shared thread-pool (with the caller's contextvars, e.g. the turn trace)."""
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(_EXEC, partial(fn, *args, **kwargs))
-
-@lru_cache(maxsize=1)
-def get_async_client() -> httpx.AsyncClient:
-    return httpx.AsyncClient(
-        http2=True,
-        timeout=httpx.Timeout(5.0),
-        transport=httpx.AsyncHTTPTransport(retries=3)  # automatic 3-try back-off
-    )
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_EXEC, ctx.run, partial(fn, *args, **kwargs))
+
+# Upstream charged when an _io stage raises (see /metrics)
+STAGE_UPSTREAM = {
+    "get_conversation_state": "mongo", "save_chat_history": "mongo", "del_chat_history": "mongo",
+    "compact_history": "openai", "decide_search_path_with_source": "openai", "summarize_context": "openai",
+    "generate_answer": "openai", "generate_answer_with_usage": "openai",
+    "search_documents": "azure_search", "get_search_results": "azure_search",
+    "prewarm_search": "azure_search", "prewarm_mongo": "mongo",
+}
 
-async def close_async_client() -> None:
-    """Call this in FastAPI's shutdown event to close keep-alive connections."""
-    await get_async_client().aclose()
+async def _io(sync_fn, async_fn, *args):
+    """Await the async-client variant in IO_MODE=async, else run the sync one on the pool.
+
+    Each call waits for a slot of its upstream (see UPSTREAMS) and is timed
+    as a stage named after the sync function.
+    """
+    stage = sync_fn.__name__
+    upstream = STAGE_UPSTREAM.get(stage)
+    async with UPSTREAMS.slot(upstream):
+        with metrics.span(stage, upstream):
+            if ASYNC_IO:
+                return await async_fn(*args)
+            return await _to_thread(sync_fn, *args)
+
+async def _search(query: str, top_k: int, skip_k: int, service: bool):
+    return await _io(search_documents, asearch_documents, query, top_k, skip_k, service)
+
+async def _reply(reply_token: str, messages: list[TextMessage],
+                 user_id: str | None = None, deadline: float | None = None) -> str:
+    """Reply on the loop (no thread hop); if LINE rejects the token the answer may be pushed (see LineOutbound)."""
+    # A ready answer always tries its reply token: only LINE knows whether it is still valid
+    async with UPSTREAMS.slot("line", shed=False):
+        with metrics.span("line_reply", "line"):
+            return await LINE_OUT.reply(user_id, reply_token, messages, deadline)
+
+async def _reply_shed(user_id: str, reply_token: str, deadline: float | None) -> None:
+    """Canned answer for a turn that would not finish before its reply token expires."""
+    with scheduler.lane(HIGH, deadline=None):
+        await _reply(reply_token, [TextMessage(text=SHED_REPLY, quickReply=FAQ_QUICK_REPLY)], user_id, deadline)
 
 # Main Function
-## Line Loading Effect
-async def _send_loading_indicator(user_id: str, seconds: int = 40) -> None:
-    url = "https://api.line.me/v2/bot/chat/loading/start"
-    headers = {
-        "Authorization": f"Bearer {os.getenv('LINE_CHANNEL_ACCESS_TOKEN')}",
-        "Content-Type": "application/json"
-    }
-    payload = {"chatId": user_id, "loadingSeconds": seconds}
-    client = get_async_client()                     
-    await client.post(url, json=payload, headers=headers)
-
-## Run Main Event
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event: MessageEvent):
-    logger.info(f"Sync Wrapper: Received event for user {event.source.user_id}, text: '{event.message.text}'. Scheduling async handler.") #
-    if main_event_loop:
-        _ = asyncio.run_coroutine_threadsafe(_async_handle_message_logic(event), main_event_loop)
-        logger.info(f"Sync Wrapper: Task for _async_handle_message_logic scheduled on main event loop for user {event.source.user_id}.")
-
-    else:
-        logger.error(f"Sync Wrapper: Main event loop not available. Cannot schedule async task for user {event.source.user_id}.")
-
 ## Handle Receiving Message
 async def _async_handle_message_logic(event: MessageEvent):
     user_id = event.source.user_id
     message_text = event.message.text
     reply_token = event.reply_token
+    redelivery = bool(event.delivery_context and event.delivery_context.is_redelivery)
+    if DEDUP is not None and await DEDUP.seen(event.webhook_event_id, redelivery):
+        logger.info(f"[{user_id}] Dropping duplicate webhook event {event.webhook_event_id} (redelivery={redelivery}).")
+        return
     logger.info(f"Received message: '{message_text}' from user: {user_id}") 
     ### Check 'CHAT_RESET'
     if message_text == "CHAT RESET":
-        await _to_thread(del_chat_history, user_id) # chat_history_func
-        line_api = get_line_api()                   # clients_func
-        await _to_thread(
-            line_api.reply_message_with_http_info,
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text="แชทของคุณถูกรีเซ็ตเรียบร้อยแล้ว")],
-            ),
-        )
-        USER_BUFFERS.pop(user_id, None)
+        with scheduler.lane(HIGH):
+            await _io(del_chat_history, adel_chat_history, user_id) # chat_history_func
+            await _reply(reply_token, [TextMessage(text="แชทของคุณถูกรีเซ็ตเรียบร้อยแล้ว")], user_id)
+        await BUFFER.clear(user_id)
+        if task := _DEBOUNCE_TASKS.pop(user_id, None):
+            task.cancel()
         return
-    buf = USER_BUFFERS[user_id]
-    task = buf.get("task")
-    if not task or task.done():
-        asyncio.create_task(_send_loading_indicator(user_id, 30))
-
-    buf["messages"].append(message_text)
-    buf["reply_token"] = reply_token  # keep latest so we can reply
+    seq, first = await BUFFER.append(user_id, message_text, reply_token)
+    if first:
+        _spawn(LINE_OUT.start_loading(user_id, 30))
 
-    # Debounce: cancel a pending batch task and reschedule
-    if task := buf.get("task"):
+    # Debounce: cancel this worker's pending batch task and reschedule; one
+    # sleeping on another worker finds it no longer owns the batch
+    if task := _DEBOUNCE_TASKS.get(user_id):
         if not task.done():
             task.cancel()
-    buf["task"] = asyncio.create_task(process_message_batch(user_id))
+    window = DEBOUNCE.window(user_id, message_text) if DEBOUNCE_ADAPTIVE else MESSAGE_WINDOW
+    _DEBOUNCE_TASKS[user_id] = asyncio.create_task(process_message_batch(user_id, seq, window))
+
+## History Compaction
+async def _compact_history(user_id: str) -> None:
+    try:
+        with scheduler.lane(LOW):
+            compacted = await _io(compact_history, acompact_history, user_id)
+        if compacted:
+            logger.info(f"[{user_id}] Conversation history compacted.")
+    except Exception as e:
+        logger.error(f"[{user_id}] History compaction failed: {e}", exc_info=True)
 
 ## Message Batch
-async def process_message_batch(user_id: str) -> None:
+async def process_message_batch(user_id: str, seq: int, window: float = MESSAGE_WINDOW) -> None:
+    # This worker received the message whose reply token the batch will use
+    reply_deadline = time.monotonic() + REPLY_TOKEN_TTL
     try:
-        logger.info(f"[{user_id}] process_message_batch: Waiting for MESSAGE_WINDOW ({MESSAGE_WINDOW}s).")
-        await asyncio.sleep(MESSAGE_WINDOW)
-        buf = USER_BUFFERS[user_id]
-        buffer_data = {"messages": buf["messages"][:], "reply_token": buf["reply_token"]}
-        buf["messages"].clear()
-        buf["reply_token"] = None
-        buf["task"] = None
-        await _run_rag_pipeline(user_id, buffer_data)
+        logger.info(f"[{user_id}] process_message_batch: Waiting for debounce window ({window:.2f}s).")
+        await asyncio.sleep(window)
+        # Past the window this task is no longer cancelled by new messages: a
+        # newer one starts its own batch, and take() decides who owns this one.
+        if _DEBOUNCE_TASKS.get(user_id) is asyncio.current_task():
+            del _DEBOUNCE_TASKS[user_id]
+        batch = await BUFFER.take(user_id, seq)
+        if batch is None:
+            logger.info(f"[{user_id}] A newer message owns this batch; not flushing.")
+            return
+        TURN_QUEUE.offer(user_id, {"messages": batch.messages, "reply_token": batch.reply_token,
+                                   "window": window, "queued_at": time.perf_counter(),
+                                   "reply_deadline": reply_deadline})
     except asyncio.CancelledError:
         return
     except Exception as e:
         logger.error(f"[{user_id}] Error in process_message_batch: {e}", exc_info=True)
 
+## Speculative Answer
+async def _speculate(plan: RetrievalPlan, path: str, user_query: str, chat_hist: str | None) -> tuple[str, int]:
+    context = await plan.context_for(path, release=False) # rag_func
+    return await _io(generate_answer_with_usage, agenerate_answer_with_usage, user_query, context, chat_hist)
+
 ## RAG Pipeline
 async def _run_rag_pipeline(user_id: str, buffer_data: dict[str, Any]) -> tuple[str, str]| None:
     reply_token = None
+    path_decision = None
+    turn = metrics.start_turn(user_id)
+    reply_deadline = (buffer_data or {}).get("reply_deadline")
+    scheduler.set_deadline(reply_deadline)
     try:
         ### Check Empty
         if not buffer_data or not buffer_data.get("messages") or not buffer_data.get("reply_token"):
@@ -181,99 +396,150 @@ async def _run_rag_pipeline(user_id: str, buffer_data: dict[str, Any]) -> tuple[
             return None
         
         ### Start
+        if "queued_at" in buffer_data:
+            waited, window = time.perf_counter() - buffer_data["queued_at"], buffer_data["window"]
+            metrics.record("debounce", window, turn.start_ns - int((waited + window) * 1e9))
+            metrics.record("queue_wait", waited, turn.start_ns - int(waited * 1e9))
         logger.info(f"[{user_id}] Starting RAG pipeline. Buffer: {buffer_data}")
         user_query = " ".join(buffer_data["messages"])
         reply_token = buffer_data["reply_token"] 
         logger.info(f"[{user_id}] User query: '{user_query}', Reply token: {reply_token}")
 
         ### Check FAQ
-        if user_query in FAQ_CACHED_ANSWERS:
-            answer = FAQ_CACHED_ANSWERS[user_query]
+        with metrics.span("fast_path"):
+            answer = FAST_PATH.answer(buffer_data["messages"])
+        if answer is not None:
             path_decision = 'OFF-TOPIC'
-            line_api = get_line_api() # clients_func
-            logger.info(f"[{user_id}] Attempting to send RAG answer via LINE API.")
-            await _to_thread(
-                line_api.reply_message_with_http_info,
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=answer, quickReply=FAQ_QUICK_REPLY)],
-                ),
-            )
-            logger.info(f"[{user_id}] Successfully sent RAG answer.")
-            ### Save Chat
-            timestamp = datetime.now(ZoneInfo("Asia/Bangkok"))
-            await _to_thread(save_chat_history, user_id, "user", user_query, timestamp, path_decision) # chat_history_func
-            timestamp = datetime.now(ZoneInfo("Asia/Bangkok"))
-            await _to_thread(save_chat_history, user_id, "assistant", answer, timestamp, path_decision) # chat_history_func
+            with scheduler.lane(HIGH):
+                logger.info(f"[{user_id}] Attempting to send RAG answer via LINE API.")
+                await _reply(reply_token, [TextMessage(text=answer, quickReply=FAQ_QUICK_REPLY)], user_id, reply_deadline)
+                logger.info(f"[{user_id}] Successfully sent RAG answer.")
+                scheduler.set_deadline(None) # replied; the saves below are not bound by the token
+                ### Save Chat
+                timestamp = datetime.now(ZoneInfo("Asia/Bangkok"))
+                await _io(save_chat_history, asave_chat_history, user_id, "user", user_query, timestamp, path_decision) # chat_history_func
+                timestamp = datetime.now(ZoneInfo("Asia/Bangkok"))
+                await _io(save_chat_history, asave_chat_history, user_id, "assistant", answer, timestamp, path_decision) # chat_history_func
             return answer,path_decision
+
+        ### Shed Early
+        # A RAG turn that would outlive its reply token gets the canned answer now
+        if UPSTREAMS.should_shed(reply_deadline):
+            raise TurnShed("turn")
         
         ### Chat History
-        chat_hist, latest_decision, latest_user = await _to_thread(get_conversation_state, user_id) # chat_history_func
+        chat_hist, latest_decision, latest_user = await _io(get_conversation_state, aget_conversation_state, user_id) # chat_history_func
         logger.info(f"[{user_id}] Conversation state retrieved. Latest decision: {latest_decision}")
 
         ### Decide RAG Source
-        classify_fut = _to_thread(decide_search_path, user_query, chat_hist)
-
-        # launch both product+service searches in parallel (small top=3 each is cheap)
-        prod_fut    = _to_thread(get_search_results, user_query, 7, 0, False)
-        svc_fut     = _to_thread(get_search_results, user_query, 3, 0, True)
-        more_fut    = _to_thread(get_search_results, user_query, 7, 7, False)
-        path_decision = await classify_fut
-        logger.info(f"[{user_id}] Path decision: {path_decision}")
+        # Retrieval starts alongside classification: one product query covers
+        # both PRODUCT and MORE, the service index only when it looks likely.
+        want_service = likely_service(user_query, latest_decision)
+        plan = RetrievalPlan(user_query, _search, want_service)
+        predicted = SPECULATOR.predict(chat_hist, latest_decision, want_service) if SPECULATIVE else None
+        speculation = None
+        if predicted and SPECULATOR.allow():
+            speculation = asyncio.ensure_future(_speculate(plan, predicted, user_query, chat_hist))
+        try:
+            path_decision, classify_source = await _io(
+                decide_search_path_with_source, adecide_search_path_with_source, user_query, chat_hist) # rag_func
+            classify_decision = path_decision
+            logger.info(f"[{user_id}] Path decision: {path_decision}")
+
+            ### Semantic Cache
+            # Only history-free turns are safe to answer from another user's turn.
+            answer = None
+            cacheable = not chat_hist and path_decision in SEMANTIC_CACHE_PATHS
+            if cacheable:
+                answer = await _io(get_cached_answer, aget_cached_answer, user_query, path_decision) # rag_func
+                if answer is not None:
+                    plan.cancel()
+                    logger.info(f"[{user_id}] Semantic cache hit for path {path_decision}.")
+        except BaseException:
+            plan.cancel()
+            if speculation:
+                speculation.cancel()
+            raise
+
+        ### Speculative Answer
+        if speculation:
+            if answer is None and path_decision == predicted:
+                SPECULATOR.hit()
+                try:
+                    answer, _ = await speculation
+                except Exception as e:
+                    # The decided path can still answer from the plan's searches
+                    logger.warning(f"[{user_id}] Speculative answer failed ({e}); generating it normally.")
+                else:
+                    plan.cancel()
+                    logger.info(f"[{user_id}] Speculative answer kept for path {predicted}.")
+                    if cacheable:
+                        await _io(cache_answer, acache_answer, user_query, path_decision, answer) # rag_func
+            else:
+                SPECULATOR.discard(speculation, ASYNC_IO, estimate_tokens(user_query, "", chat_hist))
+                logger.info(f"[{user_id}] Speculation on {predicted} discarded (decision {path_decision}).")
 
         ### Retrieving Doc
-        context = "" # Initialize context
-        if path_decision == "INSURANCE_SERVICE":
-            context = await svc_fut # rag_func
-        elif path_decision == "INSURANCE_PRODUCT":
-            context = await prod_fut # rag_func
-        elif path_decision == "CONTINUE CONVERSATION":
-            if latest_decision!='OFF-TOPIC':
-                summary_ctx = await _to_thread(summarize_context, user_query, latest_user) # rag_func
-                service_flag = latest_decision == "INSURANCE_SERVICE"
-                context = await _to_thread(
-                    get_search_results, # rag_func
-                    summary_ctx,
-                    3 if service_flag else 7,
-                    0,
-                    service_flag,
-                )
-                path_decision = "INSURANCE_SERVICE" if service_flag else "INSURANCE_PRODUCT"
+        if answer is None:
+            context = "" # Initialize context
+            if path_decision in ("INSURANCE_SERVICE", "INSURANCE_PRODUCT", "MORE"):
+                context = await plan.context_for(path_decision) # rag_func
+            elif path_decision == "CONTINUE CONVERSATION":
+                plan.cancel()
+                if latest_decision!='OFF-TOPIC':
+                    summary_ctx = await _io(summarize_context, asummarize_context, user_query, latest_user) # rag_func
+                    service_flag = latest_decision == "INSURANCE_SERVICE"
+                    context = await _io(
+                        get_search_results, aget_search_results, # rag_func
+                        summary_ctx,
+                        3 if service_flag else 7,
+                        0,
+                        service_flag,
+                    )
+                    path_decision = "INSURANCE_SERVICE" if service_flag else "INSURANCE_PRODUCT"
+                else:
+                    context = ""
+                    path_decision = 'OFF-TOPIC'
             else:
-                context = ""
-                path_decision = 'OFF-TOPIC'
-        elif path_decision == "MORE":
-            context = await more_fut # rag_func
-        else:
-            logger.info(f"[{user_id}] Path decision is OFF-TOPIC or unrecognized. No context will be fetched for RAG.")
-            context, chat_hist = "", None
-        logger.info(f"[{user_id}] Context for RAG (length: {len(context)}): '{context[:200]}...'")
-
-        ### Answer
-        answer = await _to_thread(generate_answer, user_query, context, chat_hist) # rag_func
+                plan.cancel()
+                logger.info(f"[{user_id}] Path decision is OFF-TOPIC or unrecognized. No context will be fetched for RAG.")
+                context, chat_hist = "", None
+            logger.info(f"[{user_id}] Context for RAG (length: {len(context)}): '{context[:200]}...'")
+
+            ### Answer
+            answer = await _io(generate_answer, agenerate_answer, user_query, context, chat_hist) # rag_func
+            if cacheable:
+                await _io(cache_answer, acache_answer, user_query, path_decision, answer) # rag_func
         
         ### Send Answer API
-        line_api = get_line_api()
         logger.info(f"[{user_id}] Attempting to send RAG answer via LINE API.")
-        await _to_thread(
-            line_api.reply_message_with_http_info,
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text=answer, quickReply=FAQ_QUICK_REPLY)],
-            ),
-        )
-        logger.info(f"[{user_id}] Successfully sent RAG answer.")
+        sent = await _reply(reply_token, [TextMessage(text=answer, quickReply=FAQ_QUICK_REPLY)], user_id, reply_deadline)
+        logger.info(f"[{user_id}] Successfully sent RAG answer ({sent}).")
+        UPSTREAMS.observe_turn(time.perf_counter() - turn.start)
+        WARMUP.first_turn(time.perf_counter() - turn.start)
+        scheduler.set_deadline(None)
 
         ### Save Chat
         timestamp = datetime.now(ZoneInfo("Asia/Bangkok"))
-        await _to_thread(save_chat_history, user_id, "user", user_query, timestamp, path_decision) 
+        await _io(save_chat_history, asave_chat_history, user_id, "user", user_query, timestamp, path_decision, classify_decision, classify_source) 
         timestamp = datetime.now(ZoneInfo("Asia/Bangkok"))
-        await _to_thread(save_chat_history, user_id, "assistant", answer, timestamp, path_decision) 
+        await _io(save_chat_history, asave_chat_history, user_id, "assistant", answer, timestamp, path_decision) 
+
+        ### Compact History (after the reply, off the hot path)
+        if needs_compaction(user_id):
+            _spawn(_compact_history(user_id))
         
         return answer, path_decision
     
+    except TurnShed as e:
+        logger.warning(f"[{user_id}] Shedding turn: {e}.")
+        path_decision = "SHED"
+        await _reply_shed(user_id, reply_token, reply_deadline)
     except Exception as e:
         logger.error(f"[{user_id}] Error in _run_rag_pipeline: {e}", exc_info=True)
+    finally:
+        scheduler.set_deadline(None)
+        metrics.finish_turn(turn, path_decision)
 
 
 
@@ -284,8 +550,10 @@ async def webhook(
     body = await request.body()
     body_str = body.decode("utf-8")
 
+    # Signature check and parsing are CPU-only, so they run on the loop and
+    # LINE is acknowledged before any pipeline work starts.
     try:
-        await _to_thread(handler.handle, body_str, x_line_signature)
+        events = parser.parse(body_str, x_line_signature)
     except InvalidSignatureError:
         logger.error("Invalid LINE signature.") # Added logging
         raise HTTPException(status_code=400, detail="Invalid LINE signature")
@@ -293,13 +561,66 @@ async def webhook(
         logger.exception("Unhandled error in webhook")
         raise HTTPException(status_code=500, detail=str(exc))
 
+    for event in events:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            _spawn(_async_handle_message_logic(event))
+
     return "OK"
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ADMIN_TOKEN enables POST /admin/invalidate-caches (X-Admin-Token header):
+# after a catalog update it drops this worker's cached search hits and answers
+# without waiting for the catalog version poll (CATALOG_VERSION_POLL_SEC)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+@app.post("/admin/invalidate-caches")
+async def invalidate_caches(x_admin_token: str | None = Header(None, alias="X-Admin-Token")):
+    if not ADMIN_TOKEN or not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    version = catalog.bump()
+    search_cache.clear()
+    semantic_cache.invalidate()
+    logger.info("Caches invalidated by admin request; catalog version %s.", version)
+    return {"catalog_version": version}
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 503 until the startup prewarm has finished."""
+    return JSONResponse(WARMUP.stats(), status_code=200 if WARMUP.ready else 503)
+
+@app.get("/stats")
+async def stats():
+    return {
+        "startup": WARMUP.stats(),
+        "turn_queue": TURN_QUEUE.stats(),
+        "buffer": BUFFER.stats(),
+        "dedup": DEDUP.stats() if DEDUP else None,
+        "debounce": DEBOUNCE.stats(),
+        "speculation": SPECULATOR.stats(),
+        "upstreams": UPSTREAMS.stats(),
+        "line": LINE_OUT.stats(),
+        "llm": llm_guard.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "catalog": catalog.stats(),
+        "search_cache": search_cache.stats(),
+        "context_packer": context_packer.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "intent_model": intent_classifier.stats(),
+        "chat_writer": chat_writer.stats() if chat_writer else None,
+        "state_cache": state_cache.stats() if state_cache else None,
+    }
+
 ## 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Shutdown event triggered. Closing async client and ThreadPoolExecutor.")
-    await close_async_client()
+    await TURN_QUEUE.stop()
+    await _to_thread(flush_chat_history)
+    await close_async_clients()
     _EXEC.shutdown(wait=True) # Ensure threads complete
     logger.info("ThreadPoolExecutor shut down.")
 
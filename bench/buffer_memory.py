@@ -0,0 +1,72 @@
+"""Memory of the in-process message buffers under millions of distinct users.
+
+Drives ``InMemoryBuffer`` the way the webhook does (append a message, then
+the debounce owner takes the batch) for ``--users`` distinct user ids, with
+every user writing once and never again. With idle eviction the resident
+set is whoever wrote within the last ``--ttl`` seconds, so traced memory
+should level off; ``--no-evict`` shows the unbounded growth for comparison::
+
+    python -m bench.buffer_memory --users 2000000
+    python -m bench.buffer_memory --users 300000 --no-evict
+
+Exits non-zero if traced memory at the end is more than ``--max-growth``
+times the first report (after warm-up).
+"""
+
+## Import Library
+import sys
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+from utils.buffer_backend import InMemoryBuffer
+
+
+async def simulate(users: int, ttl: float, report_every: int) -> list[dict]:
+    buffer = InMemoryBuffer(ttl=ttl, max_users=sys.maxsize)
+    rows = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    for n in range(1, users + 1):
+        user_id = f"U{n:032x}"
+        seq, _ = await buffer.append(user_id, "ประกันสุขภาพมีแผนไหนบ้างครับ", f"{n:032x}")
+        await buffer.take(user_id, seq)
+        if n % report_every == 0:
+            stats = buffer.stats()
+            rows.append({
+                "users_seen": n,
+                "resident": stats["users"],
+                "reported_mb": stats["bytes"] / 2**20,
+                "traced_mb": tracemalloc.get_traced_memory()[0] / 2**20,
+                "evicted": stats["evicted"],
+                "seconds": time.perf_counter() - start,
+            })
+            print("{users_seen:>10,} seen  {resident:>9,} resident  {reported_mb:7.1f} MB reported  "
+                  "{traced_mb:7.1f} MB traced  {evicted:>10,} evicted  {seconds:6.1f}s".format(**rows[-1]))
+    tracemalloc.stop()
+    return rows
+
+
+def main() -> None:
+    cli = argparse.ArgumentParser(description="Buffer memory under many distinct users")
+    cli.add_argument("--users", type=int, default=1_000_000)
+    cli.add_argument("--ttl", type=float, default=1.0, help="idle seconds before a buffer is dropped")
+    cli.add_argument("--no-evict", action="store_true")
+    cli.add_argument("--report-every", type=int, default=100_000)
+    cli.add_argument("--max-growth", type=float, default=1.5)
+    args = cli.parse_args()
+
+    rows = asyncio.run(simulate(args.users, float("inf") if args.no_evict else args.ttl, args.report_every))
+    if len(rows) < 3:
+        return
+    # Skip the first report: the resident set is still filling its first ttl
+    base, last = rows[1]["traced_mb"], rows[-1]["traced_mb"]
+    growth = last / base if base else float("inf")
+    print(f"traced memory {base:.1f} MB -> {last:.1f} MB ({growth:.2f}x)")
+    if not args.no_evict and growth > args.max_growth:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
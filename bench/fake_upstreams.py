@@ -0,0 +1,268 @@
+"""Local stand-ins for OpenAI, Azure AI Search and the LINE Messaging API.
+
+One FastAPI app serves every fake so the bot can be pointed at it with
+environment variables only:
+
+* ``OPENAI_BASE_URL=http://host:port/v1``: chat completions (classifier
+  labels, summaries, answers, each with a ``usage`` block), embeddings
+  (deterministic vectors, float or base64) and the model list.
+* ``AZURE_SEARCH_ENDPOINT=http://host:port``: ``docs/search.post.search``
+  over a synthetic product/service catalog, and ``docs/$count``.
+* ``LINE_API_HOST=http://host:port``: reply, push, loading-indicator and
+  bot-info endpoints. Every reply (by reply token) and push (by user id) is
+  recorded with its arrival time so the load generator can measure
+  end-to-end latency. Reply tokens older than ``reply_token_ttl`` seconds
+  (counted from the webhook that issued them, see ``issue_token``) are
+  rejected like LINE does.
+
+Each upstream has a log-normal latency (median, sigma) and an error rate
+answered with HTTP 500.
+"""
+
+## Import Library
+import json
+import math
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+LABEL_WEIGHTS = {
+    "INSURANCE_PRODUCT": 0.45,
+    "INSURANCE_SERVICE": 0.25,
+    "CONTINUE CONVERSATION": 0.1,
+    "MORE": 0.05,
+    "OFF-TOPIC": 0.15,
+}
+SEGMENTS = ["สุขภาพ", "ออมทรัพย์", "บำนาญ", "อุบัติเหตุ", "โรคร้ายแรง", "คุ้มครองชีวิต"]
+
+
+@dataclass
+class Upstream:
+    median_ms: float = 50.0
+    sigma: float = 0.5
+    error_rate: float = 0.0
+
+    def delay(self, rng: random.Random) -> float:
+        return rng.lognormvariate(math.log(max(self.median_ms, 0.001) / 1000), self.sigma)
+
+    @classmethod
+    def parse(cls, spec: str) -> "Upstream":
+        """``median_ms[,sigma[,error_rate]]``, e.g. ``800,0.6,0.01``."""
+        parts = [float(p) for p in spec.split(",")]
+        return cls(*parts)
+
+
+@dataclass
+class FakeConfig:
+    chat: Upstream = field(default_factory=lambda: Upstream(700, 0.5))
+    classify: Upstream = field(default_factory=lambda: Upstream(350, 0.4))
+    embeddings: Upstream = field(default_factory=lambda: Upstream(60, 0.3))
+    search: Upstream = field(default_factory=lambda: Upstream(80, 0.4))
+    line: Upstream = field(default_factory=lambda: Upstream(40, 0.3))
+    reply_token_ttl: float = 60.0
+    answer_tokens: int = 180
+    embedding_dim: int = 256
+    seed: int = 7
+
+
+def _catalog(rng: random.Random) -> dict[str, list[dict]]:
+    products = [{
+        "Product_Segment": seg,
+        "Product_Name": f"แผนประกัน{seg} {i}",
+        "Unique_Pros": f"คุ้มครอง{seg}สูงสุด {i} ล้านบาท\nลดหย่อนภาษีได้",
+        "Benefit": "; ".join(f"ผลประโยชน์ข้อ {j}: จ่ายคืน {rng.randint(1, 20)}% ทุกปี" for j in range(4)),
+        "Condition": "อายุรับประกัน 1 เดือน - 70 ปี  ไม่คุ้มครองโรคที่เป็นมาก่อนการทำประกัน  ระยะเวลารอคอย 30 วัน",
+        "Product_Description": f"ประกัน{seg}สำหรับทุกช่วงวัย " * 6,
+        "Product_URL": f"https://example.com/product/{i}",
+    } for i, seg in enumerate(SEGMENTS * 5)]
+    services = [{
+        "Service_Segment": "บริการลูกค้า",
+        "Service_Name": name,
+        "Service_Detail": f"ขั้นตอน{name}: กรอกแบบฟอร์ม แนบเอกสาร ส่งที่สาขาหรือออนไลน์ " * 3,
+        "Service_URL": f"https://example.com/service/{i}",
+    } for i, name in enumerate(["เคลมสินไหม", "เปลี่ยนผู้รับประโยชน์", "ชำระเบี้ย", "ขอเอกสารกรมธรรม์", "ร้องเรียน"])]
+    return {"product": products, "service": services}
+
+
+class FakeUpstreams:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self._rng = random.Random(config.seed)
+        self._catalog = _catalog(self._rng)
+        self._lock = threading.Lock()
+        self.replies: dict[str, tuple[float, str]] = {}  # reply token -> (monotonic time, first text)
+        self.pushes: dict[str, list[tuple[float, str]]] = {}  # user id -> [(monotonic time, first text)]
+        self.issued: dict[str, float] = {}  # reply token -> monotonic time its webhook was sent
+        self.calls: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.app = self._build()
+
+    async def _upstream(self, name: str, upstream: Upstream) -> JSONResponse | None:
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            delay, fail = upstream.delay(self._rng), self._rng.random() < upstream.error_rate
+        await asyncio.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            return JSONResponse({"error": {"message": f"fake {name} failure", "type": "server_error"}}, status_code=500)
+        return None
+
+    def issue_token(self, token: str) -> None:
+        with self._lock:
+            self.issued[token] = time.monotonic()
+
+    def _vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vec = np.random.default_rng(seed).standard_normal(self.config.embedding_dim).astype(np.float32)
+        return vec / np.linalg.norm(vec)
+
+    def _completion(self, body: dict) -> tuple[str, str]:
+        system = next((m["content"] for m in body.get("messages", []) if m["role"] == "system"), "")
+        if "classification" in system.lower():
+            labels, weights = zip(*LABEL_WEIGHTS.items())
+            with self._lock:
+                return "classify", self._rng.choices(labels, weights)[0]
+        if "summar" in system.lower():
+            return "summarize", "สรุป: ผู้ใช้สนใจแผนประกันสุขภาพและเงื่อนไขการเคลม"
+        return "chat", "คำตอบจำลอง " * self.config.answer_tokens
+
+    def _build(self) -> FastAPI:
+        app = FastAPI()
+        cfg = self.config
+
+        @app.post("/v1/chat/completions")
+        async def chat(request: Request):
+            body = await request.json()
+            kind, content = self._completion(body)
+            failed = await self._upstream(kind, cfg.chat if kind == "chat" else cfg.classify)
+            if failed:
+                return failed
+            prompt = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 3
+            completion = len(content) // 3
+            return {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model") or "fake",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": prompt, "completion_tokens": completion,
+                          "total_tokens": prompt + completion},
+            }
+
+        @app.post("/v1/embeddings")
+        async def embeddings(request: Request):
+            body = await request.json()
+            failed = await self._upstream("embeddings", cfg.embeddings)
+            if failed:
+                return failed
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            as_b64 = body.get("encoding_format") == "base64"
+            data = []
+            for i, text in enumerate(inputs):
+                vec = self._vector(str(text))
+                data.append({"object": "embedding", "index": i,
+                             "embedding": base64.b64encode(vec.tobytes()).decode() if as_b64 else vec.tolist()})
+            tokens = sum(len(str(t)) for t in inputs) // 3
+            return {"object": "list", "data": data, "model": body.get("model") or "fake",
+                    "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+        @app.get("/v1/models")
+        async def models():
+            failed = await self._upstream("models", cfg.classify)
+            return failed or {"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "bench"}]}
+
+        @app.get("/indexes{index:path}/docs/$count")
+        async def count(index: str):
+            failed = await self._upstream("search_count", cfg.search)
+            if failed:
+                return failed
+            return PlainTextResponse(str(len(self._catalog["service" if "service" in index.lower() else "product"])))
+
+        @app.post("/indexes{index:path}/docs/search.post.search")
+        async def search(index: str, request: Request):
+            body = await request.json()
+            failed = await self._upstream("search", cfg.search)
+            if failed:
+                return failed
+            docs = self._catalog["service" if "service" in index.lower() else "product"]
+            select = (body.get("select") or "").split(",") if isinstance(body.get("select"), str) else body.get("select")
+            skip, top = body.get("skip") or 0, body.get("top") or 50
+            with self._lock:
+                hits = self._rng.sample(docs, min(len(docs), skip + top))[skip:skip + top]
+            value = [{"@search.score": 1.0 / (i + 1),
+                      **({k: d.get(k) for k in select if k} if select else d)} for i, d in enumerate(hits)]
+            return {"value": value}
+
+        @app.post("/v2/bot/message/reply")
+        async def reply(request: Request):
+            body = await request.json()
+            failed = await self._upstream("line_reply", cfg.line)
+            if failed:
+                return failed
+            token = body.get("replyToken")
+            with self._lock:
+                issued = self.issued.get(token)
+            if issued is not None and time.monotonic() - issued > cfg.reply_token_ttl:
+                return JSONResponse({"message": "Invalid reply token"}, status_code=400)
+            text = next((m.get("text", "") for m in body.get("messages", [])), "")
+            with self._lock:
+                self.replies[token] = (time.monotonic(), text)
+            return JSONResponse({"sentMessages": [{"id": "1", "quoteToken": "q"}]},
+                                headers={"x-line-request-id": "fake"})
+
+        @app.post("/v2/bot/message/push")
+        async def push(request: Request):
+            body = await request.json()
+            failed = await self._upstream("line_push", cfg.line)
+            if failed:
+                return failed
+            text = next((m.get("text", "") for m in body.get("messages", [])), "")
+            with self._lock:
+                self.pushes.setdefault(body.get("to"), []).append((time.monotonic(), text))
+            return JSONResponse({"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+        @app.get("/v2/bot/info")
+        async def bot_info():
+            failed = await self._upstream("line_info", cfg.line)
+            return failed or {"userId": "Ubench", "basicId": "@bench", "displayName": "Bench Bot", "chatMode": "bot"}
+
+        @app.post("/v2/bot/chat/loading/start")
+        async def loading(request: Request):
+            await request.body()
+            failed = await self._upstream("line_loading", cfg.line)
+            return failed or JSONResponse({}, status_code=202)
+
+        return app
+
+    def serve_in_thread(self, port: int) -> uvicorn.Server:
+        server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=port, log_level="warning"))
+        threading.Thread(target=server.run, name="fake-upstreams", daemon=True).start()
+        deadline = time.monotonic() + 10
+        while not server.started and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return server
+
+
+def summary(upstreams: FakeUpstreams) -> dict:
+    with upstreams._lock:
+        return {"calls": dict(upstreams.calls), "errors": dict(upstreams.errors)}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    cli = argparse.ArgumentParser(description="Serve the fake upstreams on their own")
+    cli.add_argument("--port", type=int, default=9100)
+    args = cli.parse_args()
+    fakes = FakeUpstreams(FakeConfig())
+    uvicorn.run(fakes.app, host="127.0.0.1", port=args.port, log_level="info")
+    print(json.dumps(summary(fakes)))
@@ -0,0 +1,365 @@
+"""Offline load test of ``api_webhook.app`` against the local fakes.
+
+Boots the fake upstreams (``bench/fake_upstreams.py``) in this process and
+the bot in a uvicorn subprocess pointed at them, with Mongo replaced by
+mongomock unless ``--mongo-uri`` is given. Simulated users then send bursts of
+1-3 messages as correctly signed LINE webhooks and wait for the reply before
+thinking and sending the next burst. End-to-end latency is measured from the
+last message of a burst to the moment the fake LINE API receives the reply.
+
+Results (latency percentiles, throughput, per-stage timings scraped from the
+bot's ``/metrics``, fake upstream call/error counts, and the configuration)
+are written as JSON; ``--baseline`` prints the change against an earlier file::
+
+    python -m bench.loadtest --users 50 --duration 60 --out bench/results/run.json
+    python -m bench.loadtest --chat-latency 1200,0.6,0.02 --baseline bench/results/run.json
+
+mongomock needs ``pymongo<4.9`` (newer pymongo breaks its bulk writes);
+``IO_MODE=async`` needs a real Mongo (``--mongo-uri``).
+"""
+
+## Import Library
+import os
+import sys
+import json
+import time
+import uuid
+import hmac
+import socket
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import subprocess
+from collections import defaultdict
+
+import httpx
+
+from bench.fake_upstreams import FakeConfig, FakeUpstreams, Upstream, summary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "bench-channel-secret"
+BUSY_PREFIX = "ขณะนี้มีผู้ใช้งานจำนวนมาก"
+
+# (messages of one burst); mixes single questions, split questions and quick-reply taps
+BURSTS = [
+    ["ประกันสุขภาพมีแผนไหนบ้างครับ"],
+    ["สวัสดีครับ", "อยากสอบถามเรื่องประกันออมทรัพย์", "เบี้ยเริ่มต้นเท่าไหร่"],
+    ["เคลมประกันต้องใช้เอกสารอะไรบ้าง"],
+    ["ขอดูแผนอื่นเพิ่มเติม"],
+    ["ศูนย์ดูแลลูกค้า"],
+    ["ประกันโรคร้ายแรง", "คุ้มครองมะเร็งไหมคะ"],
+    ["อยากเปลี่ยนผู้รับประโยชน์", "ต้องทำยังไง"],
+    ["แผนที่สองเงื่อนไขเป็นยังไง"],
+    ["โปรโมชั่น SE Life"],
+    ["วันนี้อากาศดีนะ"],
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def signed_payload(user_id: str, text: str, reply_token: str,
+                   event_id: str | None = None, redelivery: bool = False) -> tuple[bytes, str]:
+    body = json.dumps({
+        "destination": "Ubench",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "webhookEventId": event_id or uuid.uuid4().hex.upper()[:26],
+            "deliveryContext": {"isRedelivery": redelivery},
+            "replyToken": reply_token,
+            "message": {"id": str(random.getrandbits(60)), "type": "text", "quoteToken": "q", "text": text},
+        }],
+    }, ensure_ascii=False).encode()
+    signature = base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"count": len(values), "mean": sum(values) / len(values),
+            "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": values[-1]}
+
+
+def parse_stages(text: str) -> dict:
+    """Mean and bucket-estimated p95 per stage (all paths) from linebot_stage_seconds."""
+    buckets, sums, counts = defaultdict(dict), defaultdict(float), defaultdict(int)
+    for line in text.splitlines():
+        if not line.startswith("linebot_stage_seconds"):
+            continue
+        name, value = line.rsplit(" ", 1)
+        labels = dict(p.split("=", 1) for p in name[name.index("{") + 1:-1].replace('"', "").split(","))
+        stage = labels["stage"]
+        if name.startswith("linebot_stage_seconds_bucket"):
+            bound = float("inf") if labels["le"] == "+Inf" else float(labels["le"])
+            buckets[stage][bound] = buckets[stage].get(bound, 0) + float(value)
+        elif name.startswith("linebot_stage_seconds_sum"):
+            sums[stage] += float(value)
+        elif name.startswith("linebot_stage_seconds_count"):
+            counts[stage] += int(float(value))
+    stages = {}
+    for stage, count in counts.items():
+        p95 = next((b for b, c in sorted(buckets[stage].items()) if c >= 0.95 * count), None)
+        stages[stage] = {"count": count, "mean": sums[stage] / count if count else 0.0,
+                         "p95_le": p95 if p95 != float("inf") else None}
+    return stages
+
+
+class LoadGenerator:
+    def __init__(self, base_url: str, fakes: FakeUpstreams, args):
+        self._url = f"{base_url}/webhook"
+        self._fakes = fakes
+        self._args = args
+        self._rng = random.Random(args.seed)
+        self.latencies: list[float] = []
+        self.first_latencies: list[float] = []
+        self.busy = 0
+        self.pushed = 0
+        self.timeouts = 0
+        self.webhook_errors = 0
+        self.webhook_ack: list[float] = []
+        self.redelivered = 0
+        self._redeliveries: set[asyncio.Task] = set()
+
+    async def _send(self, client: httpx.AsyncClient, user_id: str, text: str, token: str,
+                    event_id: str | None = None, redelivery: bool = False) -> None:
+        body, signature = signed_payload(user_id, text, token, event_id, redelivery)
+        start = time.monotonic()
+        try:
+            resp = await client.post(self._url, content=body,
+                                     headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+            if resp.status_code != 200:
+                self.webhook_errors += 1
+        except httpx.HTTPError:
+            self.webhook_errors += 1
+        self.webhook_ack.append(time.monotonic() - start)
+
+    async def _await_reply(self, token: str, user_id: str, since: float, timeout: float) -> tuple[float, str] | None:
+        """The reply for ``token``, or a push to ``user_id`` after ``since`` (expired token)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            reply = self._fakes.replies.get(token)
+            if reply:
+                return reply
+            pushed = [p for p in self._fakes.pushes.get(user_id, ()) if p[0] >= since]
+            if pushed:
+                self.pushed += 1
+                return pushed[0]
+            await asyncio.sleep(0.01)
+        return None
+
+    async def _user(self, client: httpx.AsyncClient, n: int, stop_at: float) -> None:
+        rng = random.Random(self._args.seed * 1000 + n)
+        user_id = f"U{hashlib.md5(str(n).encode()).hexdigest()}"
+        await asyncio.sleep(rng.uniform(0, self._args.ramp))
+        while time.monotonic() < stop_at:
+            burst = rng.choice(BURSTS)
+            first_sent = time.monotonic()
+            token = None
+            for i, text in enumerate(burst):
+                if i:
+                    await asyncio.sleep(rng.uniform(*self._args.burst_gap))
+                token, event_id = uuid.uuid4().hex, uuid.uuid4().hex.upper()[:26]
+                self._fakes.issue_token(token)
+                await self._send(client, user_id, text, token, event_id)
+                if rng.random() < self._args.redelivery:
+                    self._redeliver(client, user_id, text, token, event_id, rng.uniform(0.2, 2.0))
+            last_sent = time.monotonic()
+            reply = await self._await_reply(token, user_id, first_sent, self._args.reply_timeout)
+            if reply is None:
+                self.timeouts += 1
+            else:
+                at, text = reply
+                if text.startswith(BUSY_PREFIX):
+                    self.busy += 1
+                else:
+                    self.latencies.append(at - last_sent)
+                    self.first_latencies.append(at - first_sent)
+            await asyncio.sleep(rng.expovariate(1 / self._args.think))
+
+    def _redeliver(self, client: httpx.AsyncClient, user_id: str, text: str, token: str,
+                   event_id: str, delay: float) -> None:
+        """Send the same event again after ``delay``, as LINE does when an ack is slow."""
+        async def later():
+            await asyncio.sleep(delay)
+            self.redelivered += 1
+            await self._send(client, user_id, text, token, event_id, redelivery=True)
+        task = asyncio.create_task(later())
+        self._redeliveries.add(task)
+        task.add_done_callback(self._redeliveries.discard)
+
+    async def run(self) -> float:
+        start = time.monotonic()
+        stop_at = start + self._args.ramp + self._args.duration
+        limits = httpx.Limits(max_connections=self._args.users * 2)
+        async with httpx.AsyncClient(timeout=10, limits=limits) as client:
+            await asyncio.gather(*(self._user(client, n, stop_at) for n in range(self._args.users)))
+            if self._redeliveries:
+                await asyncio.gather(*self._redeliveries)
+        return time.monotonic() - start
+
+
+def app_env(args, fake_url: str) -> dict:
+    params = json.dumps({"reasoning_effort": "minimal", "verbosity": "low"})
+    env = dict(os.environ)
+    env.update({
+        "LINE_CHANNEL_SECRET": SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "LINE_API_HOST": fake_url,
+        "OPENAI_API_KEY": "bench-key",
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        "OPENAI_EMBEDDING_MODEL": "fake-embedding",
+        "OPENAI_CLASSIFY_MODEL": "fake-classify",
+        "OPENAI_CHAT_MODEL": "fake-chat",
+        "OPENAI_SUMMARY_MODEL": "fake-summary",
+        "SUMMARIZE_TEXT_PARAMS": params,
+        "SUMMARIZE_CONTEXT_PARAMS": params,
+        "DECIDE_PATH_PARAMS": params,
+        "GEN_ANS_PARAMS": params,
+        "AZURE_SEARCH_ENDPOINT": fake_url,
+        "AZURE_SEARCH_KEY": "bench-key",
+        "AZURE_SEARCH_INDEX": "products",
+        "AZURE_SEARCH_INDEX_INSURANCE_SERVICE": "services",
+        "COSMOS_MONGO_URI": args.mongo_uri,
+        "COSMOS_MONGO_DB": "bench",
+        "COSMOS_MONGO_TABLE": f"conversations_{int(time.time())}",
+        "MAX_WORKERS": str(args.max_workers),
+        "INTENT_MODEL_PATH": "",
+    })
+    for pair in args.env:
+        key, _, value = pair.partition("=")
+        env[key] = value
+    return env
+
+
+async def _wait_ready(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{url}/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("bot did not become ready")
+
+
+async def _scrape(url: str) -> tuple[str, dict]:
+    async with httpx.AsyncClient(timeout=10) as client:
+        return (await client.get(f"{url}/metrics")).text, (await client.get(f"{url}/stats")).json()
+
+
+def compare(result: dict, baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        base = json.load(f)
+    print(f"vs {baseline_path}:")
+    for key in ("p50", "p95", "p99"):
+        old, new = base["latency_s"].get(key), result["latency_s"].get(key)
+        if old and new:
+            print(f"  {key}: {old:.3f}s -> {new:.3f}s ({(new - old) / old:+.1%})")
+    old, new = base["throughput_turns_per_s"], result["throughput_turns_per_s"]
+    if old:
+        print(f"  throughput: {old:.2f} -> {new:.2f} turns/s ({(new - old) / old:+.1%})")
+
+
+async def main_async(args) -> dict:
+    config = FakeConfig(
+        chat=Upstream.parse(args.chat_latency), classify=Upstream.parse(args.classify_latency),
+        embeddings=Upstream.parse(args.embedding_latency), search=Upstream.parse(args.search_latency),
+        line=Upstream.parse(args.line_latency), reply_token_ttl=args.reply_token_ttl, seed=args.seed,
+    )
+    fakes = FakeUpstreams(config)
+    fake_port, app_port = _free_port(), _free_port()
+    fake_server = fakes.serve_in_thread(fake_port)
+    fake_url, app_url = f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{app_port}"
+
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api_webhook:app", "--host", "127.0.0.1",
+         "--port", str(app_port), "--log-level", "warning"],
+        cwd=ROOT, env=app_env(args, fake_url),
+        stdout=subprocess.DEVNULL if args.quiet else None, stderr=subprocess.DEVNULL if args.quiet else None,
+    )
+    try:
+        await _wait_ready(app_url)
+        generator = LoadGenerator(app_url, fakes, args)
+        elapsed = await generator.run()
+        metrics_text, stats = await _scrape(app_url)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        fake_server.should_exit = True
+
+    turns = len(generator.latencies)
+    return {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "elapsed_s": elapsed,
+        "turns": turns,
+        "busy_replies": generator.busy,
+        "pushed_replies": generator.pushed,
+        "redelivered": generator.redelivered,
+        "timeouts": generator.timeouts,
+        "webhook_errors": generator.webhook_errors,
+        "throughput_turns_per_s": turns / elapsed if elapsed else 0.0,
+        "latency_s": percentiles(generator.latencies),
+        "latency_from_first_message_s": percentiles(generator.first_latencies),
+        "webhook_ack_s": percentiles(generator.webhook_ack),
+        "stages": parse_stages(metrics_text),
+        "bot_stats": stats,
+        "upstreams": summary(fakes),
+    }
+
+
+def main() -> None:
+    cli = argparse.ArgumentParser(description="Offline load test of the LINE RAG bot")
+    cli.add_argument("--users", type=int, default=20)
+    cli.add_argument("--duration", type=float, default=30, help="seconds of steady load after ramp-up")
+    cli.add_argument("--ramp", type=float, default=5)
+    cli.add_argument("--think", type=float, default=3, help="mean seconds between a reply and the next burst")
+    cli.add_argument("--burst-gap", type=float, nargs=2, default=(0.3, 1.2), metavar=("MIN", "MAX"))
+    cli.add_argument("--reply-timeout", type=float, default=30)
+    cli.add_argument("--reply-token-ttl", type=float, default=60,
+                     help="fake LINE rejects older reply tokens (--env LINE_PUSH_FALLBACK=1 pushes those answers)")
+    cli.add_argument("--redelivery", type=float, default=0.0,
+                     help="share of webhooks LINE delivers a second time (same webhookEventId)")
+    cli.add_argument("--chat-latency", default="700,0.5,0", help="median_ms,sigma,error_rate")
+    cli.add_argument("--classify-latency", default="350,0.4,0")
+    cli.add_argument("--embedding-latency", default="60,0.3,0")
+    cli.add_argument("--search-latency", default="80,0.4,0")
+    cli.add_argument("--line-latency", default="40,0.3,0")
+    cli.add_argument("--mongo-uri", default="mongomock://bench")
+    cli.add_argument("--max-workers", type=int, default=32)
+    cli.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                     help="extra bot setting, e.g. --env IO_MODE=async --env SPECULATIVE=1")
+    cli.add_argument("--seed", type=int, default=1)
+    cli.add_argument("--quiet", action="store_true", help="hide the bot's own output")
+    cli.add_argument("--out", default=os.path.join("bench", "results", f"loadtest_{time.strftime('%Y%m%d_%H%M%S')}.json"))
+    cli.add_argument("--baseline")
+    args = cli.parse_args()
+
+    result = asyncio.run(main_async(args))
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    lat = result["latency_s"]
+    print(f"{result['turns']} turns in {result['elapsed_s']:.1f}s "
+          f"({result['throughput_turns_per_s']:.2f}/s), busy={result['busy_replies']} pushed={result['pushed_replies']} timeouts={result['timeouts']}")
+    if lat["count"]:
+        print(f"latency p50={lat['p50']:.3f}s p95={lat['p95']:.3f}s p99={lat['p99']:.3f}s -> {args.out}")
+    if args.baseline:
+        compare(result, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
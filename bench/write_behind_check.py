@@ -0,0 +1,53 @@
+"""Check that the chat write-behind flushes on its timer, not only on a full batch.
+
+Queues a single record into ``ChatWriteBehind`` backed by mongomock and
+fails unless it reaches both collections within the flush interval (plus
+some slack)::
+
+    python -m bench.write_behind_check --flush-ms 200
+
+mongomock needs ``pymongo<4.9`` for bulk writes.
+"""
+
+## Import Library
+import sys
+import time
+import argparse
+from datetime import datetime, timezone
+
+import mongomock
+
+from utils.write_behind import ChatWriteBehind
+
+
+def _state_update(records: list[dict]) -> dict:
+    turns = [{k: r[k] for k in ("sender", "message", "timestamp")} for r in records]
+    return {"$push": {"turns": {"$each": turns}}, "$set": {"updated_at": records[-1]["timestamp"]}}
+
+
+def main() -> None:
+    cli = argparse.ArgumentParser(description="Single-record flush check for the chat write-behind")
+    cli.add_argument("--flush-ms", type=float, default=200)
+    cli.add_argument("--slack-ms", type=float, default=500)
+    args = cli.parse_args()
+
+    db = mongomock.MongoClient()["bench"]
+    writer = ChatWriteBehind(lambda: db["log"], lambda: db["state"], _state_update,
+                             max_batch=100, max_delay=args.flush_ms / 1000)
+    writer.add({"user_id": "U1", "sender": "user", "message": "hello",
+                "timestamp": datetime.now(timezone.utc), "path_decision": "OFF-TOPIC"})
+    start = time.monotonic()
+    deadline = start + (args.flush_ms + args.slack_ms) / 1000
+    while time.monotonic() < deadline:
+        if db["log"].count_documents({}) == 1 and db["state"].count_documents({"_id": "U1"}) == 1:
+            print(f"flushed after {time.monotonic() - start:.3f}s: {writer.stats()}")
+            writer.close()
+            return
+        time.sleep(0.01)
+    print(f"not flushed within {deadline - start:.3f}s: {writer.stats()}")
+    writer.close()
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
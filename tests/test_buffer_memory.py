@@ -0,0 +1,30 @@
+"""In-process buffer memory stays flat as millions of distinct users write once.
+
+A reduced run of ``bench/buffer_memory.py``: every user appends one message
+and never returns, so without idle eviction memory grows with every user.
+"""
+
+## Import Library
+import asyncio
+
+from bench.buffer_memory import simulate
+
+USERS = 200_000
+REPORT_EVERY = 40_000
+
+
+def test_traced_memory_levels_off_with_idle_eviction():
+    rows = asyncio.run(simulate(USERS, ttl=0.05, report_every=REPORT_EVERY))
+    # Skip the first report: the resident set is still filling its first ttl
+    base, last = rows[1], rows[-1]
+    assert last["traced_mb"] <= base["traced_mb"] * 1.5
+    assert last["resident"] < USERS // 10
+    assert last["evicted"] > USERS // 2
+
+
+def test_memory_grows_without_eviction():
+    # The same load with eviction off keeps every user: what the first test guards against
+    users = USERS // 4
+    rows = asyncio.run(simulate(users, ttl=float("inf"), report_every=users // 5))
+    assert rows[-1]["resident"] == users
+    assert rows[-1]["traced_mb"] > rows[1]["traced_mb"] * 1.5
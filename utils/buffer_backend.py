@@ -0,0 +1,230 @@
+"""Where debounced LINE messages wait until a user's batch is flushed.
+
+Every ``append`` bumps the user's sequence number and returns it. The worker
+holding that sequence owns the flush: when its debounce window ends it calls
+``take`` with the sequence, which hands back the batch only if no newer
+message arrived in the meantime (on any worker). Older owners get ``None`` and
+drop out, so exactly one worker runs the pipeline for each batch.
+
+``BUFFER_BACKEND=memory`` (default) keeps buffers in the process;
+``BUFFER_BACKEND=memcached`` shares them between uvicorn workers and pods
+through memcached CAS updates. Either way a user's buffer is dropped after
+``ttl`` seconds without messages, so memory follows recently active users
+rather than everyone who ever wrote.
+"""
+
+## Import Library
+import sys
+import json
+import time
+import asyncio
+import itertools
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+
+from utils import metrics
+
+EVICTIONS = metrics.register(metrics.Counter(
+    "linebot_buffer_evictions_total", "Idle per-user message buffers dropped", ("backend",)))
+
+
+@dataclass
+class Batch:
+    messages: list[str] = field(default_factory=list)
+    reply_token: str | None = None
+    seq: int = 0
+
+
+class BufferBackend(ABC):
+    @abstractmethod
+    async def append(self, user_id: str, message: str, reply_token: str) -> tuple[int, bool]:
+        """Buffer a message; returns (owner sequence, whether it started a new batch)."""
+
+    @abstractmethod
+    async def take(self, user_id: str, seq: int) -> Batch | None:
+        """Claim and clear the batch if ``seq`` still owns it."""
+
+    @abstractmethod
+    async def clear(self, user_id: str) -> None:
+        """Drop buffered messages and revoke any pending owner (CHAT RESET)."""
+
+    def stats(self) -> dict[str, int]:
+        return {}
+
+
+class _UserBuffer:
+    """One user's in-process buffer; ``messages`` is None while nothing is waiting."""
+
+    __slots__ = ("messages", "reply_token", "seq", "touched")
+
+    def __init__(self, seq: int, touched: float):
+        self.messages: list[str] | None = None
+        self.reply_token: str | None = None
+        self.seq = seq
+        self.touched = touched
+
+
+# Approximate bytes per user besides the message text: record, user id and dict entry
+_RECORD_BYTES = sys.getsizeof(_UserBuffer(0, 0.0)) + sys.getsizeof("U" + "0" * 32) + 100
+
+
+class InMemoryBuffer(BufferBackend):
+    """Single-process buffers; correct only while one worker serves all users.
+
+    Records are kept in last-touched order, so each append drops the users
+    idle for more than ``ttl`` from the front (a batch whose owner never took
+    it goes too). Sequence numbers come from one process-wide counter: a user
+    who returns after eviction gets numbers no sleeping owner can still hold.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_users: int = 1_000_000):
+        self._ttl = ttl
+        self._max_users = max_users
+        self._buffers: OrderedDict[str, _UserBuffer] = OrderedDict()
+        self._seq = itertools.count(1)
+        self._message_bytes = 0
+        self.evicted = 0
+
+    def _sweep(self, now: float) -> None:
+        buffers = self._buffers
+        while buffers:
+            user_id, buf = next(iter(buffers.items()))
+            if now - buf.touched < self._ttl and len(buffers) <= self._max_users:
+                return
+            del buffers[user_id]
+            if buf.messages:
+                self._message_bytes -= sum(map(sys.getsizeof, buf.messages))
+            self.evicted += 1
+            EVICTIONS.inc("memory")
+
+    async def append(self, user_id, message, reply_token):
+        now = time.monotonic()
+        self._sweep(now)
+        buf = self._buffers.get(user_id)
+        if buf is None:
+            buf = self._buffers[user_id] = _UserBuffer(0, now)
+        else:
+            self._buffers.move_to_end(user_id)
+            buf.touched = now
+        first = not buf.messages
+        if first:
+            buf.messages = []
+        buf.messages.append(message)
+        self._message_bytes += sys.getsizeof(message)
+        buf.reply_token = reply_token  # keep latest so we can reply
+        buf.seq = next(self._seq)
+        return buf.seq, first
+
+    async def take(self, user_id, seq):
+        buf = self._buffers.get(user_id)
+        if buf is None or buf.seq != seq or not buf.messages:
+            return None
+        batch = Batch(buf.messages, buf.reply_token, buf.seq)
+        self._message_bytes -= sum(map(sys.getsizeof, buf.messages))
+        buf.messages, buf.reply_token = None, None
+        return batch
+
+    async def clear(self, user_id):
+        # Keep the sequence moving so a sleeping owner cannot take later messages
+        buf = self._buffers.get(user_id)
+        if buf is not None:
+            if buf.messages:
+                self._message_bytes -= sum(map(sys.getsizeof, buf.messages))
+            buf.messages, buf.reply_token = None, None
+            buf.seq = next(self._seq)
+
+    def stats(self):
+        return {
+            "users": len(self._buffers),
+            "bytes": len(self._buffers) * _RECORD_BYTES + self._message_bytes,
+            "evicted": self.evicted,
+        }
+
+
+class MemcachedBuffer(BufferBackend):
+    """Buffers shared across workers: one JSON document per user, updated with gets/cas.
+
+    The document keeps its sequence after a batch is taken, so an owner from
+    before a flush or reset can never match a newer batch. Documents expire
+    after ``ttl`` seconds without messages.
+    """
+
+    def __init__(self, client, executor: Executor | None = None, ttl: int = 300,
+                 prefix: str = "linebuf:", max_attempts: int = 20):
+        self._client = client
+        self._executor = executor
+        self._ttl = ttl
+        self._prefix = prefix
+        self._max_attempts = max_attempts
+        self.conflicts = 0
+        self.lost_ownership = 0
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _update(self, user_id: str, mutate):
+        """CAS loop: ``mutate(batch)`` returns (new batch or None to leave it, result)."""
+        key = self._prefix + user_id
+        for _ in range(self._max_attempts):
+            raw, cas = self._client.gets(key)
+            batch = Batch(**json.loads(raw)) if raw else Batch()
+            new, result = mutate(batch)
+            if new is None:
+                return result
+            value = json.dumps(new.__dict__, ensure_ascii=False)
+            if raw is None:
+                stored = self._client.add(key, value, self._ttl)
+            else:
+                stored = self._client.cas(key, value, cas, self._ttl)
+            if stored:
+                return result
+            self.conflicts += 1
+        raise RuntimeError(f"Message buffer for {user_id} stayed contended after {self._max_attempts} attempts")
+
+    @staticmethod
+    def _append(message, reply_token):
+        def mutate(batch: Batch):
+            first = not batch.messages
+            batch.messages.append(message)
+            batch.reply_token = reply_token
+            batch.seq += 1
+            return batch, (batch.seq, first)
+        return mutate
+
+    @staticmethod
+    def _take(seq):
+        def mutate(batch: Batch):
+            if batch.seq != seq or not batch.messages:
+                return None, None
+            return Batch(seq=batch.seq), Batch(batch.messages, batch.reply_token, batch.seq)
+        return mutate
+
+    @staticmethod
+    def _clear(batch: Batch):
+        return Batch(seq=batch.seq + 1), None
+
+    async def append(self, user_id, message, reply_token):
+        return await self._run(self._update, user_id, self._append(message, reply_token))
+
+    async def take(self, user_id, seq):
+        batch = await self._run(self._update, user_id, self._take(seq))
+        if batch is None:
+            self.lost_ownership += 1
+        return batch
+
+    async def clear(self, user_id):
+        await self._run(self._update, user_id, self._clear)
+
+    def stats(self):
+        return {"cas_conflicts": self.conflicts, "lost_ownership": self.lost_ownership}
+
+
+def create_buffer_backend(kind: str, executor: Executor | None = None, ttl: int = 300) -> BufferBackend:
+    if kind == "memory":
+        return InMemoryBuffer(ttl=ttl)
+    if kind == "memcached":
+        from utils.clients import get_memcache
+        return MemcachedBuffer(get_memcache(), executor, ttl=ttl)
+    raise ValueError(f"Unknown BUFFER_BACKEND: {kind}")
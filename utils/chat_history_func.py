@@ -1,69 +1,512 @@
 import os
+import asyncio
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING
 
+from utils.clients import get_mongo, get_async_mongo, get_memcache
+from utils.write_behind import ChatWriteBehind
+from utils.state_cache import ConversationStateCache, SharedStateStamps
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 # MongoDB
-mongo_uri = os.getenv("COSMOS_MONGO_URI")
 mongo_db = os.getenv("COSMOS_MONGO_DB")
 mongo_table = os.getenv("COSMOS_MONGO_TABLE")
-mongo_client = MongoClient(mongo_uri)
-db = mongo_client[mongo_db]
-conversations = db[mongo_table]
+mongo_state_table = os.getenv("COSMOS_MONGO_STATE_TABLE") or f"{mongo_table}_state"
 
+# The client is created on first use (utils.clients.get_mongo), not at import
+def conversations():
+    """Append-only per-message log (analytics, intent-model training)."""
+    return get_mongo()[mongo_db][mongo_table]
 
-def get_conversation_state(user_id, summary_max_chars=2800):
-    from utils.rag_func import summarize_text
+def conversation_states():
+    """One document per user: {_id: user_id, summary, turns: [last N],
+    latest_decision, updated_at, compacted_at}."""
+    return get_mongo()[mongo_db][mongo_state_table]
+
+# Raw turns kept on the state document; older ones live only in the log/summary
+STATE_MAX_TURNS = int(os.getenv("STATE_MAX_TURNS") or "50")
+
+# History compaction: past SUMMARY_MAX_CHARS, all but the newest
+# COMPACTION_KEEP_TURNS turns are folded into the state's summary
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS") or "2800")
+COMPACTION_KEEP_TURNS = int(os.getenv("COMPACTION_KEEP_TURNS") or "4")
+COMPACTION_LEASE_SEC = int(os.getenv("COMPACTION_LEASE_SEC") or "120")
+_compaction_due: set[str] = set()
+_compacting: set[str] = set()
+_compaction_lock = threading.Lock()
+
+# State cache: active users' state documents stay in memory and are updated
+# write-through, so a turn normally skips the full Mongo read. Another worker
+# or pod may have written the user since; STATE_CACHE_VERIFY sets how a
+# cached copy is checked against the stored updated_at/compacted_at stamps:
+#   off       - not at all (no round trip); only correct when one process
+#               serves every user
+#   memcached - writers mirror the stamps in the shared memcached
+#               (SharedStateStamps), so a turn pays one memcached get; an
+#               expired key falls back to the Mongo stamp read
+#   mongo     - a projected Mongo point read of the stamps on every turn
+# auto (default) is off for one process with the in-memory buffer
+# (BUFFER_BACKEND=memory, WEB_CONCURRENCY unset or 1), memcached with
+# BUFFER_BACKEND=memcached, and mongo otherwise. Running several processes
+# with off serves stale history after another worker answers the user.
+def _verify_mode():
+    mode = (os.getenv("STATE_CACHE_VERIFY") or "auto").lower()
+    mode = {"0": "off", "1": "mongo"}.get(mode, mode)
+    if mode == "auto":
+        if (os.getenv("BUFFER_BACKEND") or "memory").lower() == "memcached":
+            return "memcached"
+        return "mongo" if int(os.getenv("WEB_CONCURRENCY") or "1") > 1 else "off"
+    if mode not in ("off", "memcached", "mongo"):
+        raise ValueError(f"Unknown STATE_CACHE_VERIFY: {mode}")
+    return mode
+
+STATE_CACHE_VERIFY = _verify_mode()
+_STAMP = {"updated_at": 1, "compacted_at": 1}
+
+
+def aconversations():
+    """Async (IO_MODE=async) handle on the same conversations collection."""
+    return get_async_mongo()[mongo_db][mongo_table]
+
+def aconversation_states():
+    return get_async_mongo()[mongo_db][mongo_state_table]
+
+
+def prewarm_mongo():
+    """Point read that opens the connection pool (startup prewarm)."""
+    conversation_states().find_one({"_id": "__prewarm__"}, {"_id": 1})
+
+async def aprewarm_mongo():
+    await aconversation_states().find_one({"_id": "__prewarm__"}, {"_id": 1})
+
+
+def ensure_indexes():
+    """(user_id, timestamp) serves the log queries; state reads are _id point lookups."""
+    conversations().create_index([("user_id", ASCENDING), ("timestamp", DESCENDING)])
+
+
+def _history_text(state, max_chars=None):
+    """Summary plus the newest raw turns that fit in ``max_chars``; flags truncation."""
+    head = [f"assistant: {state['summary']}"] if state.get("summary") else []
+    budget = (max_chars - sum(len(h) + 1 for h in head)) if max_chars else None
+    tail = []
+    for m in reversed(state.get("turns", [])):
+        line = f"{m['sender']}: {m['message']}"
+        if budget is not None:
+            budget -= len(line) + 1
+            if budget < 0 and tail:
+                return "\n".join(head + tail[::-1]), True
+        tail.append(line)
+    return "\n".join(head + tail[::-1]), budget is not None and budget < 0
+
+def history_text(state, max_chars=SUMMARY_MAX_CHARS):
+    """The history string a turn passes to the classifier and answer prompt.
+
+    Also used to rebuild the intent model's training features
+    (utils.intent_model.load_examples), so training matches serving.
+    """
+    return _history_text(state, max_chars)[0]
+
+def _state_tail(state):
+    # The very last path_decision
+    latest_decision = state.get("latest_decision")
+
+    # Extract the last 2 user messages
+    user_msgs = [m["message"] for m in state.get("turns", []) if m["sender"] == "user"]
+    latest_user_history = "\n".join(user_msgs[-2:])
+    return latest_decision, latest_user_history
+
+def _utc_naive(ts):
+    # Mongo hands back naive UTC datetimes; buffered records still carry their tz
+    return ts.astimezone(timezone.utc).replace(tzinfo=None) if ts.tzinfo else ts
+
+def _stored_precision(ts):
+    # BSON dates keep milliseconds, so compare buffered stamps the way Mongo stored them
+    ts = _utc_naive(ts)
+    return ts.replace(microsecond=ts.microsecond // 1000 * 1000)
+
+def _append_records(state, records):
+    """Apply ``_state_update(records)`` to an in-memory state document."""
+    update = _state_update(records)
+    state = dict(state)
+    state["turns"] = (list(state.get("turns", [])) + update["$push"]["turns"]["$each"])[-STATE_MAX_TURNS:]
+    state.update(update["$set"])
+    return state
+
+def _with_pending(user_id, state):
+    """Overlay this user's not-yet-flushed records so a turn always sees the previous one."""
+    state = state or {"summary": "", "turns": []}
+    pending = chat_writer.pending(user_id) if chat_writer else []
+    since = state.get("updated_at")
+    new = [r for r in pending if since is None or _stored_precision(r["timestamp"]) > _stored_precision(since)]
+    return _append_records(state, new) if new else state
+
+def _stamp_current(user_id, state, stamp):
+    """True when no other worker has written or compacted the user since ``state`` was cached."""
+    if stamp is None:
+        # Nothing stored yet: fine if the cached turns are still in the write-behind buffer
+        return not (state.get("summary") or state.get("turns")) or bool(chat_writer and chat_writer.pending(user_id))
+    if stamp.get("compacted_at") != state.get("compacted_at"):
+        return False
+    stored, cached = stamp.get("updated_at"), state.get("updated_at")
+    # Local writes may not be flushed yet, so the cached copy can be ahead of Mongo
+    return stored is None or (cached is not None and _utc_naive(stored) <= _utc_naive(cached))
+
+def _verified(user_id, state, stamp):
+    if _stamp_current(user_id, state, stamp):
+        return state
+    state_cache.mark_stale(user_id)
+    return None
+
+def _mirrored_stamp(user_id):
+    try:
+        return state_stamps.get(user_id)
+    except Exception as e:
+        logger.warning(f"Reading the state stamp for {user_id} from memcached failed: {e}")
+        return None
+
+def _seed_stamp(user_id, stamp):
+    try:
+        state_stamps.seed(user_id, stamp)
+    except Exception as e:
+        logger.warning(f"Seeding the state stamp for {user_id} in memcached failed: {e}")
+
+def _stored_stamp(user_id):
+    """The user's stored stamps (None: no state document), mirrored or from Mongo."""
+    stamp = _mirrored_stamp(user_id) if state_stamps else None
+    if stamp is None:
+        stamp = conversation_states().find_one({"_id": user_id}, _STAMP)
+        if state_stamps and stamp is not None:
+            _seed_stamp(user_id, stamp)
+    return stamp
+
+async def _astored_stamp(user_id):
+    stamp = await asyncio.to_thread(_mirrored_stamp, user_id) if state_stamps else None
+    if stamp is None:
+        stamp = await aconversation_states().find_one({"_id": user_id}, _STAMP)
+        if state_stamps and stamp is not None:
+            await asyncio.to_thread(_seed_stamp, user_id, stamp)
+    return stamp
+
+def _publish_stamps(stamps):
+    """Mirror newly stored stamps ({user_id: {updated_at/compacted_at}}) for other workers."""
+    if not state_stamps:
+        return
+    for user_id, stamp in stamps.items():
+        try:
+            state_stamps.publish(user_id, stamp)
+        except Exception as e:
+            logger.warning(f"Publishing the state stamp for {user_id} failed; dropping it: {e}")
+            _forget_stamp(user_id)
+
+def _forget_stamp(user_id):
+    """Without a mirrored stamp, other workers check the user against Mongo."""
+    if not state_stamps:
+        return
+    try:
+        state_stamps.forget(user_id)
+    except Exception as e:
+        logger.warning(f"Dropping the state stamp for {user_id} failed: {e}")
+
+def _on_stored(by_user):
+    _publish_stamps({user_id: {"updated_at": records[-1]["timestamp"]} for user_id, records in by_user.items()})
 
-    # 1) Query Chat History
-    msgs = list(conversations.find(
-        {"user_id": user_id},
-        sort=[("timestamp", -1)]
-    ))
-    if not msgs:
+def _load_state(user_id, state, token):
+    state = _with_pending(user_id, state)
+    if state_cache:
+        state_cache.put(user_id, state, token)
+    return state
+
+def _read_state(user_id, state, summary_max_chars):
+    if not state or not (state.get("summary") or state.get("turns")):
         return "", None, ""
+    # No LLM call here: an over-long history is trimmed to its newest turns and
+    # compacted in the background after the reply (see compact_history).
+    history, truncated = _history_text(state, summary_max_chars)
+    if truncated:
+        with _compaction_lock:
+            _compaction_due.add(user_id)
+    latest_decision, latest_user_history = _state_tail(state)
+    return history, latest_decision, latest_user_history
 
-    # Reverse back to chronological order
-    msgs = list(reversed(msgs))
 
-    # 2) Build raw history text for summarization
-    history_text = "\n".join(f"{m['sender']}: {m['message']}" for m in msgs)
-    summary = summarize_text(history_text, summary_max_chars, user_id)
+def get_conversation_state(user_id, summary_max_chars=SUMMARY_MAX_CHARS):
+    state = state_cache.get(user_id) if state_cache else None
+    if state is not None and STATE_CACHE_VERIFY != "off":
+        state = _verified(user_id, state, _stored_stamp(user_id))
+    if state is None:
+        # Point lookup of the user's state document
+        token = state_cache.begin_load() if state_cache else 0
+        state = _load_state(user_id, conversation_states().find_one({"_id": user_id}), token)
+    return _read_state(user_id, state, summary_max_chars)
 
-    # 3) Extract the very last path_decision
-    latest_decision = msgs[-1].get("path_decision")
+async def aget_conversation_state(user_id, summary_max_chars=SUMMARY_MAX_CHARS):
+    state = state_cache.get(user_id) if state_cache else None
+    if state is not None and STATE_CACHE_VERIFY != "off":
+        state = _verified(user_id, state, await _astored_stamp(user_id))
+    if state is None:
+        token = state_cache.begin_load() if state_cache else 0
+        state = _load_state(user_id, await aconversation_states().find_one({"_id": user_id}), token)
+    return _read_state(user_id, state, summary_max_chars)
 
-    # 4) Extract the last 2 user messages
-    user_msgs = [m["message"] for m in msgs if m["sender"] == "user"]
-    # keep up to last 2
-    latest_user_history = "\n".join(user_msgs[-2:]) if len(user_msgs) >= 2 else "\n".join(user_msgs)
 
-    return summary, latest_decision, latest_user_history
+## History Compaction
+def needs_compaction(user_id):
+    return user_id in _compaction_due
 
-def get_latest_decide(user_id, limit=1):
-    messages = list(conversations.find(
-        {"user_id": user_id,
-         "path_decision": {"$ne": "OFF-TOPIC"}},
+def _claim_compaction(user_id):
+    with _compaction_lock:
+        _compaction_due.discard(user_id)
+        if user_id in _compacting:
+            return False
+        _compacting.add(user_id)
+        return True
+
+def _release_compaction(user_id):
+    with _compaction_lock:
+        _compacting.discard(user_id)
+
+def _lease():
+    """(filter, update) claiming the state document so only one worker compacts it."""
+    now = datetime.now(timezone.utc)
+    return (
+        {"$or": [{"compacting_until": None}, {"compacting_until": {"$lt": now}}]},
+        {"$set": {"compacting_until": now + timedelta(seconds=COMPACTION_LEASE_SEC)}},
+    )
+
+def _compaction_plan(state, max_chars):
+    """Text to summarise and the timestamp of the newest turn it covers, or None."""
+    if not state or not _history_text(state, max_chars)[1]:
+        return None
+    old = state.get("turns", [])[:-COMPACTION_KEEP_TURNS] if COMPACTION_KEEP_TURNS else state.get("turns", [])
+    if not old:
+        return None
+    text, _ = _history_text({"summary": state.get("summary"), "turns": old})
+    return text, old[-1]["timestamp"]
+
+def _compaction_update(summary, cutoff):
+    # Only turns at or before the cutoff are folded into the summary, so turns
+    # appended while the summary was generated survive, and re-running after a
+    # failure redoes the same work.
+    return {
+        "$set": {"summary": summary, "compacted_at": datetime.now(timezone.utc)},
+        "$pull": {"turns": {"timestamp": {"$lte": cutoff}}},
+        "$unset": {"compacting_until": ""},
+    }
+
+def compact_history(user_id, max_chars=SUMMARY_MAX_CHARS):
+    from utils.rag_func import summarize_text
+
+    if not _claim_compaction(user_id):
+        return False
+    try:
+        lease_filter, lease_update = _lease()
+        state = conversation_states().find_one_and_update({"_id": user_id, **lease_filter}, lease_update)
+        plan = _compaction_plan(state, max_chars)
+        if plan is None:
+            if state is not None:
+                conversation_states().update_one({"_id": user_id}, {"$unset": {"compacting_until": ""}})
+            return False
+        text, cutoff = plan
+        summary = summarize_text(text, 0)
+        update = _compaction_update(summary, cutoff)
+        conversation_states().update_one({"_id": user_id}, update)
+        if state_cache:
+            state_cache.invalidate(user_id)
+        _publish_stamps({user_id: {"compacted_at": update["$set"]["compacted_at"]}})
+        return True
+    finally:
+        _release_compaction(user_id)
+
+async def acompact_history(user_id, max_chars=SUMMARY_MAX_CHARS):
+    from utils.rag_func import asummarize_text
+
+    if not _claim_compaction(user_id):
+        return False
+    try:
+        lease_filter, lease_update = _lease()
+        state = await aconversation_states().find_one_and_update({"_id": user_id, **lease_filter}, lease_update)
+        plan = _compaction_plan(state, max_chars)
+        if plan is None:
+            if state is not None:
+                await aconversation_states().update_one({"_id": user_id}, {"$unset": {"compacting_until": ""}})
+            return False
+        text, cutoff = plan
+        summary = await asummarize_text(text, 0)
+        update = _compaction_update(summary, cutoff)
+        await aconversation_states().update_one({"_id": user_id}, update)
+        if state_cache:
+            state_cache.invalidate(user_id)
+        await asyncio.to_thread(_publish_stamps, {user_id: {"compacted_at": update["$set"]["compacted_at"]}})
+        return True
+    finally:
+        _release_compaction(user_id)
+
+
+def _latest_decide_query(user_id, limit):
+    return dict(
+        filter={"user_id": user_id, "path_decision": {"$ne": "OFF-TOPIC"}},
         sort=[("timestamp", -1)],
-        limit=limit
-    ))
+        limit=limit,
+    )
+
+def _latest_decide(messages):
     if not messages:
         return "OFF-TOPIC"
     messages.reverse()
     latest_decide = "\n".join([f"{m['path_decision']}" for m in messages])
     return latest_decide
 
+def get_latest_decide(user_id, limit=1):
+    return _latest_decide(list(conversations().find(**_latest_decide_query(user_id, limit))))
+
+async def aget_latest_decide(user_id, limit=1):
+    return _latest_decide(await aconversations().find(**_latest_decide_query(user_id, limit)).to_list())
+
 
-def save_chat_history(user_id, sender, message, timestamp,path_decision):
-    conversations.insert_one({
+def _chat_record(user_id, sender, message, timestamp, path_decision, classify_decision=None, classify_source=None):
+    record = {
         "user_id": user_id,
         "sender": sender,
         "message": message,
         "timestamp": timestamp,
         "path_decision" : path_decision
-    })
-    
+    }
+    # Raw classifier label (before CONTINUE CONVERSATION is resolved) and who
+    # gave it ("llm" or "local"); only LLM labels are used for training
+    if classify_decision:
+        record["classify_decision"] = classify_decision
+    if classify_source:
+        record["classify_source"] = classify_source
+    return record
+
+def _state_update(records):
+    """Append turns to the state document, keeping only the last STATE_MAX_TURNS."""
+    turns = [
+        {k: r[k] for k in ("sender", "message", "timestamp", "path_decision")}
+        for r in records
+    ]
+    return {
+        "$push": {"turns": {"$each": turns, "$slice": -STATE_MAX_TURNS}},
+        "$set": {"latest_decision": records[-1]["path_decision"], "updated_at": records[-1]["timestamp"]},
+    }
+
+def save_chat_history(user_id, sender, message, timestamp,path_decision, classify_decision=None, classify_source=None):
+    record = _chat_record(user_id, sender, message, timestamp, path_decision, classify_decision, classify_source)
+    if state_cache:
+        state_cache.apply(user_id, [record])
+    if chat_writer:
+        chat_writer.add(record)
+        return
+    conversations().insert_one(record)
+    conversation_states().update_one({"_id": user_id}, _state_update([record]), upsert=True)
+    _on_stored({user_id: [record]})
+
+async def asave_chat_history(user_id, sender, message, timestamp,path_decision, classify_decision=None, classify_source=None):
+    record = _chat_record(user_id, sender, message, timestamp, path_decision, classify_decision, classify_source)
+    if state_cache:
+        state_cache.apply(user_id, [record])
+    if chat_writer:
+        chat_writer.add(record)
+        return
+    await aconversations().insert_one(record)
+    await aconversation_states().update_one({"_id": user_id}, _state_update([record]), upsert=True)
+    await asyncio.to_thread(_on_stored, {user_id: [record]})
+
 def del_chat_history(user_id):
-    conversations.delete_many({"user_id": user_id})
+    if chat_writer:
+        chat_writer.discard(user_id)
+    conversations().delete_many({"user_id": user_id})
+    conversation_states().delete_one({"_id": user_id})
+    if state_cache:
+        state_cache.invalidate(user_id)
+    _forget_stamp(user_id)
+
+async def adel_chat_history(user_id):
+    if chat_writer:
+        await asyncio.to_thread(chat_writer.discard, user_id)
+    await aconversations().delete_many({"user_id": user_id})
+    await aconversation_states().delete_one({"_id": user_id})
+    if state_cache:
+        state_cache.invalidate(user_id)
+    await asyncio.to_thread(_forget_stamp, user_id)
+
+def flush_chat_history():
+    """Write out buffered turns; call from FastAPI's shutdown event."""
+    if chat_writer:
+        chat_writer.close()
+
+
+# Write-behind: turns from all users are flushed together with insert_many /
+# bulk_write (CHAT_WRITE_BEHIND=0 writes each record directly instead)
+chat_writer = (
+    ChatWriteBehind(
+        conversations,
+        conversation_states,
+        _state_update,
+        max_batch=int(os.getenv("CHAT_WRITE_BATCH") or "100"),
+        max_delay=float(os.getenv("CHAT_WRITE_FLUSH_MS") or "200") / 1000,
+        on_stored=_on_stored,
+    )
+    if (os.getenv("CHAT_WRITE_BEHIND") or "1") != "0" else None
+)
+
+state_cache = (
+    ConversationStateCache(
+        _append_records,
+        max_bytes=int(os.getenv("STATE_CACHE_MB") or "64") * 1024 * 1024,
+        idle_ttl=float(os.getenv("STATE_CACHE_TTL") or "1800"),
+        write_window=float(os.getenv("STATE_CACHE_WRITE_WINDOW") or "300"),
+    )
+    if (os.getenv("STATE_CACHE") or "1") != "0" else None
+)
+
+state_stamps = (
+    SharedStateStamps(get_memcache(), ttl=int(float(os.getenv("STATE_CACHE_TTL") or "1800")))
+    if state_cache and STATE_CACHE_VERIFY == "memcached" else None
+)
+
+
+def migrate_states():
+    """Build state documents from the per-message layout (idempotent: replaces each user's state)."""
+    ensure_indexes()
+    migrated, user_id, records = 0, None, []
+
+    def flush():
+        if records:
+            update = _state_update(records)
+            conversation_states().replace_one({"_id": user_id}, {
+                "summary": "",
+                "turns": update["$push"]["turns"]["$each"][-STATE_MAX_TURNS:],
+                **update["$set"],
+            }, upsert=True)
+
+    for m in conversations().find({}, sort=[("user_id", ASCENDING), ("timestamp", ASCENDING)]):
+        if m["user_id"] != user_id:
+            flush()
+            migrated += user_id is not None
+            user_id, records = m["user_id"], []
+        records.append(m)
+    flush()
+    migrated += user_id is not None
+    return migrated
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Conversation state maintenance")
+    cli.add_argument("command", choices=["migrate", "ensure-indexes"])
+    args = cli.parse_args()
+    if args.command == "migrate":
+        count = migrate_states()
+        print(f"{datetime.now(ZoneInfo('Asia/Bangkok')).isoformat()} migrated {count} users to {mongo_state_table}")
+    else:
+        ensure_indexes()
+        print(f"Indexes ensured on {mongo_table}")
@@ -1,44 +1,80 @@
 ## Import Library
+# SDKs are imported inside their factory on first use, so importing this
+# module (and the app) stays fast; see api_webhook's prewarm for warming them
+from __future__ import annotations
+
 import os
+import threading
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from openai import OpenAI
-# from google import genai
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+
+if TYPE_CHECKING:
+    import httpx
+    from azure.search.documents import SearchClient
+    from azure.search.documents.aio import SearchClient as AsyncSearchClient
+    from openai import OpenAI, AsyncOpenAI
+    from linebot.v3.messaging import MessagingApi, AsyncMessagingApi
 
 load_dotenv()
 
+# Overridable so the load-test harness (bench/) can point LINE calls at a local fake
+LINE_API_HOST = os.getenv("LINE_API_HOST") or "https://api.line.me"
+
 ## Setup Variable
+# Sync clients may be first requested from several pool threads at once
+_lock = threading.Lock()
 _search_client: SearchClient | None = None
 _service_search_client : SearchClient | None = None
 _openai_client:  OpenAI       | None = None
 # _gemini_client:  genai.Client | None = None
 _line_api: MessagingApi | None = None
+_memcache_client = None
+_mongo_client = None
 
+## Async clients (IO_MODE=async); created on first use inside the event loop
+_async_search_client: AsyncSearchClient | None = None
+_async_service_search_client: AsyncSearchClient | None = None
+_async_openai_client: AsyncOpenAI | None = None
+_async_mongo_client = None
+_async_line_api: AsyncMessagingApi | None = None
+_http_client: httpx.AsyncClient | None = None
+
+
+def _azure_key():
+    from azure.core.credentials import AzureKeyCredential
+    return AzureKeyCredential(os.getenv("AZURE_SEARCH_KEY"))
 
 def get_search_client() -> SearchClient:
     global _search_client
-    if _search_client is None:            
-        _search_client = SearchClient(
-            endpoint = os.getenv("AZURE_SEARCH_ENDPOINT"),
-            credential = AzureKeyCredential(os.getenv("AZURE_SEARCH_KEY")),
-            index_name = os.getenv("AZURE_SEARCH_INDEX"))
+    if _search_client is None:
+        with _lock:
+            if _search_client is None:
+                from azure.search.documents import SearchClient
+                _search_client = SearchClient(
+                    endpoint = os.getenv("AZURE_SEARCH_ENDPOINT"),
+                    credential = _azure_key(),
+                    index_name = os.getenv("AZURE_SEARCH_INDEX"))
     return _search_client  
 
 def get_service_search_client() -> SearchClient:
     global _service_search_client
-    if _service_search_client is None:            
-        _service_search_client = SearchClient(
-            endpoint = os.getenv("AZURE_SEARCH_ENDPOINT"),
-            credential = AzureKeyCredential(os.getenv("AZURE_SEARCH_KEY")),
-            index_name = os.getenv("AZURE_SEARCH_INDEX_INSURANCE_SERVICE"))
+    if _service_search_client is None:
+        with _lock:
+            if _service_search_client is None:
+                from azure.search.documents import SearchClient
+                _service_search_client = SearchClient(
+                    endpoint = os.getenv("AZURE_SEARCH_ENDPOINT"),
+                    credential = _azure_key(),
+                    index_name = os.getenv("AZURE_SEARCH_INDEX_INSURANCE_SERVICE"))
     return _service_search_client               
 
 def get_openai() -> OpenAI:
     global _openai_client
     if _openai_client is None:
-        _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        with _lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     return _openai_client
 
 # def get_gemini() -> genai.Client:
@@ -52,6 +88,118 @@ def get_line_api() -> MessagingApi:
     """Thread-safe singleton for the LINE Messaging API."""
     global _line_api
     if _line_api is None:
-        configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
-        _line_api = MessagingApi(ApiClient(configuration))
+        with _lock:
+            if _line_api is None:
+                from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+                configuration = Configuration(host=LINE_API_HOST, access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+                _line_api = MessagingApi(ApiClient(configuration))
     return _line_api
+
+
+def get_async_search_client() -> AsyncSearchClient:
+    global _async_search_client
+    if _async_search_client is None:
+        from azure.search.documents.aio import SearchClient as AsyncSearchClient
+        _async_search_client = AsyncSearchClient(
+            endpoint = os.getenv("AZURE_SEARCH_ENDPOINT"),
+            credential = _azure_key(),
+            index_name = os.getenv("AZURE_SEARCH_INDEX"))
+    return _async_search_client
+
+def get_async_service_search_client() -> AsyncSearchClient:
+    global _async_service_search_client
+    if _async_service_search_client is None:
+        from azure.search.documents.aio import SearchClient as AsyncSearchClient
+        _async_service_search_client = AsyncSearchClient(
+            endpoint = os.getenv("AZURE_SEARCH_ENDPOINT"),
+            credential = _azure_key(),
+            index_name = os.getenv("AZURE_SEARCH_INDEX_INSURANCE_SERVICE"))
+    return _async_service_search_client
+
+def get_async_openai() -> AsyncOpenAI:
+    global _async_openai_client
+    if _async_openai_client is None:
+        from openai import AsyncOpenAI
+        _async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _async_openai_client
+
+def get_mongo():
+    """Sync MongoClient for chat history, created on first use.
+
+    A ``mongomock://`` URI gives an in-memory stand-in for the load-test
+    harness (bench/); mongomock is not a runtime dependency and needs
+    pymongo < 4.9 for bulk writes.
+    """
+    global _mongo_client
+    if _mongo_client is None:
+        with _lock:
+            if _mongo_client is None:
+                uri = os.getenv("COSMOS_MONGO_URI")
+                if uri and uri.startswith("mongomock://"):
+                    import mongomock
+                    _mongo_client = mongomock.MongoClient()
+                else:
+                    from pymongo import MongoClient
+                    _mongo_client = MongoClient(uri)
+    return _mongo_client
+
+def get_async_mongo():
+    """pymongo's AsyncMongoClient (pymongo >= 4.9), imported only when IO_MODE=async uses it."""
+    global _async_mongo_client
+    if _async_mongo_client is None:
+        from pymongo import AsyncMongoClient
+        _async_mongo_client = AsyncMongoClient(os.getenv("COSMOS_MONGO_URI"))
+    return _async_mongo_client
+
+def get_async_line_api() -> AsyncMessagingApi:
+    global _async_line_api
+    if _async_line_api is None:
+        from linebot.v3.messaging import Configuration, AsyncApiClient, AsyncMessagingApi
+        configuration = Configuration(host=LINE_API_HOST, access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+        _async_line_api = AsyncMessagingApi(AsyncApiClient(configuration))
+    return _async_line_api
+
+def get_async_client() -> httpx.AsyncClient:
+    """Pooled HTTP/2 client for calls made with raw HTTP (LINE outbound, see utils/line_outbound.py)."""
+    global _http_client
+    if _http_client is None:
+        import httpx
+        # http2/limits go on the transport: httpx ignores the client's own when one is passed
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(5.0),
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_connections=int(os.getenv("LINE_HTTP_MAX_CONNECTIONS") or "20")),
+                retries=3,  # automatic 3-try back-off on connect errors
+            ),
+        )
+    return _http_client
+
+def get_memcache():
+    """Shared memcached client (BUFFER_BACKEND=memcached); MEMCACHED_SERVERS is comma-separated host:port."""
+    global _memcache_client
+    if _memcache_client is None:
+        import bmemcached
+        _memcache_client = bmemcached.Client(
+            (os.getenv("MEMCACHED_SERVERS") or "127.0.0.1:11211").split(","),
+            os.getenv("MEMCACHED_USERNAME"),
+            os.getenv("MEMCACHED_PASSWORD"))
+    return _memcache_client
+
+async def close_async_clients() -> None:
+    """Close whichever async clients were created; call from FastAPI's shutdown event."""
+    global _async_search_client, _async_service_search_client, _async_openai_client
+    global _async_mongo_client, _async_line_api, _http_client
+    for search in (_async_search_client, _async_service_search_client):
+        if search is not None:
+            await search.close()
+    if _async_openai_client is not None:
+        await _async_openai_client.close()
+    if _async_mongo_client is not None:
+        await _async_mongo_client.close()
+    if _async_line_api is not None:
+        await _async_line_api.api_client.close()
+    if _http_client is not None:
+        await _http_client.aclose()
+    _async_search_client = _async_service_search_client = _async_openai_client = None
+    _async_mongo_client = _async_line_api = _http_client = None
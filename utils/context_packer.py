@@ -0,0 +1,193 @@
+"""Packs search hits into the answer prompt under a token budget.
+
+Each hit is turned once into a compact rendering, cached by a hash of its
+field values: a header line (name, segment), its URL, and the long fields
+split into segments (lines, bullets) with their token sets. Per query, the
+packer always keeps every hit's header and URL, then fills the remaining
+``budget`` with the segments that best match the query. It weights segments
+by field (e.g. Unique_Pros over Condition) and by the hit's rank, drops
+segments already used by a higher-ranked hit, and cuts over-long segments.
+Selected segments are emitted in their original field order.
+
+Token counts are estimates (about 3 characters per token for mixed
+Thai/English text). That is enough to budget prompts and report the saving
+against rendering every field of every hit.
+"""
+
+## Import Library
+import re
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from utils.local_index import tokenize
+
+CHARS_PER_TOKEN = 3
+DOC_SEPARATOR = "================="
+MAX_SEGMENT_CHARS = 400
+
+# (field, label, weight); weight None marks header/URL fields that are always kept
+PRODUCT_LAYOUT = [
+    ("Product_Name", "Product Name", None),
+    ("Product_Segment", "Product Segment", None),
+    ("Unique_Pros", "Unique Point", 1.0),
+    ("Benefit", "Product Benefit", 0.9),
+    ("Product_Description", "Product Description", 0.7),
+    ("Condition", "Product Condition", 0.5),
+    ("Product_URL", "URL", None),
+]
+SERVICE_LAYOUT = [
+    ("Service_Name", "Service Name", None),
+    ("Service_Segment", "Service Segment", None),
+    ("Service_Detail", "Service Detail", 1.0),
+    ("Service_URL", "URL", None),
+]
+
+_SPLIT = re.compile(r"\s*(?:\n+|•|;|\s{2,})\s*")
+
+
+def approx_tokens(text: str | None) -> int:
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+
+@dataclass
+class _Segment:
+    field: int
+    text: str
+    key: str
+    weight: float
+    tokens: frozenset
+    cost: int
+
+
+@dataclass
+class _Compact:
+    fixed: list[tuple[int, str]]
+    segments: list[_Segment]
+    fixed_cost: int
+    full_cost: int
+
+
+def _compact(doc: dict, layout) -> _Compact:
+    fixed, segments, full = [], [], []
+    for i, (field, label, weight) in enumerate(layout):
+        value = str(doc.get(field) or "").strip()
+        full.append(f"{label}: {value}")
+        if not value:
+            continue
+        if weight is None:
+            fixed.append((i, f"{label}: {value}"))
+            continue
+        seen = set()
+        for part in _SPLIT.split(value):
+            part = part.strip(" -–")
+            if not part or part in seen:
+                continue
+            seen.add(part)
+            if len(part) > MAX_SEGMENT_CHARS:
+                part = part[:MAX_SEGMENT_CHARS].rstrip() + "…"
+            segments.append(_Segment(i, part, " ".join(part.lower().split()), weight,
+                                     frozenset(tokenize(part)), approx_tokens(part) + 3))
+    return _Compact(
+        fixed=fixed,
+        segments=segments,
+        fixed_cost=sum(approx_tokens(line) + 1 for _, line in fixed),
+        # What print_results/print_results_service + render_results used to send
+        full_cost=approx_tokens(f"{DOC_SEPARATOR}\n".join(full)) + 6,
+    )
+
+
+class ContextPacker:
+    """``budget`` <= 0 disables the limit (compaction and de-duplication still apply)."""
+
+    def __init__(self, budget: int, cache_size: int = 4096):
+        self._budget = budget
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[tuple, _Compact] = OrderedDict()
+        self.packs = 0
+        self.tokens_full = 0
+        self.tokens_packed = 0
+        self.deduped = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _compact_for(self, doc: dict, layout, kind: str) -> _Compact:
+        key = (kind, hash(tuple(str(doc.get(f) or "") for f, _, _ in layout)))
+        with self._lock:
+            compact = self._cache.get(key)
+            if compact is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return compact
+            self.cache_misses += 1
+        compact = _compact(doc, layout)
+        with self._lock:
+            self._cache[key] = compact
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return compact
+
+    def pack(self, docs: list[dict], service: bool, query: str) -> str:
+        layout, kind = (SERVICE_LAYOUT, "service") if service else (PRODUCT_LAYOUT, "product")
+        compacts = [self._compact_for(d, layout, kind) for d in docs]
+        if not compacts:
+            return ""
+        q = set(tokenize(query or ""))
+
+        # Headers and URLs of every hit first; the rest of the budget goes to segments
+        remaining = (self._budget - sum(c.fixed_cost + 1 for c in compacts)) if self._budget > 0 else math.inf
+        candidates = []
+        for rank, compact in enumerate(compacts):
+            for pos, seg in enumerate(compact.segments):
+                overlap = len(q & seg.tokens) / len(q) if q else 0.0
+                score = seg.weight * (1 + 2 * overlap) / (1 + 0.15 * rank) * (1.1 if pos == 0 else 1.0)
+                candidates.append((score, rank, pos, seg))
+        candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+
+        chosen: set[tuple[int, int]] = set()
+        used_texts: set[str] = set()
+        deduped = 0
+        for _, rank, pos, seg in candidates:
+            if seg.key in used_texts:
+                deduped += 1
+                continue
+            if seg.cost > remaining:
+                continue
+            remaining -= seg.cost
+            chosen.add((rank, pos))
+            used_texts.add(seg.key)
+
+        blocks = []
+        for rank, compact in enumerate(compacts):
+            lines = dict(compact.fixed)
+            by_field: dict[int, list[str]] = {}
+            for pos, seg in enumerate(compact.segments):
+                if (rank, pos) in chosen:
+                    by_field.setdefault(seg.field, []).append(seg.text)
+            for field, texts in by_field.items():
+                label = layout[field][1]
+                lines[field] = f"{label}: {texts[0]}" if len(texts) == 1 else f"{label}:\n- " + "\n- ".join(texts)
+            blocks.append("\n".join(lines[i] for i in sorted(lines)))
+        text = f"\n{DOC_SEPARATOR}\n".join(blocks)
+
+        with self._lock:
+            self.packs += 1
+            self.tokens_full += sum(c.full_cost for c in compacts)
+            self.tokens_packed += approx_tokens(text)
+            self.deduped += deduped
+        return text
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "packs": self.packs,
+                "tokens_full": self.tokens_full,
+                "tokens_packed": self.tokens_packed,
+                "tokens_saved": self.tokens_full - self.tokens_packed,
+                "segments_deduped": self.deduped,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cached_docs": len(self._cache),
+            }
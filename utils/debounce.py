@@ -0,0 +1,106 @@
+"""Adaptive debounce window for batching a user's LINE messages.
+
+Instead of always waiting ``MESSAGE_WINDOW`` seconds, each incoming message
+picks the window for its batch:
+
+* ``instant`` (0s): quick-reply taps and other canned intents;
+* ``complete``: the message already reads like a whole question (question
+  mark, Thai question word/particle at the end, or long enough), so only a
+  short grace window;
+* ``cadence``: the user's own typing rhythm, an EWMA of recent gaps between
+  consecutive messages, scaled by ``cadence_factor``;
+* ``default``: no cadence learned yet.
+
+Every window is capped at ``max_window``. Chosen windows and the wait saved
+against always using the cap are exported on ``/metrics``.
+"""
+
+## Import Library
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from utils import metrics
+from utils.fast_path import normalize_text
+
+WINDOW_SECONDS = metrics.register(metrics.Histogram(
+    "linebot_debounce_window_seconds", "Debounce window chosen for a message", ("kind",),
+    buckets=(0.0, 0.1, 0.25, 0.4, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0)))
+SAVED_SECONDS = metrics.register(metrics.Counter(
+    "linebot_debounce_saved_seconds_total", "Debounce wait saved against always waiting the max window"))
+
+QUESTION_ENDINGS = (
+    "ไหม", "มั้ย", "มั๊ย", "มัย", "ไม", "หรือเปล่า", "รึเปล่า", "หรือป่าว", "ป่าว", "หรือยัง", "รึยัง",
+    "หรือไม่", "ยังไง", "อย่างไร", "เท่าไหร่", "เท่าไร", "อะไร", "อะไรบ้าง", "ที่ไหน", "ไหน", "บ้าง",
+    "ทำไม", "เมื่อไหร่", "เมื่อไร", "กี่วัน", "กี่ปี", "กี่บาท", "ได้ไหม", "หรอ", "เหรอ",
+)
+
+
+def looks_complete(message: str, min_chars: int = 40) -> bool:
+    """Heuristic: the user has probably finished typing this thought."""
+    if message.rstrip().endswith(("?", "？")):
+        return True
+    text = normalize_text(message)
+    return text.endswith(QUESTION_ENDINGS) or len(text) >= min_chars
+
+
+class DebouncePolicy:
+    def __init__(self, max_window: float, short_window: float = 0.4, min_window: float = 0.3,
+                 is_instant: Callable[[str], bool] | None = None, complete_chars: int = 40,
+                 alpha: float = 0.3, cadence_factor: float = 1.5, max_users: int = 100_000):
+        self._max = max_window
+        self._short = min(short_window, max_window)
+        self._min = min(min_window, max_window)
+        self._is_instant = is_instant or (lambda _: False)
+        self._complete_chars = complete_chars
+        self._alpha = alpha
+        self._factor = cadence_factor
+        self._max_users = max_users
+        self._lock = threading.Lock()
+        # user_id -> (last message monotonic time, EWMA of gaps or None)
+        self._users: OrderedDict[str, tuple[float, float | None]] = OrderedDict()
+        self.windows = {"instant": 0, "complete": 0, "cadence": 0, "default": 0}
+        self.window_total = 0.0
+        self.saved_total = 0.0
+
+    def _observe(self, user_id: str, now: float) -> float | None:
+        with self._lock:
+            last, ewma = self._users.pop(user_id, (None, None))
+            if last is not None:
+                gap = now - last
+                # Gaps well past the cap are separate turns, not typing rhythm
+                if gap <= 2 * self._max:
+                    ewma = gap if ewma is None else self._alpha * gap + (1 - self._alpha) * ewma
+            self._users[user_id] = (now, ewma)
+            if len(self._users) > self._max_users:
+                self._users.popitem(last=False)
+            return ewma
+
+    def window(self, user_id: str, message: str) -> float:
+        ewma = self._observe(user_id, time.monotonic())
+        if self._is_instant(message):
+            kind, window = "instant", 0.0
+        elif looks_complete(message, self._complete_chars):
+            kind, window = "complete", self._short
+        elif ewma is not None:
+            kind, window = "cadence", max(self._min, min(self._max, ewma * self._factor))
+        else:
+            kind, window = "default", self._max
+        with self._lock:
+            self.windows[kind] += 1
+            self.window_total += window
+            self.saved_total += self._max - window
+        WINDOW_SECONDS.observe(window, kind)
+        SAVED_SECONDS.inc(amount=self._max - window)
+        return window
+
+    def stats(self) -> dict:
+        with self._lock:
+            chosen = sum(self.windows.values())
+            return {
+                "windows": dict(self.windows),
+                "avg_window_s": self.window_total / chosen if chosen else 0.0,
+                "latency_saved_s": self.saved_total,
+                "tracked_users": len(self._users),
+            }
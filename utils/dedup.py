@@ -0,0 +1,111 @@
+"""Drop LINE webhook redeliveries before they are buffered.
+
+LINE redelivers an event (same ``webhookEventId``, ``deliveryContext.
+isRedelivery`` set) when our acknowledgement is slow or fails, so without a
+check one question can run the whole pipeline, and be saved, twice.
+``EventDedup.seen`` records each event id for ``window`` seconds and reports
+whether it was already there.
+
+``DEDUP_BACKEND=memory`` keeps the ids in the process, bounded by
+``maxsize`` (oldest first out). ``DEDUP_BACKEND=memcached`` also claims every
+id with an atomic ``add`` in memcached, so a redelivery that lands on another
+worker or pod is caught too; if memcached fails the event goes through
+(better a rare double answer than a lost question).
+"""
+
+## Import Library
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import Executor
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+DUPLICATES = metrics.register(metrics.Counter(
+    "linebot_webhook_duplicates_total", "Webhook events dropped as already seen", ("redelivery",)))
+
+
+class EventDedup:
+    """Time-windowed, size-bounded set of seen webhook event ids (one process)."""
+
+    def __init__(self, window: float = 3600.0, maxsize: int = 100000):
+        self._window = window
+        self._maxsize = maxsize
+        self._seen: OrderedDict[str, float] = OrderedDict()  # event id -> monotonic expiry, oldest first
+        self.checked = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def _claim_local(self, event_id: str) -> bool:
+        """Record ``event_id``; False if it is already held in the window."""
+        now = time.monotonic()
+        expiry = self._seen.get(event_id)
+        if expiry is not None and expiry > now:
+            return False
+        # Every entry has the same window, so insertion order is expiry order
+        while self._seen and next(iter(self._seen.values())) <= now:
+            self._seen.popitem(last=False)
+        while len(self._seen) >= self._maxsize:
+            self._seen.popitem(last=False)
+            self.evicted += 1
+        self._seen[event_id] = now + self._window
+        self._seen.move_to_end(event_id)
+        return True
+
+    async def _claim_shared(self, event_id: str) -> bool:
+        return True
+
+    async def seen(self, event_id: str | None, redelivery: bool = False) -> bool:
+        """True if ``event_id`` was already handled; events without an id always go through."""
+        if not event_id:
+            return False
+        self.checked += 1
+        if self._claim_local(event_id) and await self._claim_shared(event_id):
+            return False
+        self.duplicates += 1
+        DUPLICATES.inc(str(redelivery).lower())
+        return True
+
+    def stats(self) -> dict[str, int]:
+        return {"tracked": len(self._seen), "checked": self.checked,
+                "duplicates": self.duplicates, "evicted": self.evicted}
+
+
+class MemcachedEventDedup(EventDedup):
+    """Local set in front of a memcached ``add`` per event, shared by all workers."""
+
+    def __init__(self, client, executor: Executor | None = None, window: float = 3600.0,
+                 maxsize: int = 100000, prefix: str = "linewh:"):
+        super().__init__(window, maxsize)
+        self._client = client
+        self._executor = executor
+        self._prefix = prefix
+        self.errors = 0
+
+    async def _claim_shared(self, event_id: str) -> bool:
+        try:
+            # add only stores when the key is absent: the first worker wins
+            return bool(await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._client.add, self._prefix + event_id, "1", int(self._window)))
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Webhook dedup check failed for {event_id}; handling it anyway: {e}")
+            return True
+
+    def stats(self):
+        return {**super().stats(), "errors": self.errors}
+
+
+def create_event_dedup(kind: str, executor: Executor | None = None, window: float = 3600.0,
+                       maxsize: int = 100000) -> EventDedup | None:
+    if kind in ("off", "none"):
+        return None
+    if kind == "memory":
+        return EventDedup(window, maxsize)
+    if kind == "memcached":
+        from utils.clients import get_memcache
+        return MemcachedEventDedup(get_memcache(), executor, window, maxsize)
+    raise ValueError(f"Unknown DEDUP_BACKEND: {kind}")
@@ -0,0 +1,278 @@
+## Import Library
+import time
+import asyncio
+import sqlite3
+import queue
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text: str) -> str:
+    """Normalise text the same way for cache keys and for the embedding call."""
+    normalized = text.replace("\n", " ").strip()
+    return " ".join(normalized.split()).lower()
+
+
+class _DiskTier:
+    """Optional SQLite tier so warm embeddings survive restarts and are shared by workers."""
+
+    def __init__(self, path: str, ttl: float):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> list[float] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created, vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[0] > self._ttl:
+            return None
+        vec = array("f")
+        vec.frombytes(row[1])
+        return vec.tolist()
+
+    def put(self, key: str, vector: list[float]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)",
+                (key, time.time(), array("f", vector).tobytes()),
+            )
+            self._conn.commit()
+
+
+class EmbeddingCache:
+    """LRU+TTL embedding cache that coalesces concurrent requests for the same text.
+
+    The first caller for a key becomes the owner and starts the fetch; any
+    caller arriving while that fetch is in flight gets the owner's future
+    instead of issuing its own OpenAI request. ``fetch`` returns a future so
+    that both threads (``get``) and coroutines (``aget``) can wait on it.
+    With a disk tier, ``aget`` does the SQLite lookup on ``executor`` so it
+    never blocks the event loop.
+    """
+
+    def __init__(self, fetch: Callable[[str], Future], maxsize: int = 2048,
+                 ttl: float = 86400, disk_path: str | None = None, namespace: str = "",
+                 executor: Executor | None = None):
+        self._fetch = fetch
+        self._executor = executor
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._namespace = namespace
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._disk = _DiskTier(disk_path, ttl) if disk_path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.disk_errors = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _remember(self, key: str, vector: list[float]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _disk_get(self, key: str) -> list[float] | None:
+        """Disk-tier lookup; a failing tier (e.g. "database is locked") is a miss."""
+        if not self._disk:
+            return None
+        try:
+            return self._disk.get(f"{self._namespace}:{key}")
+        except Exception as exc:
+            with self._lock:
+                self.disk_errors += 1
+            logger.warning("Embedding disk cache read failed; treating it as a miss: %s", exc)
+            return None
+
+    def _disk_put(self, key: str, vector: list[float]) -> None:
+        if not self._disk:
+            return
+        try:
+            self._disk.put(f"{self._namespace}:{key}", vector)
+        except Exception as exc:
+            with self._lock:
+                self.disk_errors += 1
+            logger.warning("Embedding disk cache write failed: %s", exc)
+
+    def _settle(self, key: str, fut: Future, source: Future) -> None:
+        try:
+            vector = source.result()
+        except BaseException as exc:
+            with self._lock:
+                self._inflight.pop(key, None)
+            fut.set_exception(exc)
+            return
+        self._remember(key, vector)
+        with self._lock:
+            self._inflight.pop(key, None)
+        fut.set_result(vector)
+        # Runs on the thread that resolved the fetch, never the event loop,
+        # after the waiting callers already have their vector
+        self._disk_put(key, vector)
+
+    def _claim(self, key: str) -> tuple[Future, bool]:
+        """Future for ``key`` and whether the caller owns it (must call ``_load``)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                fut: Future = Future()
+                fut.set_result(entry[1])
+                return fut, False
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                return fut, False
+            fut = self._inflight[key] = Future()
+            return fut, True
+
+    def _load(self, key: str, fut: Future) -> None:
+        """Resolve an owned miss from the disk tier, or start the fetch.
+
+        Whatever happens, ``fut`` is resolved and ``key`` leaves the in-flight
+        map, so later callers never join a future nobody will settle.
+        """
+        try:
+            vector = self._disk_get(key)
+            if vector is None:
+                with self._lock:
+                    self.misses += 1
+                source = self._fetch(key)
+        except BaseException as exc:
+            with self._lock:
+                self._inflight.pop(key, None)
+            fut.set_exception(exc)
+            return
+        if vector is not None:
+            self._remember(key, vector)
+            with self._lock:
+                self.disk_hits += 1
+                self._inflight.pop(key, None)
+            fut.set_result(vector)
+            return
+        source.add_done_callback(lambda src: self._settle(key, fut, src))
+
+    def submit(self, text: str) -> Future:
+        key = normalize_query(text)
+        fut, owner = self._claim(key)
+        if owner:
+            self._load(key, fut)
+        return fut
+
+    def get(self, text: str) -> list[float]:
+        return self.submit(text).result()
+
+    async def aget(self, text: str) -> list[float]:
+        key = normalize_query(text)
+        fut, owner = self._claim(key)
+        if owner and self._disk:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._load, key, fut)
+        elif owner:
+            self._load(key, fut)
+        return await asyncio.wrap_future(fut)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "inflight": len(self._inflight),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "disk_errors": self.disk_errors,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+            }
+
+
+class EmbeddingBatcher:
+    """Collects embedding requests from concurrent callers into list-input calls.
+
+    A dispatcher thread waits for the first request, keeps collecting for up to
+    ``max_wait`` seconds or ``max_size`` texts, then sends the batch through
+    ``fetch_many`` on a small pool and resolves each caller's future.
+    """
+
+    def __init__(self, fetch_many: Callable[[list[str]], list[list[float]]],
+                 max_size: int = 64, max_wait: float = 0.005, concurrency: int = 4):
+        self._fetch_many = fetch_many
+        self._max_size = max(1, max_size)
+        self._max_wait = max(0.0, max_wait)
+        self._queue: queue.SimpleQueue[tuple[str, Future]] = queue.SimpleQueue()
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embed-batch")
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.largest_batch = 0
+        threading.Thread(target=self._dispatch, name="embed-batcher", daemon=True).start()
+
+    def submit(self, text: str) -> Future:
+        fut: Future = Future()
+        self._queue.put((text, fut))
+        return fut
+
+    def _dispatch(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._run, batch)
+
+    def _run(self, batch: list[tuple[str, Future]]) -> None:
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        with self._lock:
+            self.batches += 1
+            self.requests += len(batch)
+            self.largest_batch = max(self.largest_batch, len(texts))
+        try:
+            vectors = self._fetch_many(texts)
+            if len(vectors) != len(texts):
+                raise ValueError(f"Embedding API returned {len(vectors)} vectors for {len(texts)} inputs")
+            vectors = dict(zip(texts, vectors))
+        except Exception as exc:
+            logger.warning("Embedding batch of %d failed: %s", len(texts), exc)
+            for _, fut in batch:
+                fut.set_exception(exc)
+            return
+        for text, fut in batch:
+            fut.set_result(vectors[text])
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "largest_batch": self.largest_batch,
+                "pending": self._queue.qsize(),
+            }
@@ -0,0 +1,144 @@
+"""Fast-path matcher for canned intents (FAQ answers) that bypass the RAG pipeline.
+
+Text is normalised (case, zero-width characters, punctuation, whitespace and
+Thai/English polite particles) and scanned with an Aho-Corasick automaton
+built over every intent phrase and alias, so matching costs one pass over the
+message regardless of how many intents are configured.
+
+Extra intents can be loaded from a JSON file (``FAST_PATH_INTENTS_FILE``)::
+
+    {"ชำระเบี้ย": {"answer": "...", "aliases": ["จ่ายเบี้ย", "pay premium"]}}
+"""
+
+## Import Library
+import json
+import unicodedata
+from collections import deque
+
+POLITE_PARTICLES = (
+    "ครับผม", "ครับ", "คับ", "ขอรับ", "ค่ะ", "คะ", "จ้า", "จ้ะ", "จ๊ะ", "นะ",
+    "please", "pls", "thanks",
+)
+FILLER = {"สวัสดี", "หวัดดี", "ขอบคุณ", "hi", "hello", "hey", "ok", "โอเค"}
+_DROP_CATEGORIES = ("P", "Z", "Cf", "Cc", "S")
+
+
+def normalize_text(text: str) -> str:
+    """Fold case and Unicode form, strip particles, punctuation and all whitespace."""
+    text = unicodedata.normalize("NFC", text).lower()
+    words = []
+    for word in text.split():
+        stripped = True
+        while stripped:
+            stripped = False
+            for particle in POLITE_PARTICLES:
+                if word.endswith(particle) and len(word) > len(particle):
+                    word, stripped = word[:-len(particle)], True
+                    break
+        if word not in POLITE_PARTICLES:
+            words.append(word)
+    joined = "".join(words)
+    return "".join(ch for ch in joined if not unicodedata.category(ch).startswith(_DROP_CATEGORIES))
+
+
+class _Automaton:
+    """Aho-Corasick automaton returning (start, end, intent) for every match."""
+
+    def __init__(self, patterns: dict[str, str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[list[tuple[int, str]]] = [[]]
+        for pattern, intent in patterns.items():
+            node = 0
+            for ch in pattern:
+                if ch not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[node][ch] = len(self._goto) - 1
+                node = self._goto[node][ch]
+            self._out[node].append((len(pattern), intent))
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find(self, text: str) -> list[tuple[int, int, str]]:
+        node, matches = 0, []
+        for end, ch in enumerate(text, 1):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            matches.extend((end - length, end, intent) for length, intent in self._out[node])
+        return matches
+
+
+class FastPathMatcher:
+    """Maps a (possibly batched) user query to a canned intent, or ``None``.
+
+    Each message of a debounced batch must either be filler (greetings,
+    particles) or be covered by intent phrases for at least ``min_coverage``
+    of its normalised length; otherwise the turn falls through to the LLM.
+    """
+
+    def __init__(self, intents: dict[str, dict], min_coverage: float = 0.8):
+        self.intents = intents
+        self._min_coverage = min_coverage
+        patterns = {}
+        for intent, spec in intents.items():
+            for phrase in [intent, *spec.get("aliases", [])]:
+                key = normalize_text(phrase)
+                if key:
+                    patterns[key] = intent
+        self._automaton = _Automaton(patterns)
+
+    @classmethod
+    def from_config(cls, answers: dict[str, str], aliases: dict[str, list[str]] | None = None,
+                    path: str | None = None, min_coverage: float = 0.8) -> "FastPathMatcher":
+        intents = {k: {"answer": v, "aliases": (aliases or {}).get(k, [])} for k, v in answers.items()}
+        if path:
+            with open(path, encoding="utf-8") as f:
+                for intent, spec in json.load(f).items():
+                    merged = intents.setdefault(intent, {"aliases": []})
+                    merged["answer"] = spec.get("answer", merged.get("answer"))
+                    merged["aliases"] = merged["aliases"] + spec.get("aliases", [])
+        return cls(intents, min_coverage)
+
+    def _match_message(self, message: str) -> str | None:
+        text = normalize_text(message)
+        if not text or text in FILLER:
+            return ""
+        # Greedy longest-first cover so overlapping aliases are not double counted
+        best: dict[str, int] = {}
+        covered = [False] * len(text)
+        for start, end, intent in sorted(self._automaton.find(text), key=lambda m: m[0] - m[1]):
+            if any(covered[start:end]):
+                continue
+            covered[start:end] = [True] * (end - start)
+            best[intent] = best.get(intent, 0) + end - start
+        if not best or sum(covered) / len(text) < self._min_coverage:
+            return None
+        return max(best, key=best.get)
+
+    def match(self, messages: list[str]) -> list[str]:
+        """Intents answering every message in order, or ``[]`` if any message needs the LLM."""
+        found: list[str] = []
+        for message in messages:
+            intent = self._match_message(message)
+            if intent is None:
+                return []
+            if intent and intent not in found:
+                found.append(intent)
+        return found
+
+    def answer(self, messages: list[str]) -> str | None:
+        intents = self.match(messages)
+        if not intents:
+            return None
+        return "\n\n".join(self.intents[i]["answer"] for i in intents)
@@ -0,0 +1,108 @@
+## Import Library
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+TURNS = metrics.register(metrics.Counter(
+    "linebot_turn_queue_turns_total",
+    "Debounced turns by outcome (enqueued, dropped on a full queue, completed, failed)", ("outcome",)))
+
+
+class TurnQueue:
+    """Bounded queue of debounced turns drained by a fixed pool of consumer tasks.
+
+    ``offer`` never waits: when the queue is full the turn is handed to
+    ``on_overflow`` (e.g. a canned "busy" reply) instead of piling up, so the
+    number of pipelines in flight is capped at ``workers``.
+    """
+
+    def __init__(self, handle: Callable[..., Awaitable[Any]],
+                 on_overflow: Callable[..., Awaitable[Any]],
+                 maxsize: int = 200, workers: int = 16):
+        self._handle = handle
+        self._on_overflow = on_overflow
+        self._maxsize = maxsize
+        self._workers = workers
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._overflow: set[asyncio.Task] = set()  # overflow replies in flight; the loop holds tasks weakly
+        self._stopping = False
+        self.enqueued = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        self._tasks = [asyncio.create_task(self._consume(i)) for i in range(self._workers)]
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Let the overflow replies already sent off finish
+        await asyncio.gather(*self._overflow, return_exceptions=True)
+
+    def offer(self, *item: Any) -> bool:
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            TURNS.inc("dropped")
+            logger.warning("Turn queue full (%d); shedding turn with overflow reply.", self._maxsize)
+            task = asyncio.create_task(self._safe(self._on_overflow, item))
+            self._overflow.add(task)
+            task.add_done_callback(self._overflow.discard)
+            return False
+        self.enqueued += 1
+        TURNS.inc("enqueued")
+        return True
+
+    @staticmethod
+    async def _safe(fn, item) -> None:
+        try:
+            await fn(*item)
+        except Exception as e:
+            logger.error(f"Turn queue overflow handler failed: {e}", exc_info=True)
+
+    async def _consume(self, worker: int) -> None:
+        while True:
+            item = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await self._handle(*item)
+                self.completed += 1
+                TURNS.inc("completed")
+            except asyncio.CancelledError:
+                if self._stopping:
+                    raise
+                # A cancellation from inside the turn (not stop()) must not end the consumer
+                self.failed += 1
+                TURNS.inc("failed")
+                logger.error(f"Turn consumer {worker}: turn was cancelled", exc_info=True)
+            except Exception as e:
+                self.failed += 1
+                TURNS.inc("failed")
+                logger.error(f"Turn consumer {worker} failed: {e}", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "capacity": self._maxsize,
+            "workers": self._workers,
+            "in_flight": self.in_flight,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
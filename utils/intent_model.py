@@ -0,0 +1,209 @@
+"""Local intent classifier used in front of the LLM in ``decide_search_path``.
+
+Character n-gram TF-IDF features over the user query and the tail of the
+conversation history feed a logistic-regression model. The model answers only
+when its top probability reaches ``INTENT_MODEL_THRESHOLD``; everything else
+falls back to the LLM classifier.
+
+Train from the logged conversations and write a report::
+
+    python -m utils.intent_model train --out decide_path_lr.joblib --report intent_report.json
+    python -m utils.intent_model evaluate --model decide_path_lr.joblib
+"""
+
+## Import Library
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+
+logger = logging.getLogger(__name__)
+
+LABELS = ["INSURANCE_SERVICE", "INSURANCE_PRODUCT", "CONTINUE CONVERSATION", "MORE", "OFF-TOPIC"]
+HISTORY_TAIL_CHARS = 500
+
+
+def history_tail(chat_history: str | None) -> str:
+    return (chat_history or "")[-HISTORY_TAIL_CHARS:]
+
+
+def build_pipeline():
+    from sklearn.pipeline import Pipeline
+    from sklearn.compose import ColumnTransformer
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    features = ColumnTransformer([
+        ("query", TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), sublinear_tf=True, min_df=2), 0),
+        ("history", TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), sublinear_tf=True,
+                                    min_df=2, max_features=20000), 1),
+    ])
+    return Pipeline([
+        ("features", features),
+        ("clf", LogisticRegression(max_iter=2000, class_weight="balanced", C=4.0)),
+    ])
+
+
+class IntentClassifier:
+    """Lazily loads the exported model; ``predict`` returns ``None`` below threshold."""
+
+    def __init__(self, path: str, threshold: float):
+        self._path = path
+        self._threshold = threshold
+        self._model = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.fallbacks = 0
+
+    def _load(self):
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                if self._path and os.path.exists(self._path):
+                    import joblib
+                    self._model = joblib.load(self._path)
+                    logger.info("Loaded intent model from %s", self._path)
+        return self._model
+
+    def warm(self) -> bool:
+        """Load the model and run one prediction so the first real turn skips both."""
+        model = self._load()
+        if model is None:
+            return False
+        import numpy as np
+        model.predict_proba(np.array([["สวัสดี", ""]], dtype=object))
+        return True
+
+    def predict(self, user_query: str, chat_history: str | None = None) -> str | None:
+        model = self._model if self._loaded else self._load()
+        if model is None:
+            return None
+        import numpy as np
+        proba = model.predict_proba(np.array([[user_query, history_tail(chat_history)]], dtype=object))[0]
+        best = int(proba.argmax())
+        if proba[best] >= self._threshold:
+            self.local_hits += 1
+            return str(model.classes_[best])
+        self.fallbacks += 1
+        return None
+
+    def stats(self) -> dict[str, int]:
+        return {"local_hits": self.local_hits, "fallbacks": self.fallbacks}
+
+
+def _training_label(m: dict) -> str | None:
+    """The LLM's label for a logged user message, or None.
+
+    Labels the local model gave itself (``classify_source`` "local", or a
+    ``classify_decision`` logged without a source) are skipped, so retraining
+    never learns from its own predictions. Records from before the local
+    model only carry the final ``path_decision`` (CONTINUE CONVERSATION
+    already resolved) and are used as they are.
+    """
+    if m.get("classify_source") == "llm":
+        return m.get("classify_decision")
+    if "classify_source" not in m and "classify_decision" not in m:
+        return m.get("path_decision")
+    return None
+
+
+def load_examples(limit: int | None = None) -> list[tuple[str, str, str]]:
+    """(query, history, label) triples rebuilt from the per-message conversation log.
+
+    The history is built with ``chat_history_func.history_text`` from the
+    turns before the message, as a live turn sees it (the newest turns that
+    fit SUMMARY_MAX_CHARS; compaction summaries are not in the log).
+    """
+    from utils.chat_history_func import conversations, history_text, STATE_MAX_TURNS
+
+    examples, turns, current_user = [], [], None
+    cursor = conversations().find({}, sort=[("user_id", 1), ("timestamp", 1)])
+    for m in cursor:
+        if m["user_id"] != current_user:
+            current_user, turns = m["user_id"], []
+        if m["sender"] == "user":
+            label = _training_label(m)
+            if label in LABELS:
+                history = history_text({"turns": turns[-STATE_MAX_TURNS:]}) if turns else ""
+                examples.append((m["message"], history_tail(history), label))
+                if limit and len(examples) >= limit:
+                    break
+        turns.append({"sender": m["sender"], "message": m["message"]})
+    return examples
+
+
+def evaluate(model, examples, threshold: float) -> dict:
+    import numpy as np
+    from sklearn.metrics import accuracy_score, classification_report
+
+    X = np.array([[q, h] for q, h, _ in examples], dtype=object)
+    y = [label for _, _, label in examples]
+    start = time.perf_counter()
+    proba = model.predict_proba(X)
+    batch_ms = (time.perf_counter() - start) * 1000
+    single = []
+    for row in X[:200]:
+        t = time.perf_counter()
+        model.predict_proba(row.reshape(1, -1))
+        single.append((time.perf_counter() - t) * 1000)
+    pred = model.classes_[proba.argmax(axis=1)]
+    confident = proba.max(axis=1) >= threshold
+    single.sort()
+    return {
+        "examples": len(y),
+        "accuracy": accuracy_score(y, pred),
+        "threshold": threshold,
+        "coverage_at_threshold": float(confident.mean()) if len(y) else 0.0,
+        "accuracy_at_threshold": accuracy_score(np.array(y)[confident], pred[confident]) if confident.any() else None,
+        "latency_ms": {
+            "batch_per_example": batch_ms / max(len(y), 1),
+            "single_p50": single[len(single) // 2] if single else None,
+            "single_p99": single[int(len(single) * 0.99)] if single else None,
+        },
+        "per_label": classification_report(y, pred, output_dict=True, zero_division=0),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local intent classifier tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    train = sub.add_parser("train", help="train from Mongo conversations and export")
+    train.add_argument("--out", default=os.getenv("INTENT_MODEL_PATH") or "decide_path_lr.joblib")
+    train.add_argument("--limit", type=int)
+    train.add_argument("--report")
+    ev = sub.add_parser("evaluate", help="accuracy/latency report for an exported model")
+    ev.add_argument("--model", default=os.getenv("INTENT_MODEL_PATH") or "decide_path_lr.joblib")
+    ev.add_argument("--limit", type=int)
+    ev.add_argument("--report")
+    for p in (train, ev):
+        p.add_argument("--threshold", type=float, default=float(os.getenv("INTENT_MODEL_THRESHOLD") or "0.9"))
+    args = parser.parse_args()
+
+    import joblib
+    import numpy as np
+    from sklearn.model_selection import train_test_split
+
+    examples = load_examples(args.limit)
+    if args.cmd == "train":
+        train_set, test_set = train_test_split(
+            examples, test_size=0.2, random_state=42, stratify=[e[2] for e in examples])
+        model = build_pipeline()
+        model.fit(np.array([[q, h] for q, h, _ in train_set], dtype=object), [e[2] for e in train_set])
+        joblib.dump(model, args.out)
+        report = evaluate(model, test_set, args.threshold)
+        print(f"Trained on {len(train_set)} examples, wrote {args.out}")
+    else:
+        report = evaluate(joblib.load(args.model), examples, args.threshold)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""All outbound LINE Messaging API calls on one pooled async HTTP client.
+
+* ``start_loading`` shows the typing indicator. While one is already running
+  for a user (until it times out or a message is sent), further calls are
+  dropped instead of hitting the API again.
+* ``reply`` always tries the reply token first, even past its estimated
+  deadline (the estimate is local; only LINE knows). If LINE rejects the
+  token it can fall back to the push API (``push_fallback``, off by default),
+  so an answer that finished late still reaches the user.
+  Push messages count against the channel's monthly (paid) message quota.
+  A push that times out or gets a 5xx/429 is retried with the same
+  ``X-Line-Retry-Key``, so LINE delivers it at most once.
+"""
+
+## Import Library
+import time
+import uuid
+import asyncio
+import logging
+from typing import Callable
+
+import httpx
+from linebot.v3.messaging import ReplyMessageRequest, PushMessageRequest, TextMessage
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+PUSH_FALLBACKS = metrics.register(metrics.Counter(
+    "linebot_line_push_fallbacks_total", "Answers pushed because the reply token had expired", ("reason",)))
+
+
+class LineOutbound:
+    def __init__(self, client: Callable[[], httpx.AsyncClient], host: str, access_token: str,
+                 push_fallback: bool = False, push_retries: int = 2, max_tracked: int = 10000):
+        self._client = client
+        self._host = host.rstrip("/")
+        self._headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+        self.push_fallback = push_fallback
+        self._push_retries = push_retries
+        self._max_tracked = max_tracked
+        self._loading: dict[str, float] = {}  # user id -> monotonic time the indicator stops
+        self.loading_sent = 0
+        self.loading_coalesced = 0
+        self.loading_failed = 0
+        self.replies = 0
+        self.pushes = 0
+        self.expired = 0
+
+    async def _post(self, path: str, body: dict, headers: dict | None = None) -> httpx.Response:
+        return await self._client().post(f"{self._host}{path}", json=body,
+                                         headers={**self._headers, **headers} if headers else self._headers)
+
+    async def prewarm(self) -> None:
+        """Open the pooled HTTP/2 connection to the LINE API (startup prewarm)."""
+        resp = await self._client().get(f"{self._host}/v2/bot/info", headers=self._headers)
+        resp.raise_for_status()
+
+    ## Loading indicator
+    async def start_loading(self, user_id: str, seconds: int = 30) -> bool:
+        """Show the loading animation unless one is already running for ``user_id``."""
+        now = time.monotonic()
+        if self._loading.get(user_id, 0) > now:
+            self.loading_coalesced += 1
+            return False
+        if len(self._loading) >= self._max_tracked:
+            self._loading = {u: t for u, t in self._loading.items() if t > now}
+        self._loading[user_id] = now + seconds
+        try:
+            with metrics.span("line_loading", "line"):
+                resp = await self._post("/v2/bot/chat/loading/start", {"chatId": user_id, "loadingSeconds": seconds})
+            resp.raise_for_status()
+        except Exception as e:
+            self._loading.pop(user_id, None)
+            self.loading_failed += 1
+            logger.warning(f"[{user_id}] Loading indicator failed: {e}")
+            return False
+        self.loading_sent += 1
+        return True
+
+    ## Messages
+    @staticmethod
+    def _token_rejected(resp: httpx.Response) -> bool:
+        if resp.status_code != 400:
+            return False
+        try:
+            return "reply token" in resp.json().get("message", "").lower()
+        except ValueError:
+            return False
+
+    async def push(self, user_id: str, messages: list[TextMessage]) -> None:
+        body = PushMessageRequest(to=user_id, messages=messages).to_dict()
+        # Every attempt carries the same retry key, so LINE sends the message once
+        headers = {"X-Line-Retry-Key": str(uuid.uuid4())}
+        for attempt in range(self._push_retries + 1):
+            try:
+                resp = await self._post("/v2/bot/message/push", body, headers)
+            except httpx.TransportError:
+                if attempt == self._push_retries:
+                    raise
+            else:
+                # 409: an earlier attempt with this key was already accepted
+                if resp.status_code == 409:
+                    break
+                if (resp.status_code != 429 and resp.status_code < 500) or attempt == self._push_retries:
+                    resp.raise_for_status()
+                    break
+            await asyncio.sleep(0.2 * 2 ** attempt)
+        self._loading.pop(user_id, None)
+        self.pushes += 1
+
+    async def reply(self, user_id: str | None, reply_token: str, messages: list[TextMessage],
+                    deadline: float | None = None) -> str:
+        """Send ``messages``; returns ``"reply"``, ``"push"`` or ``"expired"`` (token gone, no push).
+
+        ``deadline`` only labels a rejection: ``"deadline"`` when the token was
+        rejected after it, ``"rejected"`` when LINE refused it earlier.
+        """
+        resp = await self._post("/v2/bot/message/reply",
+                                ReplyMessageRequest(reply_token=reply_token, messages=messages).to_dict())
+        if self._token_rejected(resp):
+            late = deadline is not None and time.monotonic() >= deadline
+            return await self._late(user_id, messages, "deadline" if late else "rejected")
+        resp.raise_for_status()
+        if user_id:
+            self._loading.pop(user_id, None)
+        self.replies += 1
+        return "reply"
+
+    async def _late(self, user_id: str | None, messages: list[TextMessage], reason: str) -> str:
+        if not (self.push_fallback and user_id):
+            self.expired += 1
+            logger.warning(f"[{user_id}] Reply token expired ({reason}); answer dropped.")
+            return "expired"
+        PUSH_FALLBACKS.inc(reason)
+        logger.info(f"[{user_id}] Reply token expired ({reason}); pushing the answer instead.")
+        await self.push(user_id, messages)
+        return "push"
+
+    def stats(self) -> dict[str, int]:
+        now = time.monotonic()
+        return {
+            "loading_active": sum(1 for t in self._loading.values() if t > now),
+            "loading_sent": self.loading_sent,
+            "loading_coalesced": self.loading_coalesced,
+            "loading_failed": self.loading_failed,
+            "replies": self.replies,
+            "pushes": self.pushes,
+            "expired": self.expired,
+        }
@@ -0,0 +1,316 @@
+"""Hedging, circuit breaking and deadlines for the chat-completion calls.
+
+``LLMGuard.create(kind, request)`` (and ``acreate`` for the async client)
+replaces a bare ``chat.completions.create(**request)``:
+
+* **Deadline.** The request timeout is capped by the turn's reply deadline
+  (``utils.scheduler``) minus ``reserve`` seconds for the LINE reply. With no
+  time left the call raises ``TurnShed`` instead of starting.
+* **Hedging.** Once ``kind`` has enough latency samples, a call still running
+  after their ``hedge_percentile`` gets a duplicate and the first answer
+  wins. Hedges are capped at ``hedge_ratio`` of calls, so a slow tail is cut
+  without paying for two requests on every call.
+* **Circuit breaker.** Per model, a call that fails or takes longer than
+  ``slow_after`` counts as bad. When the bad share of the last ``window``
+  calls reaches ``error_rate``, the breaker opens for ``cooldown`` seconds and
+  requests go to the fallback (``fallback_model`` and/or
+  ``fallback_effort``). After the cooldown one probe call decides whether it
+  closes again. A failed call on a closed breaker is also retried once on the
+  fallback.
+"""
+
+## Import Library
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
+
+from utils import metrics
+from utils.scheduler import TurnShed, current_deadline
+
+logger = logging.getLogger(__name__)
+
+HEDGES = metrics.register(metrics.Counter(
+    "linebot_llm_hedges_total", "Hedged LLM calls by which request answered first", ("kind", "winner")))
+FALLBACKS = metrics.register(metrics.Counter(
+    "linebot_llm_fallbacks_total", "LLM calls served by the fallback model/effort", ("model", "reason")))
+
+
+class _LatencyWindow:
+    def __init__(self, size: int = 200):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int) -> float | None:
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    def __init__(self, window: int, error_rate: float, cooldown: float, min_calls: int = 10):
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._error_rate = error_rate
+        self._cooldown = cooldown
+        self._min_calls = min(min_calls, window)
+        self._opened_at: float | None = None
+        self._probing = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self._cooldown else "open"
+
+    def allow(self) -> bool:
+        """True to use the primary model; while half-open only one probe at a time gets through."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record(self, ok: bool) -> None:
+        if self._opened_at is not None:
+            if not self._probing:
+                return  # a call admitted before the breaker opened
+            # Probe result: close on success, start another cooldown on failure
+            self._probing = False
+            self._opened_at = None if ok else time.monotonic()
+            return
+        self._outcomes.append(ok)
+        bad = self._outcomes.count(False)
+        if len(self._outcomes) >= self._min_calls and bad / len(self._outcomes) >= self._error_rate:
+            self._opened_at = time.monotonic()
+            self._outcomes.clear()
+            self.opened += 1
+
+
+class LLMGuard:
+    def __init__(self, client: Callable, async_client: Callable, *,
+                 timeout: float = 30.0, reserve: float = 1.5,
+                 hedge_percentile: float = 0.95, hedge_min_delay: float = 0.3,
+                 hedge_ratio: float = 0.1, hedge_min_samples: int = 20, hedge_workers: int = 32,
+                 fallback_model: str | None = None, fallback_effort: str | None = "minimal",
+                 error_rate: float = 0.5, slow_after: float = 15.0, window: int = 20, cooldown: float = 30.0):
+        self._client = client
+        self._async_client = async_client
+        self._timeout = timeout
+        self._reserve = reserve
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_delay = hedge_min_delay
+        self._hedge_ratio = hedge_ratio
+        self._hedge_min_samples = hedge_min_samples
+        self._hedge_credit = 1.0
+        self._hedge_workers = hedge_workers
+        self._pool: ThreadPoolExecutor | None = None
+        self._fallback_model = fallback_model
+        self._fallback_effort = fallback_effort
+        self._breaker_config = (window, error_rate, cooldown)
+        self._slow_after = slow_after
+        self._lock = threading.Lock()
+        self._latency: dict[str, _LatencyWindow] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    ## Policy
+    def _request_timeout(self) -> float:
+        deadline = current_deadline()
+        if deadline is None:
+            return self._timeout
+        remaining = deadline - time.monotonic() - self._reserve
+        if remaining <= 0:
+            raise TurnShed("openai")
+        return min(self._timeout, remaining)
+
+    def _hedge_delay(self, kind: str) -> float | None:
+        """Seconds before a duplicate is worth sending, or None when this call must not hedge."""
+        if self._hedge_percentile <= 0:
+            return None
+        with self._lock:
+            self._hedge_credit = min(5.0, self._hedge_credit + self._hedge_ratio)
+            if self._hedge_credit < 1:
+                return None
+            window = self._latency.setdefault(kind, _LatencyWindow())
+            delay = window.percentile(self._hedge_percentile, self._hedge_min_samples)
+        return None if delay is None else max(delay, self._hedge_min_delay)
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self._hedge_credit < 1:
+                return False
+            self._hedge_credit -= 1
+            self.hedged += 1
+        return True
+
+    def _hedge_won(self, kind: str, hedge_won: bool) -> None:
+        HEDGES.inc(kind, "hedge" if hedge_won else "primary")
+        if hedge_won:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def _admit(self, model: str) -> tuple[CircuitBreaker, bool]:
+        """The model's breaker and whether this call may use the primary model."""
+        with self._lock:
+            self.calls += 1
+            breaker = self._breakers.get(model)
+            if breaker is None:
+                breaker = self._breakers[model] = CircuitBreaker(*self._breaker_config)
+            return breaker, breaker.allow()
+
+    def _record(self, kind: str, breaker: CircuitBreaker, ok: bool, seconds: float) -> None:
+        with self._lock:
+            if ok:
+                self._latency.setdefault(kind, _LatencyWindow()).add(seconds)
+            breaker.record(ok and seconds < self._slow_after)
+
+    def _fallback(self, request: dict, model: str, reason: str) -> dict:
+        with self._lock:
+            self.fallbacks += 1
+        FALLBACKS.inc(model, reason)
+        request = dict(request)
+        if self._fallback_model:
+            request["model"] = self._fallback_model
+        if self._fallback_effort:
+            request["reasoning_effort"] = self._fallback_effort
+        elif self._fallback_effort == "":
+            # Fallback model without reasoning support
+            request.pop("reasoning_effort", None)
+            request.pop("verbosity", None)
+        return request
+
+    ## Sync client (thread pool)
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._hedge_workers, thread_name_prefix="llm-hedge")
+            return self._pool
+
+    def _call(self, request: dict, timeout: float):
+        return self._client().with_options(timeout=timeout).chat.completions.create(**request)
+
+    def _pooled_call(self, request: dict, expires: float):
+        """``_call`` on a hedge-pool worker; time spent waiting for the worker comes off the timeout."""
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("LLM call timed out waiting for a hedge-pool worker")
+        return self._call(request, remaining)
+
+    def _hedged(self, kind: str, request: dict, timeout: float):
+        delay = self._hedge_delay(kind)
+        if delay is None or delay >= timeout:
+            return self._call(request, timeout)
+        # The caller must be free to take whichever request answers first, so
+        # the primary also runs on the pool (sized for two calls per caller)
+        pool = self._executor()
+        expires = time.monotonic() + timeout
+        primary = pool.submit(self._pooled_call, request, expires)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result()
+        # The losing sync request cannot be cancelled; it ends at its timeout at the latest
+        hedge = pool.submit(self._pooled_call, request, expires)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    self._hedge_won(kind, fut is hedge)
+                    return fut.result()
+                error = fut.exception()
+        raise error
+
+    def create(self, kind: str, request: dict):
+        timeout = self._request_timeout()
+        model = request["model"]
+        breaker, primary = self._admit(model)
+        if not primary:
+            return self._call(self._fallback(request, model, "open"), timeout)
+        started = time.monotonic()
+        try:
+            response = self._hedged(kind, request, timeout)
+        except Exception as e:
+            self._record(kind, breaker, False, time.monotonic() - started)
+            timeout = self._request_timeout()
+            logger.warning("LLM %s call on %s failed (%s); retrying on the fallback.", kind, model, e)
+            return self._call(self._fallback(request, model, "error"), timeout)
+        self._record(kind, breaker, True, time.monotonic() - started)
+        return response
+
+    ## Async client (IO_MODE=async)
+    async def _acall(self, request: dict, timeout: float):
+        return await self._async_client().with_options(timeout=timeout).chat.completions.create(**request)
+
+    async def _ahedged(self, kind: str, request: dict, timeout: float):
+        delay = self._hedge_delay(kind)
+        if delay is None or delay >= timeout:
+            return await self._acall(request, timeout)
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self._acall(request, timeout))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return await primary
+        hedge = asyncio.ensure_future(self._acall(request, max(0.1, timeout - (time.monotonic() - started))))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    if fut.exception() is None:
+                        self._hedge_won(kind, fut is hedge)
+                        return fut.result()
+                    error = fut.exception()
+            raise error
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    async def acreate(self, kind: str, request: dict):
+        timeout = self._request_timeout()
+        model = request["model"]
+        breaker, primary = self._admit(model)
+        if not primary:
+            return await self._acall(self._fallback(request, model, "open"), timeout)
+        started = time.monotonic()
+        try:
+            response = await self._ahedged(kind, request, timeout)
+        except asyncio.CancelledError:
+            with self._lock:
+                if breaker.state == "half_open":
+                    breaker.record(False)  # a cancelled probe must not keep the breaker half-open
+            raise
+        except Exception as e:
+            self._record(kind, breaker, False, time.monotonic() - started)
+            timeout = self._request_timeout()
+            logger.warning("LLM %s call on %s failed (%s); retrying on the fallback.", kind, model, e)
+            return await self._acall(self._fallback(request, model, "error"), timeout)
+        self._record(kind, breaker, True, time.monotonic() - started)
+        return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "fallbacks": self.fallbacks,
+                "hedge_delay_s": {
+                    kind: window.percentile(self._hedge_percentile, self._hedge_min_samples)
+                    for kind, window in self._latency.items()
+                } if self._hedge_percentile > 0 else {},
+                "breakers": {model: {"state": b.state, "opened": b.opened} for model, b in self._breakers.items()},
+            }
@@ -0,0 +1,224 @@
+"""In-process replica of the product and service search indexes.
+
+A snapshot is a directory holding, per catalog, a float32/float16 ``.npy``
+matrix of ``text_vector`` rows (loaded memory-mapped, so uvicorn workers share
+the pages) and a JSON file with the selected document fields. Queries fuse
+cosine similarity with a BM25 keyword score via reciprocal rank fusion, the
+same fusion Azure AI Search uses for hybrid queries.
+
+Build a snapshot offline with::
+
+    python -m utils.local_index build --out search_snapshot [--dtype float16]
+
+and keep it fresh from one place (cron, or ``--every SECONDS`` in a single
+sidecar process). Workers never rebuild: each one only reloads the snapshot
+when its manifest changes, so the Azure indexes are scanned once per refresh,
+not once per worker.
+"""
+
+## Import Library
+import os
+import re
+import json
+import math
+import time
+import logging
+import argparse
+import threading
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CATALOGS = ("product", "service")
+MANIFEST = "manifest.json"
+RRF_K = 60
+VECTOR_K = 10  # matches k_nearest_neighbors of the Azure vector query
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_THAI_RUN = re.compile(r"[฀-๿]+")
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Latin words plus character bigrams of Thai runs (Thai has no spaces)."""
+    text = text.lower()
+    tokens = _WORD.findall(text)
+    for run in _THAI_RUN.findall(text):
+        tokens.extend(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+    return tokens
+
+
+class _Catalog:
+    """Vectors, documents and BM25 postings for one index."""
+
+    def __init__(self, vectors: np.ndarray, docs: list[dict]):
+        self.vectors = vectors
+        self.docs = docs
+        term_freqs = [Counter(tokenize(" ".join(str(v) for v in d.values() if v))) for d in docs]
+        doc_lens = np.array([sum(tf.values()) for tf in term_freqs], dtype=np.float32)
+        avg_len = float(doc_lens.mean()) if len(docs) else 1.0
+        self.norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lens / (avg_len or 1.0))
+        postings: dict[str, list[tuple[int, int]]] = {}
+        for i, tf in enumerate(term_freqs):
+            for term, count in tf.items():
+                postings.setdefault(term, []).append((i, count))
+        n = len(docs)
+        self.postings = {
+            t: (math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)),
+                np.array([i for i, _ in p]), np.array([c for _, c in p], dtype=np.float32))
+            for t, p in postings.items()
+        }
+
+    def bm25(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            idf, idx, tf = posting
+            scores[idx] += idf * tf * (BM25_K1 + 1) / (tf + self.norm[idx])
+        return scores
+
+    def search(self, query: str, vector: list[float], top: int, skip: int = 0) -> list[dict]:
+        if not self.docs:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1.0
+        cosine = self.vectors @ q
+        fused: dict[int, float] = {}
+        for rank, i in enumerate(np.argsort(-cosine)[:VECTOR_K]):
+            fused[int(i)] = fused.get(int(i), 0.0) + 1.0 / (RRF_K + rank + 1)
+        keyword = self.bm25(query)
+        for rank, i in enumerate(np.argsort(-keyword)):
+            if keyword[i] <= 0:
+                break
+            fused[int(i)] = fused.get(int(i), 0.0) + 1.0 / (RRF_K + rank + 1)
+        ranked = sorted(fused, key=fused.get, reverse=True)[skip:skip + top]
+        return [dict(self.docs[i], **{"@search.score": fused[i]}) for i in ranked]
+
+
+class LocalIndex:
+    """Loads a snapshot directory and reloads it when its manifest changes."""
+
+    def __init__(self, path: str, reload_interval: float = 30.0):
+        self._path = path
+        self._reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._catalogs: dict[str, _Catalog] = {}
+        self._mtime = 0.0
+        self._checked = 0.0
+        self.version = ""
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if self._catalogs and now - self._checked < self._reload_interval:
+            return
+        with self._lock:
+            self._checked = now
+            manifest_path = os.path.join(self._path, MANIFEST)
+            try:
+                mtime = os.path.getmtime(manifest_path)
+            except OSError:
+                return
+            if mtime == self._mtime:
+                return
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            catalogs = {}
+            for name in CATALOGS:
+                vectors = np.load(os.path.join(self._path, f"{name}.vectors.npy"), mmap_mode="r")
+                with open(os.path.join(self._path, f"{name}.docs.json"), encoding="utf-8") as f:
+                    docs = json.load(f)
+                if len(vectors) != len(docs):
+                    logger.warning("Local search snapshot %s is mid-write; retrying later", name)
+                    return
+                catalogs[name] = _Catalog(vectors, docs)
+            self._catalogs, self._mtime = catalogs, mtime
+            self.version = manifest.get("version", str(mtime))
+            logger.info("Loaded local search snapshot %s (%s)", self.version,
+                        {k: len(c.docs) for k, c in catalogs.items()})
+
+    def available(self) -> bool:
+        self._maybe_reload()
+        return bool(self._catalogs)
+
+    def search(self, query: str, vector: list[float], top: int, skip: int = 0,
+               service: bool = False) -> list[dict]:
+        self._maybe_reload()
+        return self._catalogs["service" if service else "product"].search(query, vector, top, skip)
+
+
+def _write_atomic(path: str, write) -> None:
+    tmp = f"{path}.tmp-{os.getpid()}"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def _save_npy(path: str, matrix: np.ndarray) -> None:
+    with open(path, "wb") as f:
+        np.save(f, matrix)
+
+
+def _save_json(path: str, obj) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+
+
+def build_snapshot(out_dir: str, sources: dict[str, tuple], dtype: str = "float32") -> str:
+    """Pull every document (fields + ``text_vector``) and write a snapshot.
+
+    ``sources`` maps catalog name to ``(SearchClient, fields)``. The manifest
+    is written last so readers never see a half-written snapshot.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for name, (search_client, fields) in sources.items():
+        docs, rows = [], []
+        for hit in search_client.search(search_text="*", select=fields + ["text_vector"]):
+            vec = np.asarray(hit["text_vector"], dtype=np.float32)
+            rows.append(vec / (np.linalg.norm(vec) or 1.0))
+            docs.append({f: hit.get(f) for f in fields})
+        matrix = np.ascontiguousarray(np.vstack(rows) if rows else np.zeros((0, 1)), dtype=dtype)
+        _write_atomic(os.path.join(out_dir, f"{name}.vectors.npy"), lambda p: _save_npy(p, matrix))
+        _write_atomic(os.path.join(out_dir, f"{name}.docs.json"), lambda p: _save_json(p, docs))
+        counts[name] = len(docs)
+    version = time.strftime("%Y%m%dT%H%M%S")
+    _write_atomic(os.path.join(out_dir, MANIFEST),
+                  lambda p: _save_json(p, {"version": version, "dtype": dtype, "counts": counts}))
+    return version
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local search snapshot tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    build = sub.add_parser("build", help="snapshot the Azure product and service indexes")
+    build.add_argument("--out", default=os.getenv("SEARCH_SNAPSHOT_PATH") or "search_snapshot")
+    build.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    build.add_argument("--every", type=float, default=0,
+                       help="keep running and rebuild every N seconds (one process per deployment)")
+    args = parser.parse_args()
+
+    from utils.clients import get_search_client, get_service_search_client
+    from utils.rag_func import PRODUCT_FIELDS, SERVICE_FIELDS
+    sources = {
+        "product": (get_search_client(), PRODUCT_FIELDS),
+        "service": (get_service_search_client(), SERVICE_FIELDS),
+    }
+    while True:
+        try:
+            version = build_snapshot(args.out, sources, args.dtype)
+            print(f"Wrote snapshot {version} to {args.out}")
+        except Exception as exc:
+            if not args.every:
+                raise
+            logger.warning("Local search snapshot refresh failed: %s", exc)
+        if not args.every:
+            return
+        time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    main()
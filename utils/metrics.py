@@ -0,0 +1,216 @@
+"""Per-turn stage timing and Prometheus text exposition for ``/metrics``.
+
+A turn is opened with ``start_turn`` (stored in a contextvar, so spans on the
+thread pool see it as long as the executor call copies the context) and
+closed with ``finish_turn(path_decision)``. Each ``span(stage)`` inside it is
+buffered until the path is known, then observed into
+``linebot_stage_seconds{stage, path}`` and logged as one breakdown line per
+turn tagged with a hash of the user id. Spans outside a turn (background
+flushes, compaction) are observed straight away with ``path=""``.
+
+With ``OTEL_EXPORTER_OTLP_ENDPOINT`` set and the OpenTelemetry SDK plus OTLP
+exporter installed, every finished turn is also exported as a trace: one
+``turn`` span with a child per stage.
+"""
+
+## Import Library
+import os
+import time
+import hashlib
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._lock = threading.Lock()
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                for bound, c in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (bound,))} {c}")
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), labels + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in sorted(self._values.items())]
+        return lines
+
+
+class Gauge:
+    """Read at scrape time from a callback (queue depths, in-flight counts)."""
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name, self.help, self._read = name, help, read
+
+    def render(self) -> list[str]:
+        try:
+            value = self._read()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+_REGISTRY: list = []
+
+def register(metric):
+    _REGISTRY.append(metric)
+    return metric
+
+def gauge(name: str, help: str, read: Callable[[], float]) -> Gauge:
+    return register(Gauge(name, help, read))
+
+def render() -> str:
+    lines = []
+    for metric in _REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = register(Histogram(
+    "linebot_stage_seconds", "Duration of one pipeline stage", ("stage", "path")))
+TURNS = register(Counter("linebot_turns_total", "Finished turns by path decision", ("path",)))
+UPSTREAM_ERRORS = register(Counter(
+    "linebot_upstream_errors_total", "Failed calls to an upstream service", ("upstream",)))
+
+
+## Turn tracing
+class Turn:
+    __slots__ = ("user_hash", "start", "start_ns", "spans", "lock", "done")
+
+    def __init__(self, user_id: str):
+        self.user_hash = hashlib.sha256(user_id.encode()).hexdigest()[:12]
+        self.start = time.perf_counter()
+        self.start_ns = time.time_ns()
+        self.spans: list[tuple[str, int, float]] = []  # (stage, wall start ns, seconds)
+        self.lock = threading.Lock()
+        self.done = False
+
+
+_current: contextvars.ContextVar[Turn | None] = contextvars.ContextVar("linebot_turn", default=None)
+
+
+def start_turn(user_id: str) -> Turn:
+    turn = Turn(user_id)
+    _current.set(turn)
+    return turn
+
+def record(stage: str, seconds: float, start_ns: int | None = None) -> None:
+    """Add a stage with a known duration (e.g. the debounce sleep before the turn began)."""
+    turn = _current.get()
+    # Tasks spawned from a turn inherit it; once it has finished they report on their own
+    if turn is not None:
+        with turn.lock:
+            if not turn.done:
+                turn.spans.append((stage, start_ns if start_ns is not None else time.time_ns() - int(seconds * 1e9), seconds))
+                return
+    STAGE_SECONDS.observe(seconds, stage, "")
+
+def upstream_error(upstream: str) -> None:
+    UPSTREAM_ERRORS.inc(upstream)
+
+@contextmanager
+def span(stage: str, upstream: str | None = None):
+    """Time a block as ``stage``; an exception escaping it counts against ``upstream``."""
+    start_ns, start = time.time_ns(), time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if upstream and isinstance(e, Exception):
+            upstream_error(upstream)
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, start_ns)
+
+def finish_turn(turn: Turn, path: str | None) -> None:
+    path = path or "NONE"
+    total = time.perf_counter() - turn.start
+    with turn.lock:
+        turn.done = True
+        spans = list(turn.spans)
+    for stage, _, seconds in spans:
+        STAGE_SECONDS.observe(seconds, stage, path)
+    STAGE_SECONDS.observe(total, "turn_total", path)
+    TURNS.inc(path)
+    logger.info("turn user=%s path=%s total=%.3fs %s", turn.user_hash, path, total,
+                " ".join(f"{s}={d:.3f}" for s, _, d in spans))
+    if _tracer is not None:
+        _export(turn, path, spans)
+    _current.set(None)
+
+
+## Optional OpenTelemetry export
+def _init_tracer():
+    if not os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return None
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but the OpenTelemetry SDK/exporter is not installed.")
+        return None
+    provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME") or "line-rag-bot"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    return provider.get_tracer(__name__)
+
+def _export(turn: Turn, path: str, spans) -> None:
+    from opentelemetry import trace
+    attrs = {"user.hash": turn.user_hash, "path_decision": path}
+    root = _tracer.start_span("turn", start_time=turn.start_ns, attributes=attrs)
+    ctx = trace.set_span_in_context(root)
+    for stage, start_ns, seconds in spans:
+        child = _tracer.start_span(stage, context=ctx, start_time=start_ns, attributes=attrs)
+        child.end(end_time=start_ns + int(seconds * 1e9))
+    root.end()
+
+_tracer = _init_tracer()
@@ -1,21 +1,33 @@
 ## Import Library
 import os
 import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
-from azure.search.documents.models import VectorizedQuery
 from datetime import datetime
 from zoneinfo import ZoneInfo
 # import hashlib
-from google.genai import types
+# from google.genai import types  # only needed by the commented-out Gemini settings below
 
 ## Import Utils
 from utils.clients import get_search_client, get_service_search_client,get_openai #,get_gemini
+from utils.clients import get_async_search_client, get_async_service_search_client, get_async_openai
+from utils.embed_cache import EmbeddingCache, EmbeddingBatcher, normalize_query
+from utils.semantic_cache import SemanticAnswerCache
+from utils.intent_model import IntentClassifier
+from utils.context_packer import ContextPacker, approx_tokens
+from utils.llm_guard import LLMGuard
+from utils.scheduler import TurnShed
+from utils import metrics
+
+logger = logging.getLogger(__name__)
 
 ## Setup Clients
-client = get_openai()
+# Created on first use (utils.clients); api_webhook prewarms them at startup
 # client_gemini = get_gemini()
-search_client = get_search_client()
-service_search_client = get_service_search_client()
 
 load_dotenv()
 
@@ -33,6 +45,30 @@ summarize_context_threshold = json.loads(os.getenv("SUMMARIZE_CONTEXT_PARAMS"))
 decide_search_path_threshold = json.loads(os.getenv("DECIDE_PATH_PARAMS"))
 generate_answer_threshold = json.loads(os.getenv("GEN_ANS_PARAMS"))
 
+## Config LLM resilience
+# Chat completions are hedged after the LLM_HEDGE_PERCENTILE latency (0 = off,
+# at most LLM_HEDGE_RATIO of calls), bounded by the turn's reply deadline, and
+# moved to OPENAI_FALLBACK_MODEL / OPENAI_FALLBACK_REASONING_EFFORT ("" drops
+# reasoning params) while a model's circuit breaker is open. Sync hedging runs
+# on its own pool of LLM_HEDGE_WORKERS threads (default 2 x MAX_WORKERS: a
+# primary and a hedge for every pipeline thread).
+llm_guard = LLMGuard(
+    get_openai,
+    get_async_openai,
+    timeout=float(os.getenv("LLM_TIMEOUT_SEC") or "30"),
+    reserve=float(os.getenv("LLM_DEADLINE_RESERVE_SEC") or "1.5"),
+    hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE") or "0.95"),
+    hedge_min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY_MS") or "300") / 1000,
+    hedge_ratio=float(os.getenv("LLM_HEDGE_RATIO") or "0.1"),
+    hedge_workers=int(os.getenv("LLM_HEDGE_WORKERS") or 2 * int(os.getenv("MAX_WORKERS") or "16")),
+    fallback_model=os.getenv("OPENAI_FALLBACK_MODEL") or None,
+    fallback_effort=os.getenv("OPENAI_FALLBACK_REASONING_EFFORT", "minimal"),
+    error_rate=float(os.getenv("LLM_BREAKER_ERROR_RATE") or "0.5"),
+    slow_after=float(os.getenv("LLM_BREAKER_SLOW_SEC") or "15"),
+    window=int(os.getenv("LLM_BREAKER_WINDOW") or "20"),
+    cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN_SEC") or "30"),
+)
+
 
 # ## Config Safety Answer
 # DEFAULT_SAFETY_SETTINGS = {
@@ -180,100 +216,355 @@ summarize_instruc = (
 # )
 
 ## Embedding
-def embed_text(text: str):
-
-    normalized = text.replace("\n", " ").strip()
-    normalized = " ".join(normalized.split()).lower()
-
-
-    response = client.embeddings.create(
+def _fetch_embeddings(normalized: list[str]):
+    response = get_openai().embeddings.create(
         input=normalized,
         model= embedding_model
     )
-    embedding = response.data[0].embedding
-    return embedding
+    # The API echoes each input's position; keep the caller's order.
+    return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+# Requests from concurrent pipelines (across users) are grouped into list-input
+# embedding calls; EMBED_BATCH_MAX_SIZE=1 sends each text on its own.
+embedding_batcher = EmbeddingBatcher(
+    _fetch_embeddings,
+    max_size=int(os.getenv("EMBED_BATCH_MAX_SIZE") or "64"),
+    max_wait=float(os.getenv("EMBED_BATCH_MAX_WAIT_MS") or "5") / 1000,
+    concurrency=int(os.getenv("EMBED_BATCH_CONCURRENCY") or "4"),
+)
+
+# Product/service/MORE searches run in parallel for the same query; the cache
+# collapses them into a single embedding call and keeps recent queries warm.
+embedding_cache = EmbeddingCache(
+    embedding_batcher.submit,
+    maxsize=int(os.getenv("EMBED_CACHE_SIZE") or "2048"),
+    ttl=float(os.getenv("EMBED_CACHE_TTL") or "86400"),
+    disk_path=os.getenv("EMBED_CACHE_PATH") or None,
+    namespace=embedding_model or "",
+)
 
-## Result
-def print_results(results):
-    answer = []
-    for result in results:
-        answer+=[f"Product Segment: {result['Product_Segment']}"]
-        answer+=[f"Product Name: {result['Product_Name']}"]
-        answer+=[f"Unique Point: {result['Unique_Pros']}"] 
-        answer+=[f"Product Benefit: {result['Benefit']}"]
-        answer+=[f"Product Condition: {result['Condition']}"]
-        answer+=[f"Product Description: {result['Product_Description']}"]
-        answer+=[f"URL: {result['Product_URL']}\n"]
-    return answer
+def embed_text(text: str):
+    with metrics.span("embed_text", "openai"):
+        return embedding_cache.get(text)
+
+async def aembed_text(text: str):
+    with metrics.span("embed_text", "openai"):
+        return await embedding_cache.aget(text)
 
 ## Result
-def print_results_service(results):
-    answer = []
-    for result in results:
-        answer+=[f"Service Segment: {result['Service_Segment']}"]
-        answer+=[f"Service Name: {result['Service_Name']}"]
-        answer+=[f"Service Detail: {result['Service_Detail']}"]
-        answer+=[f"URL: {result['Service_URL']}\n"]
-    return answer
-        
-## Searching
-def get_search_results(query: str, top_k: int, skip_k:int=0, service: bool = False):
+# Hits are packed into the answer prompt within CONTEXT_TOKEN_BUDGET
+# (estimated tokens; 0 = no limit), most query-relevant fields first
+context_packer = ContextPacker(
+    budget=int(os.getenv("CONTEXT_TOKEN_BUDGET") or "1500"),
+    cache_size=int(os.getenv("CONTEXT_PACK_CACHE_SIZE") or "4096"),
+)
 
-    vect = embed_text(query)
+## Searching
+PRODUCT_FIELDS = ["Product_Segment","Product_Name","Unique_Pros","Benefit","Condition","Product_Description","Product_URL"]
+SERVICE_FIELDS = ["Service_Segment","Service_Name","Service_Detail","Service_URL"]
+PRODUCT_TOP = 7
+SERVICE_TOP = 3
+
+# Cheap hints that the classifier will pick INSURANCE_SERVICE; used to decide
+# whether the service index is worth querying before the label arrives.
+SERVICE_HINTS = (
+    "ติดต่อ", "เอกสาร", "โปรโมชั่น", "ระยะเวลา", "ประกันกลุ่ม", "ตรวจสอบ", "ดาวน์โหลด",
+    "แบบฟอร์ม", "โรงพยาบาล", "สาขา", "บริการ", "สินไหม", "เคลม", "กรมธรรม์", "ร้องเรียน",
+    "อุบัติเหตุ", "ตัวแทน", "นายหน้า", "claim", "policy", "document", "form", "hospital",
+    "branch", "contact", "complain", "agent",
+)
+
+class SearchResultCache:
+    """TTL cache of raw search hits keyed by (index, normalized query, top, skip)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, tuple[float, list[dict]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> list[dict] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, docs: list[dict]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, docs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+search_cache = SearchResultCache(
+    maxsize=int(os.getenv("SEARCH_CACHE_SIZE") or "1024"),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL") or "300"),
+)
+
+# SEARCH_BACKEND=local answers from an in-process snapshot of both indexes
+# (see utils/local_index.py); Azure remains the fallback when none is loaded.
+# Workers only reload the shared snapshot; it is rebuilt outside them with
+# `python -m utils.local_index build` (cron, or --every in one sidecar).
+search_backend = (os.getenv("SEARCH_BACKEND") or "azure").lower()
+local_index = None
+if search_backend == "local":
+    from utils.local_index import LocalIndex
+    snapshot_path = os.getenv("SEARCH_SNAPSHOT_PATH") or "search_snapshot"
+    local_index = LocalIndex(snapshot_path, float(os.getenv("SEARCH_SNAPSHOT_RELOAD_SEC") or "30"))
+    if os.getenv("SEARCH_SNAPSHOT_REFRESH_SEC"):
+        logger.warning("SEARCH_SNAPSHOT_REFRESH_SEC is ignored: workers no longer rebuild the snapshot; "
+                       "run `python -m utils.local_index build --every SECONDS` in one process instead.")
+
+def _search_request(query, vect, top_k, skip_k, service):
+    from azure.search.documents.models import VectorizedQuery
     vq = VectorizedQuery(
         vector=vect, 
         k_nearest_neighbors=10, 
         fields="text_vector"
     )
-    client_to_use = service_search_client if service else search_client
-    results = client_to_use.search(
+    return dict(
         search_text=query,
         vector_queries=[vq],
-        select=(
-            ["Service_Segment","Service_Name","Service_Detail","Service_URL"] if service
-            else ["Product_Segment","Product_Name","Unique_Pros","Benefit","Condition","Product_Description","Product_URL"]
-        ),
+        select=SERVICE_FIELDS if service else PRODUCT_FIELDS,
         top=top_k,
         skip = skip_k
     )
-    text = "=================\n".join(
-        print_results_service(results) if service
-        else print_results(results)
-    )
-    return text
 
-## Summarize Context
-def summarize_text(text, max_chars, user_id):
+## Catalog Version
+class CatalogVersion:
+    """Version of the indexed catalog, part of the search and semantic cache keys.
+
+    With the local replica it is the loaded snapshot's version. For Azure,
+    ``probe`` (document counts, plus the newest CATALOG_VERSION_FIELD value
+    when set) runs in a background thread at most every ``interval`` seconds,
+    so a re-indexed catalog changes the version without slowing a turn.
+    ``bump`` (POST /admin/invalidate-caches) changes it at once, for this
+    worker only.
+    """
+
+    def __init__(self, probe, interval: float, local=None):
+        self._probe = probe
+        self._interval = interval
+        self._local = local
+        self._lock = threading.Lock()
+        self._azure = ""
+        self._checked = float("-inf")
+        self._refreshing = False
+        self._generation = 0
+        self.changes = 0
+
+    def refresh(self) -> str:
+        """Probe Azure now (startup prewarm, background poll)."""
+        try:
+            version = self._probe()
+        except Exception:
+            with self._lock:
+                self._checked = time.monotonic()
+                self._refreshing = False
+            raise
+        with self._lock:
+            if version != self._azure:
+                if self._azure:
+                    self.changes += 1
+                    logger.info("Search catalog changed (%s -> %s); cached answers dropped.", self._azure, version)
+                self._azure = version
+            self._checked = time.monotonic()
+            self._refreshing = False
+            return self._azure
+
+    def _azure_version(self) -> str:
+        if self._interval <= 0:
+            return self._azure
+        with self._lock:
+            if self._refreshing or time.monotonic() - self._checked < self._interval:
+                return self._azure
+            self._refreshing = True
+        threading.Thread(target=self._poll, name="catalog-version", daemon=True).start()
+        return self._azure
+
+    def _poll(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning("Catalog version check failed: %s", e)
+
+    def get(self) -> str:
+        base = self._local.version if self._local is not None else self._azure_version()
+        return f"{base}+{self._generation}" if self._generation else base
+
+    def bump(self) -> str:
+        with self._lock:
+            self._generation += 1
+            self.changes += 1
+        return self.get()
+
+    def stats(self) -> dict:
+        return {"version": self.get(), "changes": self.changes}
+
+def _azure_catalog_probe() -> str:
+    parts = []
+    for search in (get_search_client(), get_service_search_client()):
+        part = str(search.get_document_count())
+        if catalog_version_field:
+            newest = list(search.search(search_text="*", select=[catalog_version_field],
+                                        order_by=[f"{catalog_version_field} desc"], top=1))
+            part += f":{newest[0].get(catalog_version_field) if newest else ''}"
+        parts.append(part)
+    return "/".join(parts)
+
+# CATALOG_VERSION_FIELD: optional sortable last-modified field on both indexes
+catalog_version_field = os.getenv("CATALOG_VERSION_FIELD") or None
+catalog = CatalogVersion(
+    _azure_catalog_probe,
+    float(os.getenv("CATALOG_VERSION_POLL_SEC") or "300"),
+    local_index,
+)
+
+def catalog_version() -> str:
+    return catalog.get()
+
+def _search_key(query, top_k, skip_k, service):
+    return ("service" if service else "product", normalize_query(query), top_k, skip_k, catalog_version())
+
+def search_documents(query: str, top_k: int, skip_k: int = 0, service: bool = False) -> list[dict]:
+    if local_index is not None and local_index.available():
+        return local_index.search(query, embed_text(query), top_k, skip_k, service)
+
+    key = _search_key(query, top_k, skip_k, service)
+    docs = search_cache.get(key)
+    if docs is not None:
+        return docs
+
+    client_to_use = get_service_search_client() if service else get_search_client()
+    vect = embed_text(query)
+    with metrics.span("azure_search", "azure_search"):
+        docs = [dict(r) for r in client_to_use.search(**_search_request(query, vect, top_k, skip_k, service))]
+    search_cache.put(key, docs)
+    return docs
+
+async def asearch_documents(query: str, top_k: int, skip_k: int = 0, service: bool = False) -> list[dict]:
+    if local_index is not None and local_index.available():
+        return local_index.search(query, await aembed_text(query), top_k, skip_k, service)
+
+    key = _search_key(query, top_k, skip_k, service)
+    docs = search_cache.get(key)
+    if docs is not None:
+        return docs
+
+    client_to_use = get_async_service_search_client() if service else get_async_search_client()
+    vect = await aembed_text(query)
+    with metrics.span("azure_search", "azure_search"):
+        results = await client_to_use.search(**_search_request(query, vect, top_k, skip_k, service))
+        docs = [dict(r) async for r in results]
+    search_cache.put(key, docs)
+    return docs
+
+def render_results(docs: list[dict], service: bool = False, query: str = "") -> str:
+    return context_packer.pack(docs, service, query)
 
-    if len(text) <= max_chars:
-        return text
-    
-    system_prompt = summarize_instruc
-    
-    user_content_for_summarizer = f"Raw Conversation Log:\n{text}"
-    response = client.chat.completions.create(
+def get_search_results(query: str, top_k: int, skip_k:int=0, service: bool = False):
+    return render_results(search_documents(query, top_k, skip_k, service), service, query)
+
+async def aget_search_results(query: str, top_k: int, skip_k:int=0, service: bool = False):
+    return render_results(await asearch_documents(query, top_k, skip_k, service), service, query)
+
+def likely_service(query: str, latest_decision: str | None = None) -> bool:
+    lowered = query.lower()
+    return latest_decision == "INSURANCE_SERVICE" or any(h in lowered for h in SERVICE_HINTS)
+
+class RetrievalPlan:
+    """Retrieval for one turn, started before the path decision is known.
+
+    ``search`` is an async ``(query, top, skip, service) -> docs`` callable:
+    ``asearch_documents`` or ``search_documents`` wrapped onto the thread pool.
+
+    One product query for the first two pages serves both INSURANCE_PRODUCT
+    (first page) and MORE (second page); the service index is only queried up
+    front when ``likely_service`` says so. Work the decision does not need is
+    cancelled.
+    """
+
+    def __init__(self, query: str, search, want_service: bool):
+        self._query = query
+        self._search = search
+        self._product = asyncio.ensure_future(search(query, PRODUCT_TOP * 2, 0, False))
+        self._service = (
+            asyncio.ensure_future(search(query, SERVICE_TOP, 0, True))
+            if want_service else None
+        )
+
+    def cancel(self) -> None:
+        for fut in (self._product, self._service):
+            if fut is not None and not fut.done():
+                fut.cancel()
+
+    async def context_for(self, path_decision: str, release: bool = True) -> str:
+        """Context for the decided path; ``release=False`` (speculation) keeps the other searches alive.
+
+        A speculative caller waits on the shared searches through a shield, so
+        cancelling it leaves them intact for the decided path.
+        """
+        shared = (lambda fut: fut) if release else asyncio.shield
+        try:
+            if path_decision == "INSURANCE_SERVICE":
+                if release:
+                    self._product.cancel()
+                docs = await (shared(self._service) if self._service else self._search(self._query, SERVICE_TOP, 0, True))
+                return render_results(docs, True, self._query)
+            if path_decision == "INSURANCE_PRODUCT":
+                return render_results((await shared(self._product))[:PRODUCT_TOP], False, self._query)
+            if path_decision == "MORE":
+                return render_results((await shared(self._product))[PRODUCT_TOP:PRODUCT_TOP * 2], False, self._query)
+            return ""
+        finally:
+            if release:
+                self.cancel()
+
+## Summarize Context
+def _summarize_text_request(text):
+    return dict(
         model=summary_model,
         messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_content_for_summarizer}
+            {"role": "system", "content": summarize_instruc},
+            {"role": "user", "content": f"Raw Conversation Log:\n{text}"}
         ],
         reasoning_effort = summarize_text_threshold['reasoning_effort'],
         verbosity = summarize_text_threshold['verbosity'],
         # temperature=0.3,
         # max_tokens=1000
-
     )
-    summary = response.choices[0].message.content.strip()
-    timestamp = datetime.now(ZoneInfo("Asia/Bangkok"))
-    from utils.chat_history_func import save_chat_history,del_chat_history,get_latest_decide
-    user_latest_decide = get_latest_decide(user_id)
-    del_chat_history(user_id)
-    save_chat_history(user_id, "assistant", summary, timestamp,user_latest_decide)
-    return summary
 
-def summarize_context(new_question,chat_history):
+def summarize_text(text, max_chars):
+
+    if len(text) <= max_chars:
+        return text
+
+    response = llm_guard.create("summarize_text", _summarize_text_request(text))
+    return response.choices[0].message.content.strip()
 
-    system_prompt = summarize_instruc
+async def asummarize_text(text, max_chars):
+
+    if len(text) <= max_chars:
+        return text
+
+    response = await llm_guard.acreate("summarize_text", _summarize_text_request(text))
+    return response.choices[0].message.content.strip()
+
+def _summarize_context_request(new_question,chat_history):
     text = f"""
     Chat History: {chat_history}
     Latest User Question: {new_question}
@@ -287,28 +578,46 @@ def summarize_context(new_question,chat_history):
     - Keep the summary concise but complete enough for follow-up vector-based retrieval.
     
     """.strip()
-    response = client.chat.completions.create(
+    return dict(
         model=summary_model,
         messages=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": summarize_instruc},
             {"role": "user", "content": text}
         ],
         reasoning_effort = summarize_context_threshold['reasoning_effort'],
         verbosity = summarize_context_threshold['verbosity'],
     )
-    summary = response.choices[0].message.content.strip()
-    # print(summary)
-    return summary
 
+def summarize_context(new_question,chat_history):
+    response = llm_guard.create("summarize_context", _summarize_context_request(new_question, chat_history))
+    return response.choices[0].message.content.strip()
+
+async def asummarize_context(new_question,chat_history):
+    response = await llm_guard.acreate("summarize_context", _summarize_context_request(new_question, chat_history))
+    return response.choices[0].message.content.strip()
 
-def decide_search_path(user_query, chat_history=None):
 
+## Decide Path
+# Local classifier answers confident cases without an LLM round trip
+intent_classifier = IntentClassifier(
+    os.getenv("INTENT_MODEL_PATH") or "decide_path_lr.joblib",
+    float(os.getenv("INTENT_MODEL_THRESHOLD") or "0.9"),
+)
+PATH_LABELS = ["INSURANCE_SERVICE","INSURANCE_PRODUCT","CONTINUE CONVERSATION","MORE","OFF-TOPIC"]
+
+def _local_decision(user_query, chat_history):
+    try:
+        return intent_classifier.predict(user_query, chat_history)
+    except Exception as e:
+        logger.warning("Intent model error: %s", e)
+        return None
+
+def _decide_request(user_query, chat_history):
     prompt_content = f"""
                 User Query: {user_query}
                 Conversation History: {chat_history if chat_history else 'None'}
                 """
-
-    response = client.chat.completions.create(
+    return dict(
         model=classify_model,  
         messages=[
             {"role": "system", "content": classify_instruc},
@@ -317,14 +626,36 @@ def decide_search_path(user_query, chat_history=None):
         reasoning_effort = decide_search_path_threshold['reasoning_effort'],
         verbosity = decide_search_path_threshold['verbosity'],
     )
+
+def _parse_decision(response):
     raw_response = response.choices[0].message.content.strip()
     path_decision = raw_response.strip().upper()
-    return path_decision if path_decision in ["INSURANCE_SERVICE","INSURANCE_PRODUCT","CONTINUE CONVERSATION","MORE","OFF-TOPIC"] else "OFF-TOPIC"
+    return path_decision if path_decision in PATH_LABELS else "OFF-TOPIC"
 
+def decide_search_path_with_source(user_query, chat_history=None):
+    """(path decision, "local" or "llm"); only LLM labels are used to retrain the local model."""
+    local_decision = _local_decision(user_query, chat_history)
+    if local_decision:
+        return local_decision, "local"
+    return _parse_decision(llm_guard.create("classify", _decide_request(user_query, chat_history))), "llm"
 
+async def adecide_search_path_with_source(user_query, chat_history=None):
+    local_decision = _local_decision(user_query, chat_history)
+    if local_decision:
+        return local_decision, "local"
+    return _parse_decision(await llm_guard.acreate("classify", _decide_request(user_query, chat_history))), "llm"
 
-def generate_answer(query, context, chat_history=None):
+def decide_search_path(user_query, chat_history=None):
+    return decide_search_path_with_source(user_query, chat_history)[0]
 
+async def adecide_search_path(user_query, chat_history=None):
+    return (await adecide_search_path_with_source(user_query, chat_history))[0]
+
+
+## Answer
+ANSWER_FALLBACK = "ฉันขออภัย ฉันไม่สามารถให้คำตอบได้ในขณะนี้ โปรดลองอีกครั้ง"
+
+def _answer_request(query, context, chat_history):
     prompt_parts = []
     if chat_history:
         prompt_parts.append(f"Conversation History:\n{chat_history}\n")
@@ -332,19 +663,95 @@ def generate_answer(query, context, chat_history=None):
     prompt_parts.append(f"User Question:\n{query}")
 
     full_prompt_for_chatgpt = "\n".join(prompt_parts)
+    return dict(
+        model=chat_model, 
+        messages=[
+            {"role": "system", "content": answer_instruc},
+            {"role": "user", "content": full_prompt_for_chatgpt}
+        ],
+        reasoning_effort = generate_answer_threshold['reasoning_effort'] ,
+        verbosity = generate_answer_threshold['verbosity'] ,
+    )
+
+def _answer_with_usage(response):
+    usage = getattr(response, "usage", None)
+    return response.choices[0].message.content.strip(), (usage.total_tokens if usage else 0)
+
+def estimate_tokens(query, context, chat_history=None):
+    """Rough prompt size for requests cancelled mid-flight."""
+    return sum(approx_tokens(p) for p in (answer_instruc, query, context, chat_history))
+
+def generate_answer_with_usage(query, context, chat_history=None):
+    """(answer, total tokens billed); the fallback answer reports 0 tokens."""
     try:
-        response = client.chat.completions.create(
-            model=chat_model, 
-            messages=[
-                {"role": "system", "content": answer_instruc},
-                {"role": "user", "content": full_prompt_for_chatgpt}
-            ],
-            reasoning_effort = generate_answer_threshold['reasoning_effort'] ,
-            verbosity = generate_answer_threshold['verbosity'] ,
-        )
-        return response.choices[0].message.content.strip()
+        return _answer_with_usage(llm_guard.create("answer", _answer_request(query, context, chat_history)))
+    except TurnShed:
+        raise
     except Exception as e:
-        print(f"Error Type: {type(e)}")
-        print(f"Error Message: {e}")
-        return "ฉันขออภัย ฉันไม่สามารถให้คำตอบได้ในขณะนี้ โปรดลองอีกครั้ง"
+        metrics.upstream_error("openai")
+        logger.error(f"Answer generation failed ({type(e).__name__}): {e}")
+        return ANSWER_FALLBACK, 0
+
+async def agenerate_answer_with_usage(query, context, chat_history=None):
+    try:
+        return _answer_with_usage(await llm_guard.acreate("answer", _answer_request(query, context, chat_history)))
+    except TurnShed:
+        raise
+    except Exception as e:
+        metrics.upstream_error("openai")
+        logger.error(f"Answer generation failed ({type(e).__name__}): {e}")
+        return ANSWER_FALLBACK, 0
+
+def generate_answer(query, context, chat_history=None):
+    return generate_answer_with_usage(query, context, chat_history)[0]
+
+async def agenerate_answer(query, context, chat_history=None):
+    return (await agenerate_answer_with_usage(query, context, chat_history))[0]
+
+
+## Prewarm (startup)
+# Open the connection pools and load the intent model before the first turn
+def prewarm_openai():
+    get_openai().with_options(timeout=5.0, max_retries=0).models.list()
+
+async def aprewarm_openai():
+    await get_async_openai().with_options(timeout=5.0, max_retries=0).models.list()
+
+def prewarm_search():
+    # The document counts also give the first catalog version
+    if local_index is None:
+        catalog.refresh()
+    else:
+        for search in (get_search_client(), get_service_search_client()):
+            search.get_document_count()
+
+async def aprewarm_search():
+    for search in (get_async_search_client(), get_async_service_search_client()):
+        await search.get_document_count()
+
+def prewarm_intent_model():
+    intent_classifier.warm()
+
+
+## Semantic Answer Cache
+# Reuses answers for reworded repeats of history-free questions; entries are
+# dropped whenever the catalog version changes (see CatalogVersion).
+semantic_cache = SemanticAnswerCache(
+    maxsize=int(os.getenv("SEMANTIC_CACHE_SIZE") or "1000"),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD") or "0.95"),
+    ttl=float(os.getenv("SEMANTIC_CACHE_TTL") or "3600"),
+)
+
+def get_cached_answer(query, path_decision):
+    return semantic_cache.lookup(embed_text(query), path_decision, catalog_version())
+
+async def aget_cached_answer(query, path_decision):
+    return semantic_cache.lookup(await aembed_text(query), path_decision, catalog_version())
+
+def cache_answer(query, path_decision, answer):
+    if answer and answer != ANSWER_FALLBACK:
+        semantic_cache.store(embed_text(query), path_decision, answer, catalog_version())
 
+async def acache_answer(query, path_decision, answer):
+    if answer and answer != ANSWER_FALLBACK:
+        semantic_cache.store(await aembed_text(query), path_decision, answer, catalog_version())
@@ -0,0 +1,259 @@
+"""Per-upstream admission control for the pipeline's outbound calls.
+
+Every call to an upstream (OpenAI, Azure Search, MongoDB, the LINE API) takes
+a slot from that upstream's ``UpstreamLimit``: a concurrency cap plus a token
+bucket (``rate`` calls/s, ``burst`` deep; ``rate`` 0 = no rate limit). Waiters
+are served by lane, then arrival order, so cheap turns (FAQ answers, CHAT
+RESET) overtake RAG turns and background work (compaction, speculation) goes
+last.
+
+The lane and the turn's reply deadline travel in contextvars (``lane()``,
+``set_deadline()``),
+like the turn trace in ``utils.metrics``. A waiter that would only get its
+slot after the deadline minus the upstream's usual call time and the LINE
+reply time raises ``TurnShed``, so the turn can answer with a canned reply
+while its reply token is still valid.
+
+Whole RAG turns are shed up front when the learned turn time exceeds the
+time left on the token. That estimate only drops as turns finish, so while
+shedding, one probe turn is let through every ``probe_interval`` seconds, and
+the estimate halves every ``half_life`` seconds without a finished turn.
+"""
+
+## Import Library
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+
+from utils import metrics
+
+HIGH, NORMAL, LOW = 0, 1, 2
+LANE_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+QUEUE_SECONDS = metrics.register(metrics.Histogram(
+    "linebot_upstream_queue_seconds", "Time a call waited for an upstream slot", ("upstream", "lane")))
+SHED = metrics.register(metrics.Counter(
+    "linebot_turns_shed_total", "Turns answered with a canned reply before their token expired", ("stage",)))
+
+
+class TurnShed(Exception):
+    """The turn cannot finish before its LINE reply token expires."""
+
+    def __init__(self, upstream: str):
+        super().__init__(f"reply deadline too close to wait for {upstream}")
+        self.upstream = upstream
+
+
+@dataclass
+class UpstreamLimit:
+    concurrency: int = 16
+    rate: float = 0.0
+    burst: int = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "UpstreamLimit":
+        limit = cls(**config)
+        if limit.rate > 0 and limit.burst <= 0:
+            limit.burst = max(1, int(limit.rate))
+        return limit
+
+
+_lane: contextvars.ContextVar[int] = contextvars.ContextVar("linebot_lane", default=NORMAL)
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("linebot_deadline", default=None)
+
+
+@contextmanager
+def lane(priority: int, deadline=...):
+    """Run the block (and tasks it creates) in ``priority``; optionally set or clear the reply deadline."""
+    lane_token = _lane.set(priority)
+    deadline_token = _deadline.set(deadline) if deadline is not ... else None
+    try:
+        yield
+    finally:
+        _lane.reset(lane_token)
+        if deadline_token is not None:
+            _deadline.reset(deadline_token)
+
+def set_deadline(deadline: float | None) -> None:
+    """Set the reply deadline for the rest of the current task (a turn consumer); None clears it."""
+    _deadline.set(deadline)
+
+def current_deadline() -> float | None:
+    return _deadline.get()
+
+
+class _Upstream:
+    def __init__(self, name: str, limit: UpstreamLimit):
+        self.name = name
+        self.limit = limit
+        self.in_use = 0
+        self.tokens = float(limit.burst)
+        self.refilled = time.monotonic()
+        self.waiters: list = []  # heap of (lane, seq, future)
+        self.timer: asyncio.TimerHandle | None = None
+        self.service_ewma = 0.0
+        self.granted = 0
+        self.shed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _refill(self, now: float) -> None:
+        if self.limit.rate > 0:
+            self.tokens = min(self.limit.burst, self.tokens + (now - self.refilled) * self.limit.rate)
+        self.refilled = now
+
+    def try_take(self) -> float:
+        """Take a slot if one is free; else the seconds until a token refills (0 = wait for a release)."""
+        if self.in_use >= self.limit.concurrency:
+            return 0.0
+        if self.limit.rate > 0:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.limit.rate
+            self.tokens -= 1
+        self.in_use += 1
+        return -1.0
+
+
+class UpstreamScheduler:
+    def __init__(self, limits: dict[str, UpstreamLimit], turn_estimate: float = 5.0, alpha: float = 0.2,
+                 probe_interval: float = 10.0, half_life: float = 60.0):
+        self._upstreams = {name: _Upstream(name, limit) for name, limit in limits.items()}
+        self._seq = itertools.count()
+        self._alpha = alpha
+        self._turn_ewma = turn_estimate
+        self._turn_seen = time.monotonic()
+        self._probe_interval = probe_interval
+        self._half_life = half_life
+        self._last_probe = float("-inf")
+        self.turns_shed = 0
+        self.probes = 0
+
+    def _learn(self, current: float, sample: float) -> float:
+        return sample if current == 0 else current + self._alpha * (sample - current)
+
+    def turn_estimate(self, now: float | None = None) -> float:
+        """Learned turn time, decayed by how long ago a turn last finished."""
+        if self._half_life <= 0:
+            return self._turn_ewma
+        idle = (time.monotonic() if now is None else now) - self._turn_seen
+        return self._turn_ewma * 0.5 ** (max(0.0, idle) / self._half_life)
+
+    def observe_turn(self, seconds: float) -> None:
+        """Time from a turn's start to its reply; the bar ``should_shed`` holds new turns to."""
+        now = time.monotonic()
+        self._turn_ewma = self._learn(self.turn_estimate(now), seconds)
+        self._turn_seen = now
+
+    def should_shed(self, deadline: float | None) -> bool:
+        """True when a turn starting now would likely miss ``deadline``."""
+        if deadline is None:
+            return False
+        now = time.monotonic()
+        if deadline - now >= self.turn_estimate(now):
+            return False
+        # Only finished turns lower the estimate, so let one through now and then
+        if self._probe_interval > 0 and now - self._last_probe >= self._probe_interval:
+            self._last_probe = now
+            self.probes += 1
+            return False
+        self.turns_shed += 1
+        SHED.inc("turn")
+        return True
+
+    def _reserve(self, up: _Upstream) -> float:
+        line = self._upstreams.get("line")
+        return up.service_ewma + (line.service_ewma if line is not None and line is not up else 0.0)
+
+    def _dispatch(self, up: _Upstream) -> None:
+        up.timer = None
+        while up.waiters:
+            fut = up.waiters[0][2]
+            if fut.done():  # gave up (shed or cancelled)
+                heapq.heappop(up.waiters)
+                continue
+            wait = up.try_take()
+            if wait >= 0:
+                if wait > 0:
+                    up.timer = asyncio.get_running_loop().call_later(wait, self._dispatch, up)
+                return
+            heapq.heappop(up.waiters)
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, upstream: str | None, shed: bool = True):
+        """Hold one call's worth of ``upstream`` capacity; unknown upstreams pass straight through.
+
+        ``shed=False`` waits regardless of the reply deadline (e.g. a reply
+        that can still go out as a push).
+        """
+        up = self._upstreams.get(upstream) if upstream else None
+        if up is None:
+            yield
+            return
+        priority, deadline = _lane.get(), _deadline.get() if shed else None
+        queued = time.monotonic()
+        if up.waiters or up.try_take() >= 0:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(up.waiters, (priority, next(self._seq), fut))
+            if up.timer is None:
+                self._dispatch(up)
+            timeout = None if deadline is None else deadline - self._reserve(up) - time.monotonic()
+            try:
+                if timeout is not None and timeout <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(asyncio.shield(fut), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if fut.done() and not fut.cancelled():
+                    self._release(up)  # granted in the same tick it gave up
+                else:
+                    fut.cancel()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                up.shed += 1
+                SHED.inc(up.name)
+                raise TurnShed(up.name) from None
+        granted = time.monotonic()
+        waited = granted - queued
+        up.granted += 1
+        up.wait_total += waited
+        up.wait_max = max(up.wait_max, waited)
+        QUEUE_SECONDS.observe(waited, up.name, LANE_NAMES[priority])
+        if waited > 0.001:
+            metrics.record(f"wait_{up.name}", waited)
+        try:
+            yield
+        finally:
+            up.service_ewma = self._learn(up.service_ewma, time.monotonic() - granted)
+            self._release(up)
+
+    def _release(self, up: _Upstream) -> None:
+        up.in_use -= 1
+        if up.waiters and up.timer is None:
+            self._dispatch(up)
+
+    def stats(self) -> dict:
+        return {
+            "turn_estimate_s": round(self.turn_estimate(), 3),
+            "turns_shed": self.turns_shed,
+            "probe_turns": self.probes,
+            "upstreams": {
+                up.name: {
+                    "concurrency": up.limit.concurrency,
+                    "rate": up.limit.rate,
+                    "in_use": up.in_use,
+                    "waiting": sum(1 for *_, f in up.waiters if not f.done()),
+                    "granted": up.granted,
+                    "shed": up.shed,
+                    "avg_wait_s": up.wait_total / up.granted if up.granted else 0.0,
+                    "max_wait_s": up.wait_max,
+                    "avg_call_s": round(up.service_ewma, 3),
+                }
+                for up in self._upstreams.values()
+            },
+        }
@@ -0,0 +1,101 @@
+## Import Library
+import time
+import threading
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """Bounded cache of generated answers looked up by query-embedding similarity.
+
+    Entries live in a preallocated matrix of unit vectors, so a lookup is one
+    matrix-vector product. A hit needs the same path decision, the same catalog
+    version and a cosine similarity of at least ``threshold``. The least
+    recently used slot is overwritten once the cache is full.
+    """
+
+    def __init__(self, maxsize: int = 1000, threshold: float = 0.95, ttl: float = 3600):
+        self._maxsize = maxsize
+        self._threshold = threshold
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._vectors: np.ndarray | None = None
+        self._expires = np.zeros(maxsize, dtype=np.float64)
+        self._last_used = np.zeros(maxsize, dtype=np.float64)
+        self._paths: list[str | None] = [None] * maxsize
+        self._answers: list[str | None] = [None] * maxsize
+        self._catalog_version = ""
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _unit(vector: list[float]) -> np.ndarray:
+        q = np.asarray(vector, dtype=np.float32)
+        return q / (np.linalg.norm(q) or 1.0)
+
+    def _check_version(self, catalog_version: str) -> None:
+        if catalog_version != self._catalog_version:
+            self._catalog_version = catalog_version
+            self._clear()
+
+    def _clear(self) -> None:
+        self._expires[:] = 0
+        self._paths = [None] * self._maxsize
+        self._answers = [None] * self._maxsize
+        self.invalidations += 1
+
+    def lookup(self, vector: list[float], path_decision: str, catalog_version: str = "") -> str | None:
+        if self._maxsize <= 0:
+            return None
+        q = self._unit(vector)
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(catalog_version)
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            live = (self._expires > now) & np.array([p == path_decision for p in self._paths])
+            if not live.any():
+                self.misses += 1
+                return None
+            sims = np.where(live, self._vectors @ q, -1.0)
+            best = int(np.argmax(sims))
+            if sims[best] < self._threshold:
+                self.misses += 1
+                return None
+            self._last_used[best] = now
+            self.hits += 1
+            return self._answers[best]
+
+    def store(self, vector: list[float], path_decision: str, answer: str, catalog_version: str = "") -> None:
+        if self._maxsize <= 0:
+            return
+        q = self._unit(vector)
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(catalog_version)
+            if self._vectors is None:
+                self._vectors = np.zeros((self._maxsize, len(q)), dtype=np.float32)
+            expired = np.flatnonzero(self._expires <= now)
+            slot = int(expired[0]) if len(expired) else int(np.argmin(self._last_used))
+            self._vectors[slot] = q
+            self._expires[slot] = now + self._ttl
+            self._last_used[slot] = now
+            self._paths[slot] = path_decision
+            self._answers[slot] = answer
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": int((self._expires > time.monotonic()).sum()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,95 @@
+"""Speculative answer generation, started while the path decision is pending.
+
+When the likely path is easy to guess (a fresh session leans on the product
+or service index; an ongoing one usually stays on its ``latest_decision``),
+the pipeline generates an answer from that path's context in parallel with
+classification. It is kept when the decision agrees and dropped otherwise.
+
+Tokens spent on dropped answers are charged to a per-minute budget
+(``SPECULATION_TOKEN_BUDGET``); while it is exhausted no new speculation
+starts.
+"""
+
+## Import Library
+import time
+import asyncio
+import threading
+
+SPECULATIVE_PATHS = ("INSURANCE_SERVICE", "INSURANCE_PRODUCT")
+
+
+class Speculator:
+    def __init__(self, token_budget_per_min: int = 20000):
+        self._budget = float(token_budget_per_min)
+        self._tokens = self._budget
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped_budget = 0
+        self.wasted_tokens = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._budget, self._tokens + (now - self._refilled) * self._budget / 60)
+        self._refilled = now
+
+    @staticmethod
+    def predict(chat_history: str | None, latest_decision: str | None, want_service: bool) -> str | None:
+        if not chat_history:
+            return "INSURANCE_SERVICE" if want_service else "INSURANCE_PRODUCT"
+        if latest_decision in SPECULATIVE_PATHS:
+            return latest_decision
+        return None
+
+    def allow(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens <= 0:
+                self.skipped_budget += 1
+                return False
+            self.started += 1
+            return True
+
+    def charge(self, tokens: int) -> None:
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            self.wasted_tokens += tokens
+
+    def hit(self) -> None:
+        with self._lock:
+            self.hits += 1
+
+    def discard(self, task: asyncio.Future, cancellable: bool, estimate: int) -> None:
+        """Drop a speculative ``(answer, tokens)`` task whose path lost.
+
+        A cancellable (async client) request is cancelled and charged its
+        prompt estimate; a request already running on the thread pool cannot
+        be stopped, so it is charged its real usage when it finishes.
+        """
+        with self._lock:
+            self.misses += 1
+        if cancellable and not task.done():
+            task.cancel()
+            self.charge(estimate)
+            return
+
+        def _charge(done: asyncio.Future) -> None:
+            if done.cancelled() or done.exception() is not None:
+                return
+            self.charge(done.result()[1])
+        task.add_done_callback(_charge)
+
+    def stats(self) -> dict:
+        with self._lock:
+            decided = self.hits + self.misses
+            return {
+                "started": self.started,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / decided if decided else 0.0,
+                "skipped_budget": self.skipped_budget,
+                "wasted_tokens": self.wasted_tokens,
+            }
@@ -0,0 +1,195 @@
+## Import Library
+import json
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+
+class ConversationStateCache:
+    """Per-user LRU cache of conversation state documents with idle TTL and a memory cap.
+
+    Saves update cached entries in place (write-through) via ``apply``. A load
+    that raced with a save is not stored: ``begin_load`` hands out a sequence
+    token and ``put`` refuses it if the user was written after the token.
+    Write sequences are remembered for ``write_window`` seconds; a load token
+    older than a forgotten write is refused for every user, so the check
+    holds however many users write.
+    """
+
+    def __init__(self, merge: Callable[[dict, list[dict]], dict],
+                 max_bytes: int = 64 * 1024 * 1024, idle_ttl: float = 1800, write_window: float = 300):
+        self._merge = merge
+        self._max_bytes = max_bytes
+        self._idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, dict, int]] = OrderedDict()
+        self._write_window = write_window
+        self._last_write: OrderedDict[str, tuple[int, float]] = OrderedDict()  # user -> (seq, monotonic time)
+        self._forgotten_seq = -1
+        self._seq = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(state: dict) -> int:
+        turns = state.get("turns", [])
+        return 200 + len(state.get("summary") or "") * 3 + sum(120 + len(t.get("message") or "") * 3 for t in turns)
+
+    def _drop(self, user_id: str) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry:
+            self._bytes -= entry[2]
+
+    def _evict(self, now: float) -> None:
+        while self._entries:
+            user_id, (last, _, _) = next(iter(self._entries.items()))
+            if self._bytes <= self._max_bytes and now - last < self._idle_ttl:
+                break
+            self._drop(user_id)
+            self.evictions += 1
+
+    def _written(self, user_id: str, now: float) -> None:
+        self._seq += 1
+        self._last_write[user_id] = (self._seq, now)
+        self._last_write.move_to_end(user_id)
+        while self._last_write:
+            seq, at = next(iter(self._last_write.values()))
+            if now - at < self._write_window:
+                break
+            self._last_write.popitem(last=False)
+            self._forgotten_seq = max(self._forgotten_seq, seq)
+
+    def get(self, user_id: str) -> dict | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or now - entry[0] >= self._idle_ttl:
+                if entry is not None:
+                    self._drop(user_id)
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries[user_id] = (now, entry[1], entry[2])
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def begin_load(self) -> int:
+        with self._lock:
+            return self._seq
+
+    def put(self, user_id: str, state: dict, token: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_write.get(user_id)
+            if (last[0] if last else self._forgotten_seq) > token:
+                return
+            self._drop(user_id)
+            size = self._size(state)
+            self._entries[user_id] = (now, state, size)
+            self._bytes += size
+            self._evict(now)
+
+    def apply(self, user_id: str, records: list[dict]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._written(user_id, now)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            state = self._merge(entry[1], records)
+            self._drop(user_id)
+            size = self._size(state)
+            self._entries[user_id] = (now, state, size)
+            self._bytes += size
+            self._evict(now)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._written(user_id, time.monotonic())
+            self._drop(user_id)
+
+    def mark_stale(self, user_id: str) -> None:
+        """A verified read found the entry outdated: drop it and count the lookup as a miss."""
+        with self._lock:
+            self.stale += 1
+            self.hits -= 1
+            self.misses += 1
+            self._drop(user_id)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "tracked_writes": len(self._last_write),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+            }
+
+
+class SharedStateStamps:
+    """Users' stored ``updated_at``/``compacted_at`` stamps, mirrored in memcached.
+
+    Whoever writes or compacts a user's state publishes the new stamps
+    (newest wins, via gets/cas), so another worker can check its cached copy
+    with one memcached get instead of a Mongo read. A missing key means
+    unknown: the caller reads the stamps from Mongo and ``seed``s them.
+    Stamps are kept at millisecond precision, as Mongo stores them.
+    """
+
+    FIELDS = ("updated_at", "compacted_at")
+    _EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, client, ttl: int = 1800, prefix: str = "linestate:", max_attempts: int = 10):
+        self._client = client
+        self._ttl = ttl
+        self._prefix = prefix
+        self._max_attempts = max_attempts
+
+    @classmethod
+    def _ms(cls, ts: datetime | None) -> int | None:
+        if ts is None:
+            return None
+        if ts.tzinfo:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        return (ts - cls._EPOCH) // timedelta(milliseconds=1)
+
+    def get(self, user_id: str) -> dict | None:
+        raw = self._client.get(self._prefix + user_id)
+        if not raw:
+            return None
+        return {k: None if v is None else self._EPOCH + timedelta(milliseconds=v) for k, v in json.loads(raw).items()}
+
+    def seed(self, user_id: str, stamp: dict) -> None:
+        """Store stamps read from Mongo, unless a writer has published since."""
+        value = {k: self._ms(stamp.get(k)) for k in self.FIELDS}
+        self._client.add(self._prefix + user_id, json.dumps(value), self._ttl)
+
+    def publish(self, user_id: str, stamp: dict) -> None:
+        key = self._prefix + user_id
+        for _ in range(self._max_attempts):
+            raw, cas = self._client.gets(key)
+            current = json.loads(raw) if raw else {}
+            value = {}
+            for k in self.FIELDS:
+                known = [v for v in (current.get(k), self._ms(stamp.get(k))) if v is not None]
+                value[k] = max(known) if known else None
+            if raw is None:
+                stored = self._client.add(key, json.dumps(value), self._ttl)
+            else:
+                stored = self._client.cas(key, json.dumps(value), cas, self._ttl)
+            if stored:
+                return
+        raise RuntimeError(f"State stamp for {user_id} stayed contended after {self._max_attempts} attempts")
+
+    def forget(self, user_id: str) -> None:
+        """The state was deleted: readers must fall back to Mongo."""
+        self._client.delete(self._prefix + user_id)
@@ -0,0 +1,78 @@
+"""Background prewarm at startup and the readiness it gates.
+
+Clients are created lazily (``utils.clients``), so without a warmup the first
+turn pays for SDK imports, client construction and a TLS handshake to every
+upstream. ``Warmup.run`` starts those steps concurrently right after startup,
+records how long each took (and whether it failed), and marks the worker
+ready once all have finished or ``timeout`` has passed. A failed step still
+counts as done: the pod becomes ready and that upstream connects on first use.
+
+Timings are measured from ``started`` (taken at the top of the app module,
+before the heavy imports): ``import_s`` up to startup, ``ready_s`` up to the
+end of the warmup, and ``first_turn_s`` for the first answered turn.
+"""
+
+## Import Library
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    def __init__(self, started: float, timeout: float = 10.0):
+        self.started = started
+        self._timeout = timeout
+        self.ready = False
+        self.import_s: float | None = None
+        self.ready_s: float | None = None
+        self.first_turn_s: float | None = None
+        self.first_reply_s: float | None = None
+        self.steps: dict[str, dict] = {}
+
+    def mark_started(self) -> None:
+        """Call first thing in the startup hook: everything before it was imports and module setup."""
+        self.import_s = time.perf_counter() - self.started
+
+    async def _step(self, name: str, fn: Callable[[], Awaitable]) -> None:
+        start = time.perf_counter()
+        try:
+            await fn()
+            self.steps[name] = {"seconds": round(time.perf_counter() - start, 3), "ok": True}
+        except Exception as e:
+            self.steps[name] = {"seconds": round(time.perf_counter() - start, 3), "ok": False, "error": str(e)[:200]}
+            logger.warning("Prewarm step %s failed: %s", name, e)
+
+    async def run(self, steps: dict[str, Callable[[], Awaitable]]) -> None:
+        tasks = [asyncio.ensure_future(self._step(name, fn)) for name, fn in steps.items()]
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=self._timeout)
+            for task in pending:
+                task.cancel()
+            for name in steps:
+                self.steps.setdefault(name, {"seconds": self._timeout, "ok": False, "error": "timed out"})
+        self.mark_ready()
+
+    def mark_ready(self) -> None:
+        self.ready_s = time.perf_counter() - self.started
+        self.ready = True
+        logger.info("Worker ready in %.2fs (imports %.2fs); prewarm: %s", self.ready_s, self.import_s or 0.0,
+                    ", ".join(f"{n}={s['seconds']}s{'' if s['ok'] else ' (failed)'}" for n, s in self.steps.items()))
+
+    def first_turn(self, seconds: float) -> None:
+        """Record the first answered turn (its duration and when it replied, from process start)."""
+        if self.first_turn_s is None:
+            self.first_turn_s = seconds
+            self.first_reply_s = time.perf_counter() - self.started
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "import_s": self.import_s,
+            "ready_s": self.ready_s,
+            "first_turn_s": self.first_turn_s,
+            "first_reply_s": self.first_reply_s,
+            "prewarm": self.steps,
+        }
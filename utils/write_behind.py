@@ -0,0 +1,205 @@
+## Import Library
+import time
+import logging
+import threading
+from collections import defaultdict
+from typing import Callable
+
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cosmos DB for MongoDB reports request-rate throttling as 16500 (some versions 429)
+THROTTLE_CODES = {16500, 429}
+DUPLICATE_KEY = 11000
+
+
+class ChatWriteBehind:
+    """Buffers chat records from every user and flushes them in bulk.
+
+    A flusher thread writes when ``max_batch`` records are queued or
+    ``max_delay`` seconds after the first one: one unordered ``insert_many``
+    into the message log and one unordered ``bulk_write`` with a single upsert
+    per user into the state collection. Throttled writes are retried with
+    backoff. Records stay visible through ``pending`` until their flush
+    succeeds, so a user's next turn can overlay them on the stored state.
+
+    The collections are passed as zero-argument getters, so the Mongo client
+    is only created once something is written. ``on_stored`` is called on the
+    flusher thread with the records, by user, whose state write landed.
+    """
+
+    def __init__(self, log_collection: Callable, state_collection: Callable,
+                 state_update: Callable[[list[dict]], dict],
+                 max_batch: int = 100, max_delay: float = 0.2, max_retries: int = 5,
+                 on_stored: Callable[[dict[str, list[dict]]], None] | None = None):
+        self._log = log_collection
+        self._states = state_collection
+        self._state_update = state_update
+        self._on_stored = on_stored
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._max_retries = max_retries
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._queue: list[dict] = []
+        self._first_queued = 0.0
+        self._pending: dict[str, list[dict]] = defaultdict(list)
+        self._closed = False
+        self.flushes = 0
+        self.records_flushed = 0
+        self.retries = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+        self._thread.start()
+
+    def add(self, record: dict) -> None:
+        with self._cond:
+            if not self._queue:
+                self._first_queued = time.monotonic()
+            self._queue.append(record)
+            self._pending[record["user_id"]].append(record)
+            # Wake the flusher to start the max_delay timer, or flush a full batch
+            if len(self._queue) == 1 or len(self._queue) >= self._max_batch:
+                self._cond.notify()
+
+    def pending(self, user_id: str) -> list[dict]:
+        with self._cond:
+            return list(self._pending.get(user_id, ()))
+
+    def discard(self, user_id: str) -> None:
+        """Drop a user's unflushed records, waiting out any flush already writing them."""
+        with self._flush_lock, self._cond:
+            self._queue = [r for r in self._queue if r["user_id"] != user_id]
+            self._pending.pop(user_id, None)
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._cond:
+                batch, self._queue = self._queue, []
+            if batch:
+                self._write(batch)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=30)
+        self.flush()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._queue) >= self._max_batch:
+                        break
+                    if self._queue:
+                        remaining = self._first_queued + self._max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            self.flush()
+
+    def _retrying(self, op: Callable[[list], None], items: list, done_codes: set[int],
+                  retry_codes: set[int] = THROTTLE_CODES, idempotent: bool = True) -> list:
+        """Run a bulk op, re-sending only retryable items; returns items that never succeeded.
+
+        Items reported in ``writeErrors`` did not apply and are always safe to
+        re-send. A whole-op failure (throttled command, lost connection) may
+        have applied part of the batch, so it is only retried when re-running
+        ``op`` is ``idempotent``.
+        """
+        for attempt in range(self._max_retries + 1):
+            try:
+                op(items)
+                return []
+            except BulkWriteError as e:
+                retry = []
+                for err in e.details.get("writeErrors", []):
+                    if err.get("code") in retry_codes:
+                        retry.append(items[err["index"]])
+                    elif err.get("code") not in done_codes:
+                        logger.error("Chat write failed permanently: %s", err.get("errmsg"))
+                        self.failed += 1
+                items = retry
+            except OperationFailure as e:
+                if e.code not in THROTTLE_CODES:
+                    raise
+                if not idempotent:
+                    logger.error("Chat write failed and may have partly applied; not retrying: %s", e)
+                    return items
+            except AutoReconnect as e:
+                if not idempotent:
+                    logger.error("Chat write failed and may have partly applied; not retrying: %s", e)
+                    return items
+            if not items:
+                return []
+            self.retries += 1
+            time.sleep(min(2.0, 0.05 * 2 ** attempt))
+        return items
+
+    def _release(self, by_user: dict[str, list[dict]]) -> None:
+        """Drop flushed records from ``pending`` (by identity; safe to repeat)."""
+        with self._cond:
+            for uid, recs in by_user.items():
+                remaining = [r for r in self._pending.get(uid, ()) if not any(r is x for x in recs)]
+                if remaining:
+                    self._pending[uid] = remaining
+                else:
+                    self._pending.pop(uid, None)
+
+    def _write(self, batch: list[dict]) -> None:
+        by_user: dict[str, list[dict]] = defaultdict(list)
+        for record in batch:
+            by_user[record["user_id"]].append(record)
+        started = time.monotonic()
+        try:
+            # Log inserts keep their client-side _id across retries, so a
+            # duplicate key means an earlier attempt already landed.
+            lost = self._retrying(lambda docs: self._log().insert_many(docs, ordered=False),
+                                  batch, {DUPLICATE_KEY})
+            # Upserts may race another worker's first insert (duplicate key): retry those.
+            # The $push is not idempotent, so the state write is not re-run as a whole.
+            ops = [UpdateOne({"_id": uid}, self._state_update(recs), upsert=True) for uid, recs in by_user.items()]
+            lost += self._retrying(lambda o: self._states().bulk_write(o, ordered=False), ops, set(),
+                                   THROTTLE_CODES | {DUPLICATE_KEY}, idempotent=False)
+            # The state now holds these turns; stop overlaying them before the bookkeeping below
+            self._release(by_user)
+            if self._on_stored:
+                stored = {uid: recs for (uid, recs), op in zip(by_user.items(), ops)
+                          if not any(op is x for x in lost)}
+                try:
+                    self._on_stored(stored)
+                except Exception as e:
+                    logger.warning(f"Chat write-behind on_stored hook failed: {e}")
+            if lost:
+                self.failed += len(lost)
+                metrics.upstream_error("mongo")
+                logger.error("Dropped %d chat writes (up to %d retries each).", len(lost), self._max_retries)
+        except Exception as e:
+            self.failed += len(batch)
+            metrics.upstream_error("mongo")
+            logger.error(f"Chat write-behind flush failed: {e}", exc_info=True)
+        finally:
+            self._release(by_user)
+            metrics.record("chat_write_flush", time.monotonic() - started)
+            self.flushes += 1
+            self.records_flushed += len(batch)
+
+    def stats(self) -> dict[str, int]:
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "pending_users": len(self._pending),
+                "flushes": self.flushes,
+                "records_flushed": self.records_flushed,
+                "retries": self.retries,
+                "failed": self.failed,
+            }